@@ -0,0 +1,72 @@
+"""
+benchmark共用的辅助函数
+"""
+
+import os
+import subprocess as sp
+import sys
+from pathlib import Path
+
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+ROOT = Path(__file__).parent.parent
+
+
+def parse_size(s: str) -> int:
+    """
+    1K => 1024
+    """
+    s = s.strip().upper()
+    if s[-1] in UNITS:
+        return int(s[:-1]) * UNITS[s[-1]]
+    return int(s)
+
+
+def write_file(
+    path: Path, size: int, chunk: bytes = b"\x5a" * (1024 * 1024), flip_at: int = None
+):
+    """
+    重复写入chunk直到size字节，flip_at不为None时修改该位置的一个字节
+    """
+    with open(path, "wb") as f:
+        rest = size
+        while rest > 0:
+            n = min(rest, len(chunk))
+            f.write(chunk[:n])
+            rest -= n
+        if flip_at is not None:
+            f.seek(flip_at)
+            f.write(b"\xa5")
+
+
+def run_python(code: str, *opts: str) -> sp.CompletedProcess:
+    """
+    在新的python进程中运行code，可以导入当前源码中的dotutil_cz
+    """
+    env = os.environ.copy()
+    # 与安装后一样使用pyc
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(ROOT), env.get("PYTHONPATH")])
+    )
+    return sp.run(
+        [sys.executable, *opts, "-c", code],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        text=True,
+        env=env,
+        check=True,
+    )
+
+
+def import_times(module: str) -> dict:
+    """
+    解析`python -X importtime`的输出，返回模块 -> 累计导入时间(us)
+    """
+    p = run_python(f"import {module}", "-X", "importtime")
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
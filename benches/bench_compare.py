@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+比较has_changed的逐块比较与原来两次sha256的耗时
+
+    python benches/bench_compare.py --sizes 1K,1M,64M,1G
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from _common import parse_size, write_file
+
+from dotutil_cz.util import get_digest, same_content
+
+
+def timeit(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1K,64K,1M,64M,1G")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dir", help="temp dir for generated files")
+    args = parser.parse_args()
+    # digest cache would hide the cost of the hash path
+    os.environ.pop("CHEZMOI_CACHE_DIR", None)
+
+    print(
+        f"{'size':>8} {'case':>6} {'sha256(s)':>10} {'compare(s)':>11} {'speedup':>8}"
+    )
+    with tempfile.TemporaryDirectory(dir=args.dir) as dir:
+        a, b = Path(dir).joinpath("a"), Path(dir).joinpath("b")
+        for s in args.sizes.split(","):
+            size = parse_size(s)
+            write_file(a, size)
+            for case, flip_at in [("equal", None), ("early", 0), ("late", size - 1)]:
+                write_file(b, size, flip_at=flip_at)
+                old = timeit(lambda: get_digest(a) != get_digest(b), args.repeat)
+                new = timeit(lambda: not same_content(a, b), args.repeat)
+                print(f"{s:>8} {case:>6} {old:>10.4f} {new:>11.4f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
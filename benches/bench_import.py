@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+使用`python -X importtime`统计模块的导入时间，列出累计耗时最多的模块
+
+    python benches/bench_import.py dotutil_cz.dotroot --repeat 5 --top 15
+"""
+
+import argparse
+import statistics
+from collections import defaultdict
+
+from _common import import_times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=["dotutil_cz.dotroot"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        # warm up pyc
+        import_times(module)
+        samples = defaultdict(list)
+        for _ in range(args.repeat):
+            for name, us in import_times(module).items():
+                samples[name].append(us)
+        medians = {name: statistics.median(v) for name, v in samples.items()}
+        print(f"{module}: {medians[module] / 1000:.1f}ms (median of {args.repeat})")
+        for name, us in sorted(medians.items(), key=lambda kv: -kv[1])[1 : args.top]:
+            print(f"  {us / 1000:>8.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
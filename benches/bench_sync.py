@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+使用生成的~/.root与root目录测试pre_sync_from_root、copy_to_root与RootCleaner.clean的
+耗时与子进程数，结果以json输出，可以在不同的commit之间比较。
+
+root目录替换为临时目录，提权默认使用fake以当前用户运行worker，不需要sudo。root运行时可以用
+--elevate direct比较在当前进程中执行的耗时。
+
+--private模拟当前用户无法访问的root目录：
+* 以普通用户运行时将这些目录chmod 0，需要--elevate sudo或doas才能读取
+* 以root运行时目录只属于root(0700)，其余文件属于--user，测量时当前进程的euid切换为
+  --user，fake worker恢复root权限后运行
+
+    python benches/bench_sync.py --files 1000,10000,100000 --output result.json
+"""
+
+import argparse
+import json
+import os
+import pwd
+import random
+import subprocess as sp
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# 在导入dotutil_cz之前设置
+os.environ["DOTUTIL_CZ_RM_DEFAULT"] = "remove"
+
+from _common import parse_size  # noqa
+
+from dotutil_cz import elevate  # noqa
+from dotutil_cz.dotroot import RootCleaner, copy_to_root, pre_sync_from_root  # noqa
+from dotutil_cz.plan import Plan, subprocess_count  # noqa
+from dotutil_cz.util import ChezmoiArgs, close_caches  # noqa
+
+FANOUT = 20
+
+
+def parse_dist(s: str):
+    """
+    1K:0.9,64K:0.1 => ([1024, 65536], [0.9, 0.1])
+    """
+    sizes, weights = [], []
+    for item in s.split(","):
+        size, weight = item.split(":")
+        sizes.append(parse_size(size))
+        weights.append(float(weight))
+    return sizes, weights
+
+
+class Tree:
+    """
+    生成的测试目录：home/.root/bench映射到root/bench，src为对应的chezmoi源码目录
+    """
+
+    def __init__(self, dir: Path, owner=None) -> None:
+        self.dir = dir
+        # 以root运行时home与缓存目录的(uid, gid)，root目录仍属于root
+        self.owner = owner
+        self.home = dir.joinpath("home")
+        self.mapped_root = self.home.joinpath(".root")
+        self.root = dir.joinpath("root")
+        self.src = dir.joinpath("src")
+        self.cache = dir.joinpath("cache")
+        self.files = []
+        self.private_dirs = []
+
+    def rel(self, i: int) -> str:
+        return os.path.join(
+            "bench",
+            f"d{i // FANOUT // FANOUT:04}",
+            f"s{i // FANOUT % FANOUT:02}",
+            f"f{i % FANOUT:03}",
+        )
+
+    def generate(self, n: int, dist, private: float, rng: random.Random):
+        sizes, weights = dist
+        blob = rng.randbytes(max(sizes))
+        for i in range(n):
+            rel = self.rel(i)
+            data = blob[: rng.choices(sizes, weights)[0]]
+            for top in [self.mapped_root, self.root]:
+                p = top.joinpath(rel)
+                p.parent.mkdir(parents=True, exist_ok=True)
+                p.write_bytes(data)
+            if i % FANOUT == 0:
+                d = Path(rel).parent
+                self.src.joinpath("dot_root", d).mkdir(parents=True, exist_ok=True)
+                if rng.random() < private:
+                    self.private_dirs.append(self.root.joinpath(d))
+            self.files.append(rel)
+        self.cache.mkdir()
+        if self.owner is not None:
+            self.dir.chmod(0o755)
+            for top in [self.home, self.src, self.cache]:
+                for d, dirs, files in os.walk(top):
+                    for name in [d] + [os.path.join(d, n) for n in dirs + files]:
+                        os.lchown(name, *self.owner)
+
+    def change(self, fraction: float, top: Path, rng: random.Random) -> int:
+        changed = rng.sample(self.files, int(len(self.files) * fraction))
+        for rel in changed:
+            with open(top.joinpath(rel), "ab") as f:
+                f.write(b"changed")
+        return len(changed)
+
+    def remove(self, fraction: float, rng: random.Random) -> int:
+        removed = rng.sample(self.files, int(len(self.files) * fraction))
+        for rel in removed:
+            self.mapped_root.joinpath(rel).unlink()
+            self.files.remove(rel)
+        return len(removed)
+
+    def set_private(self, private: bool):
+        # 当前用户无法访问的root目录，以root运行时只需要去掉其它用户的权限
+        mode = 0o700 if self.owner is not None else 0
+        for d in self.private_dirs:
+            d.chmod(mode if private else 0o755)
+
+    @contextmanager
+    def as_owner(self):
+        """
+        以root运行时将当前进程的euid切换为owner，real uid仍为root，之后可以切换回来
+        """
+        if self.owner is None:
+            yield
+            return
+        groups = os.getgroups()
+        os.setgroups([])
+        os.setegid(self.owner[1])
+        os.seteuid(self.owner[0])
+        try:
+            yield
+        finally:
+            os.seteuid(0)
+            os.setegid(0)
+            os.setgroups(groups)
+
+
+class RootFakeBackend(elevate.FakeBackend):
+    """
+    当前进程的euid为普通用户而real uid为root时，worker先恢复root权限再运行
+    """
+
+    def py_args(self, codestr: str, non_interactive=False):
+        codestr = "import os\nos.setresuid(0, 0, 0)\nos.setresgid(0, 0, 0)\n" + codestr
+        return super().py_args(codestr, non_interactive=non_interactive)
+
+
+def measure(name: str, fn, results: list, tree: Tree, **info):
+    plan = Plan(dry_run=False)
+    count = subprocess_count()
+    with tree.as_owner():
+        start = time.perf_counter()
+        # 失败时直接退出，不记录为耗时
+        fn(plan)
+        elapsed = time.perf_counter() - start
+    result = {
+        "phase": name,
+        **info,
+        "seconds": round(elapsed, 6),
+        "subprocesses": subprocess_count() - count,
+        "phases": plan.phases,
+    }
+    print(json.dumps(result), file=sys.stderr)
+    results.append(result)
+
+
+def run(n: int, args, results: list):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(dir=args.dir) as dir:
+        tree = Tree(Path(dir), owner=args.owner)
+        start = time.perf_counter()
+        tree.generate(n, parse_dist(args.size_dist), args.private, rng)
+        print(
+            f"generated {n} files in {time.perf_counter() - start:.3f}s",
+            file=sys.stderr,
+        )
+
+        os.environ["CHEZMOI_HOME_DIR"] = str(tree.home)
+        os.environ["CHEZMOI_CACHE_DIR"] = str(tree.cache)
+        cz = ChezmoiArgs("chezmoi apply")
+        info = {"files": n}
+
+        def cleaner():
+            return RootCleaner(
+                tree.mapped_root,
+                tree.cache.joinpath(".root"),
+                "false",
+                tree.src,
+                root=tree.root,
+            )
+
+        try:
+            changed = tree.change(args.changed, tree.mapped_root, rng)
+            tree.set_private(True)
+            measure(
+                "copy_to_root.cold",
+                lambda plan: copy_to_root(tree.mapped_root, plan=plan, root=tree.root),
+                results,
+                tree,
+                changed=changed,
+                **info,
+            )
+            measure(
+                "copy_to_root.warm",
+                lambda plan: copy_to_root(tree.mapped_root, plan=plan, root=tree.root),
+                results,
+                tree,
+                changed=0,
+                **info,
+            )
+
+            # 修改root文件时不能是私有的
+            tree.set_private(False)
+            changed = tree.change(args.changed, tree.root, rng)
+            tree.set_private(True)
+            measure(
+                "pre_sync_from_root",
+                lambda plan: pre_sync_from_root(cz, plan=plan, root=tree.root),
+                results,
+                tree,
+                changed=changed,
+                **info,
+            )
+
+            measure(
+                "clean.cold",
+                lambda plan: cleaner().clean(set(), plan=plan),
+                results,
+                tree,
+                removed=0,
+                **info,
+            )
+            removed = tree.remove(args.removed, rng)
+            measure(
+                "clean.removed",
+                lambda plan: cleaner().clean(set(), plan=plan),
+                results,
+                tree,
+                removed=removed,
+                **info,
+            )
+        finally:
+            tree.set_private(False)
+            # 摘要缓存与状态存储是进程内共享的，下一个大小使用新的CHEZMOI_CACHE_DIR
+            close_caches()
+
+
+def git_commit():
+    try:
+        return sp.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            text=True,
+            stderr=sp.DEVNULL,
+        ).strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", default="1000,10000,100000")
+    parser.add_argument(
+        "--size-dist",
+        default="1K:0.8,16K:0.15,1M:0.05",
+        help="file size distribution, size:weight,...",
+    )
+    parser.add_argument("--changed", type=float, default=0.01)
+    parser.add_argument("--private", type=float, default=0.0)
+    parser.add_argument("--removed", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--elevate", default="fake", help="elevate backend: fake, direct, sudo, doas"
+    )
+    parser.add_argument(
+        "--user",
+        default="nobody",
+        help="owner of the home tree with --private when running as root",
+    )
+    parser.add_argument("--dir", help="temp dir for generated trees")
+    parser.add_argument("--output", help="write json results to file")
+    args = parser.parse_args()
+
+    backend = elevate._which_backend(args.elevate)
+    args.owner = None
+    if args.private > 0:
+        if os.geteuid() == 0:
+            if backend.in_process:
+                parser.error("--private can not use an in process elevate backend")
+            pw = pwd.getpwnam(args.user)
+            args.owner = (pw.pw_uid, pw.pw_gid)
+            if isinstance(backend, elevate.FakeBackend):
+                backend = RootFakeBackend()
+        elif isinstance(backend, elevate.FakeBackend) or backend.in_process:
+            parser.error(
+                "--private needs --elevate sudo or doas when not running as root"
+            )
+    elevate.set_backend(backend)
+    results = []
+    for n in args.files.split(","):
+        run(int(n), args, results)
+
+    data = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "euid": os.geteuid() if hasattr(os, "geteuid") else None,
+        "elevate": elevate.backend().name,
+        "params": vars(args),
+        "results": results,
+    }
+    out = json.dumps(data, indent=2)
+    if args.output:
+        Path(args.output).write_text(out)
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
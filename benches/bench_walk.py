@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+比较dotroot原来使用的`Path.rglob`+`is_file/is_symlink/exists/stat`与walk的
+系统调用次数与耗时。通过替换os.scandir/os.stat/os.lstat计数，不需要strace
+
+    python benches/bench_walk.py --entries 100000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from dotutil_cz.walk import walk
+
+
+def gen_tree(root: Path, entries: int, fanout: int = 20):
+    """
+    生成约entries个目录项，每个目录fanout个文件，目录嵌套为两层
+    """
+    count = 0
+    i = 0
+    while count < entries:
+        d = root.joinpath(f"d{i // fanout:04}", f"s{i % fanout:02}")
+        d.mkdir(parents=True, exist_ok=True)
+        count += 1 if i % fanout else 2
+        for j in range(min(fanout, entries - count)):
+            d.joinpath(f"f{j:03}").write_bytes(b"x")
+            count += 1
+        i += 1
+
+
+@contextmanager
+def count_syscalls():
+    counts = {"scandir": 0, "stat": 0}
+    orig = {name: getattr(os, name) for name in ["scandir", "stat", "lstat"]}
+
+    def wrap(name, key):
+        def f(*args, **kwargs):
+            counts[key] += 1
+            return orig[name](*args, **kwargs)
+
+        return f
+
+    os.scandir = wrap("scandir", "scandir")
+    os.stat = wrap("stat", "stat")
+    os.lstat = wrap("lstat", "stat")
+    try:
+        yield counts
+    finally:
+        for name, f in orig.items():
+            setattr(os, name, f)
+
+
+def old_walk(root: Path) -> int:
+    n = 0
+    for p in root.rglob("*"):
+        if p.is_file() or p.is_symlink():
+            p.exists()
+            p.stat()
+            n += 1
+    return n
+
+
+def new_walk(root: Path) -> int:
+    n = 0
+    for e in walk(root):
+        if e.is_file() or e.is_symlink():
+            e.stat()
+            n += 1
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--dir", help="temp dir for generated tree")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as dir:
+        root = Path(dir)
+        gen_tree(root, args.entries)
+        print(f"generated tree in {root}")
+        print(f"{'walker':>8} {'files':>8} {'scandir':>8} {'stat':>8} {'time(s)':>8}")
+        for name, fn in [("rglob", old_walk), ("scandir", new_walk)]:
+            with count_syscalls() as counts:
+                start = time.perf_counter()
+                n = fn(root)
+                elapsed = time.perf_counter() - start
+            print(
+                f"{name:>8} {n:>8} {counts['scandir']:>8} {counts['stat']:>8} {elapsed:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+比较elevate_writefile不同来源的吞吐量：
+* legacy: 原来的实现，只有read()的stream，4 KiB的数据帧
+* stream: 没有fd的stream，自适应缓冲
+* file: 普通文件对象，使用sendfile写入worker的stdin
+* pipe: 子进程的stdout，使用splice写入worker的stdin
+* path: 源文件路径，由worker直接打开并使用copy_file_range
+
+    python benches/bench_writefile.py --sizes 1M,100M,1G --elevate fake
+"""
+
+import argparse
+import json
+import os
+import subprocess as sp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _common import parse_size, write_file
+
+from dotutil_cz import elevate
+from dotutil_cz.util import elevate_writefile
+
+MODES = ("legacy", "stream", "file", "pipe", "path")
+
+
+class ReadOnly:
+    """
+    只有read()的stream，不能使用fd
+    """
+
+    def __init__(self, f) -> None:
+        self._f = f
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+
+def write(mode: str, src: Path, dst: Path):
+    if mode == "legacy":
+        elevate_writefile(str(dst), ReadOnly(open(src, "rb")), chunk_size=4096)
+    elif mode == "stream":
+        elevate_writefile(str(dst), ReadOnly(open(src, "rb")))
+    elif mode == "file":
+        elevate_writefile(str(dst), open(src, "rb"))
+    elif mode == "pipe":
+        with sp.Popen(["cat", str(src)], stdout=sp.PIPE, bufsize=0) as p:
+            elevate_writefile(str(dst), p.stdout)
+    elif mode == "path":
+        elevate_writefile(str(dst), src)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1M,100M,1G")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--elevate", default="fake", help="elevate backend: fake, direct, sudo, doas"
+    )
+    parser.add_argument("--dir", help="temp dir for generated files")
+    args = parser.parse_args()
+
+    elevate.set_backend(elevate._which_backend(args.elevate))
+    # worker启动不计入耗时
+    elevate.worker().start()
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as dir:
+        src, dst = Path(dir).joinpath("src"), Path(dir).joinpath("dst")
+        for size_s in args.sizes.split(","):
+            size = parse_size(size_s)
+            write_file(src, size, chunk=os.urandom(1024 * 1024))
+            for mode in args.modes.split(","):
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    write(mode, src, dst)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                    assert dst.stat().st_size == size
+                    dst.unlink()
+                result = {
+                    "size": size_s,
+                    "mode": mode,
+                    "seconds": round(best, 6),
+                    "mib_per_s": round(size / 1024**2 / best, 1),
+                }
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+
+    print(
+        json.dumps(
+            {"elevate": elevate.backend().name, "results": results},
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
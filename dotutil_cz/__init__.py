@@ -1,7 +1,12 @@
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+# 与psutil.WINDOWS/psutil.POSIX一致，hook中不需要导入psutil
+WINDOWS = os.name == "nt"
+POSIX = os.name == "posix"
+
 
 class SetupException(Exception):
     pass
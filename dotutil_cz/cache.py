@@ -0,0 +1,510 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+log = logging.getLogger(__name__)
+
+
+class DigestCache:
+    """
+    持久化的文件摘要缓存，使用(device, inode, size, mtime_ns, ctime_ns)作为key，
+    文件未改变时可以不用重新读取内容计算hash。
+
+    超过max_entries时按LRU淘汰
+    """
+
+    VERSION = 1
+    # 与git的racy clean类似，刚修改过的文件可能在同一个时间戳内再次修改，不缓存
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, path: Path, max_entries=50000) -> None:
+        self._path = path
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def _fields(st: Union[os.stat_result, Dict[str, Any]]):
+        # 兼容提权worker返回的stat dict
+        if isinstance(st, dict):
+            return st["dev"], st["ino"], st["size"], st["mtime_ns"], st["ctime_ns"]
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+    @classmethod
+    def key(cls, st: Union[os.stat_result, Dict[str, Any]]) -> str:
+        return ":".join(str(v) for v in cls._fields(st))
+
+    def _load(self):
+        if not self._path.is_file():
+            return
+        try:
+            data = json.loads(self._path.read_text())
+            if data.get("version") != self.VERSION:
+                log.debug(f"ignore digest cache {self._path} with old version")
+                return
+            self._entries.update(data["entries"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f"ignore invalid digest cache {self._path}: {e}")
+            self._entries.clear()
+        log.debug(f"loaded {len(self._entries)} digests from {self._path}")
+
+    def get(self, st: Union[os.stat_result, Dict[str, Any]]) -> Optional[str]:
+        k = self.key(st)
+        with self._lock:
+            if (digest := self._entries.get(k)) is not None:
+                self._entries.move_to_end(k)
+            return digest
+
+    def put(self, st: Union[os.stat_result, Dict[str, Any]], digest: str):
+        if time.time_ns() - self._fields(st)[3] < self.RACY_NS:
+            return
+        k = self.key(st)
+        with self._lock:
+            self._entries[k] = digest
+            self._entries.move_to_end(k)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"version": self.VERSION, "entries": list(self._entries.items())}
+            self._dirty = False
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._path.with_name(f"{self._path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps(data, separators=(",", ":")))
+            os.replace(tmp, self._path)
+            log.debug(f"saved {len(data['entries'])} digests to {self._path}")
+        except OSError as e:
+            log.warning(f"failed to save digest cache {self._path}: {e}")
+            tmp.unlink(missing_ok=True)
+
+
+class ScanCache:
+    """
+    持久化的文件扫描结果缓存：路径 -> (size, mtime_ns, 结果)，文件未改变时
+    不需要重新扫描。tag表示扫描的方式(如正则)，与保存的tag不同时全部失效。
+    保存时删除已经不存在的路径
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path, tag: str) -> None:
+        self._path = path
+        self._tag = tag
+        self._entries: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not self._path.is_file():
+            return
+        try:
+            data = json.loads(self._path.read_text())
+            if data.get("version") != self.VERSION or data.get("tag") != self._tag:
+                log.debug(f"ignore scan cache {self._path} with old version or tag")
+                return
+            self._entries.update(data["entries"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f"ignore invalid scan cache {self._path}: {e}")
+            self._entries.clear()
+        log.debug(f"loaded {len(self._entries)} scan results from {self._path}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, path: Union[str, Path], st: os.stat_result) -> Optional[Any]:
+        entry = self._entries.get(str(path))
+        if entry is not None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+        return None
+
+    def put(self, path: Union[str, Path], st: os.stat_result, result: Any):
+        if time.time_ns() - st.st_mtime_ns < DigestCache.RACY_NS:
+            return
+        with self._lock:
+            self._entries[str(path)] = [st.st_size, st.st_mtime_ns, result]
+            self._dirty = True
+
+    def prune(self) -> int:
+        """
+        删除已经不存在的路径，返回删除的数量
+        """
+        with self._lock:
+            paths = list(self._entries)
+        missing = [p for p in paths if not os.path.lexists(p)]
+        if missing:
+            with self._lock:
+                for p in missing:
+                    self._entries.pop(p, None)
+                self._dirty = True
+            log.debug(f"pruned {len(missing)} missing paths from {self._path}")
+        return len(missing)
+
+    def save(self):
+        self.prune()
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                "version": self.VERSION,
+                "tag": self._tag,
+                "entries": dict(self._entries),
+            }
+            self._dirty = False
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._path.with_name(f"{self._path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps(data, separators=(",", ":")))
+            os.replace(tmp, self._path)
+            log.debug(f"saved {len(data['entries'])} scan results to {self._path}")
+        except OSError as e:
+            log.warning(f"failed to save scan cache {self._path}: {e}")
+            tmp.unlink(missing_ok=True)
+
+
+class MappedManifest:
+    """
+    上次apply后映射目录中所有路径的清单，与walk的顺序一致按路径parts排序。
+    第一行为版本，之后每行一个json [rel, type]，可以流式读取与写入，不需要载入内存。
+
+    新的清单先写入临时文件，commit后才会替换旧的清单
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    def read(self) -> Iterator[Tuple[str, str]]:
+        try:
+            with open(self._path, encoding="utf8") as f:
+                header = json.loads(f.readline() or "{}")
+                if header.get("version") != self.VERSION:
+                    log.debug(f"ignore manifest {self._path} with old version")
+                    return
+                for line in f:
+                    rel, type = json.loads(line)
+                    yield rel, type
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError) as e:
+            log.warning(f"ignore invalid manifest {self._path}: {e}")
+
+    def write(self, entries: Iterable[Tuple[str, str]]) -> int:
+        """
+        将entries写入临时文件，返回写入的数量
+        """
+        count = 0
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._tmp, "w", encoding="utf8") as f:
+            f.write(json.dumps({"version": self.VERSION}) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+    def commit(self):
+        if self._tmp.exists():
+            os.replace(self._tmp, self._path)
+            log.debug(f"saved manifest {self._path}")
+
+    def discard(self):
+        self._tmp.unlink(missing_ok=True)
+
+
+def user_cache_dir() -> Path:
+    """
+    当前用户的缓存目录：windows为LOCALAPPDATA，其它为XDG_CACHE_HOME或~/.cache
+    """
+    if os.name == "nt" and (v := os.environ.get("LOCALAPPDATA")):
+        return Path(v, "dotutil-cz")
+    if v := os.environ.get("XDG_CACHE_HOME"):
+        return Path(v, "dotutil-cz")
+    return Path.home().joinpath(".cache", "dotutil-cz")
+
+
+class DumpCache:
+    """
+    加密保存在本地的restic dump内容，key为(仓库id, snapshot id, path)。
+
+    每个内容一个文件，文件名为key的sha256，内容使用cipher(如Fernet)加密。
+    命中时更新文件的mtime，总大小超过max_size时按mtime淘汰最久未使用的内容，
+    大于max_entry_size的内容不缓存
+    """
+
+    SUFFIX = ".dump"
+
+    def __init__(
+        self, dir: Path, cipher, max_size=256 * 1024**2, max_entry_size=None
+    ) -> None:
+        self._dir = dir
+        self._cipher = cipher
+        self._max_size = max_size
+        self._max_entry_size = max_entry_size or max_size // 4
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(
+        cls, env: Dict[str, str], get_repo_id: Callable[[], str]
+    ) -> Optional["DumpCache"]:
+        """
+        从env创建仓库get_repo_id()的缓存，不可用时返回None并且不会查询仓库id：
+        * DOTUTIL_CZ_RESTIC_CACHE为0时禁用
+        * DOTUTIL_CZ_RESTIC_CACHE_DIR: 缓存目录，默认为user_cache_dir()/restic-dump
+        * DOTUTIL_CZ_RESTIC_CACHE_SIZE: 最大字节数，默认256MiB
+        * DOTUTIL_CZ_RESTIC_CACHE_KEY: Fernet key，默认使用PBKDF2从仓库密码
+          RESTIC_PASSWORD或RESTIC_PASSWORD_FILE派生
+
+        需要安装cryptography，没有密码时也不会缓存
+        """
+        if env.get("DOTUTIL_CZ_RESTIC_CACHE", "").strip().lower() in ("0", "false"):
+            return None
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            log.debug("disabled restic dump cache without cryptography")
+            return None
+
+        if not (key := env.get("DOTUTIL_CZ_RESTIC_CACHE_KEY")):
+            password = env.get("RESTIC_PASSWORD")
+            if not password and (f := env.get("RESTIC_PASSWORD_FILE")):
+                try:
+                    password = Path(f).read_text().rstrip("\r\n")
+                except OSError as e:
+                    log.debug(f"failed to read restic password file {f}: {e}")
+            if not password:
+                log.debug("disabled restic dump cache without restic password")
+                return None
+        repo_id = get_repo_id()
+        if not key:
+            import base64
+            import hashlib
+
+            key = base64.urlsafe_b64encode(
+                hashlib.pbkdf2_hmac(
+                    "sha256",
+                    password.encode(),
+                    f"dotutil-cz-restic-dump:{repo_id}".encode(),
+                    100000,
+                )
+            )
+        dir = env.get("DOTUTIL_CZ_RESTIC_CACHE_DIR")
+        dir = Path(dir) if dir else user_cache_dir().joinpath("restic-dump")
+        size = int(env.get("DOTUTIL_CZ_RESTIC_CACHE_SIZE") or 256 * 1024**2)
+        return cls(dir.joinpath(repo_id), Fernet(key), max_size=size)
+
+    def _path(self, snapshot_id: str, path: str) -> Path:
+        import hashlib
+
+        name = hashlib.sha256(f"{snapshot_id}\0{path}".encode()).hexdigest()
+        return self._dir.joinpath(name + self.SUFFIX)
+
+    def get(self, snapshot_id: str, path: str) -> Optional[bytes]:
+        p = self._path(snapshot_id, path)
+        try:
+            token = p.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            data = self._cipher.decrypt(token)
+        except Exception as e:
+            log.warning(f"removing invalid restic dump cache {p}: {e!r}")
+            p.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+        log.debug(f"hit restic dump cache {snapshot_id}:{path} in {p}")
+        return data
+
+    def put(self, snapshot_id: str, path: str, data: bytes):
+        if len(data) > self._max_entry_size:
+            log.debug(f"skipped caching large restic dump {path} of {len(data)} bytes")
+            return
+        p = self._path(snapshot_id, path)
+        token = self._cipher.encrypt(data)
+        with self._lock:
+            self._dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp = p.with_name(f"{p.name}.{os.getpid()}.tmp")
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(token)
+                os.replace(tmp, p)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for e in os.scandir(self._dir):
+            if e.name.endswith(self.SUFFIX):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            log.debug(f"evicting restic dump cache {path}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def tee(
+        self, snapshot_id: str, path: str, chunks: Iterable[bytes]
+    ) -> Iterator[bytes]:
+        """
+        返回chunks的同时收集内容，全部读取完成后写入缓存。超过max_entry_size时
+        不再收集
+        """
+        buf: Optional[bytearray] = bytearray()
+        for chunk in chunks:
+            if buf is not None:
+                buf += chunk
+                if len(buf) > self._max_entry_size:
+                    buf = None
+            yield chunk
+        if buf is not None:
+            self.put(snapshot_id, path, bytes(buf))
+
+
+def _write_private_json(path: Path, data: Any):
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _read_json(path: Path) -> Optional[Any]:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning(f"ignore invalid cache {path}: {e}")
+        return None
+
+
+class SnapshotCache:
+    """
+    保存在本地的restic仓库元数据，用于在本地查询snapshot与其中的文件：
+    * repos.json: 仓库参数 -> 仓库id，在base目录中
+    * snapshots.json: `restic snapshots --json`的结果，ttl秒内有效，只用于查找短id，
+      解析latest时总是重新查询
+    * tree-<snapshot id>.json: `restic ls --json`的文件列表 path -> [type, size, mtime]，
+      snapshot不会改变所以一直有效，不在snapshots中的会被删除
+    """
+
+    VERSION = 1
+
+    def __init__(self, dir: Path, ttl: float = 600) -> None:
+        self._dir = dir
+        self._ttl = ttl
+
+    @staticmethod
+    def base_dir(env: Dict[str, str] = None) -> Path:
+        env = os.environ if env is None else env
+        if v := env.get("DOTUTIL_CZ_RESTIC_META_DIR"):
+            return Path(v)
+        return user_cache_dir().joinpath("restic-meta")
+
+    @classmethod
+    def from_env(cls, env: Dict[str, str], repo_id: str) -> "SnapshotCache":
+        """
+        env DOTUTIL_CZ_RESTIC_META_DIR为缓存目录，DOTUTIL_CZ_RESTIC_SNAPSHOTS_TTL为
+        snapshots的有效秒数，默认600
+        """
+        ttl = float(env.get("DOTUTIL_CZ_RESTIC_SNAPSHOTS_TTL") or 600)
+        return cls(cls.base_dir(env).joinpath(repo_id), ttl=ttl)
+
+    @classmethod
+    def get_repo_id(cls, base_dir: Path, repo_key: str) -> Optional[str]:
+        data = _read_json(base_dir.joinpath("repos.json"))
+        return data.get(repo_key) if isinstance(data, dict) else None
+
+    @classmethod
+    def put_repo_id(cls, base_dir: Path, repo_key: str, repo_id: str):
+        path = base_dir.joinpath("repos.json")
+        data = _read_json(path)
+        data = data if isinstance(data, dict) else {}
+        data[repo_key] = repo_id
+        _write_private_json(path, data)
+
+    def snapshots(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        未过期的snapshots，不存在或过期时返回None
+        """
+        path = self._dir.joinpath("snapshots.json")
+        try:
+            if time.time() - path.stat().st_mtime > self._ttl:
+                log.debug(f"expired restic snapshots cache {path}")
+                return None
+        except FileNotFoundError:
+            return None
+        data = _read_json(path)
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return None
+        return data["snapshots"]
+
+    def put_snapshots(self, snapshots: List[Dict[str, Any]]):
+        _write_private_json(
+            self._dir.joinpath("snapshots.json"),
+            {"version": self.VERSION, "snapshots": snapshots},
+        )
+        # 删除已经不存在的snapshot的文件列表
+        ids = {s["id"] for s in snapshots}
+        for p in self._dir.glob("tree-*.json"):
+            if p.stem[len("tree-") :] not in ids:
+                log.debug(f"removing restic tree cache {p} of forgotten snapshot")
+                p.unlink(missing_ok=True)
+
+    def tree(self, snapshot_id: str) -> Optional[Dict[str, List[Any]]]:
+        data = _read_json(self._dir.joinpath(f"tree-{snapshot_id}.json"))
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return None
+        return data["entries"]
+
+    def put_tree(self, snapshot_id: str, entries: Dict[str, List[Any]]):
+        _write_private_json(
+            self._dir.joinpath(f"tree-{snapshot_id}.json"),
+            {"version": self.VERSION, "entries": entries},
+        )
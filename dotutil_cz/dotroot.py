@@ -1,24 +1,46 @@
 #!/usr/bin/env python3
+import fnmatch
+import hashlib
 import logging
+import mmap
 import os
 import re
+import stat
 import subprocess as sp
 import sys
 from pathlib import Path
 from shutil import which
-from typing import Iterable, Set
-
-import psutil
-
-from dotutil_cz import elevate
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from dotutil_cz import WINDOWS, elevate
+from dotutil_cz.cache import MappedManifest, ScanCache
+from dotutil_cz.plan import Plan, phase
+from dotutil_cz.preflight import Preflight, interactive
+from dotutil_cz.source_state import SourceStateIndex
+from dotutil_cz.state import StateStore
 from dotutil_cz.util import (
+    MAPPED_MANIFEST_NAME,
     ChezmoiArgs,
     SetupException,
+    apply_journal,
     config_log_cz,
+    digest_cache,
     elevate_copy_file,
+    elevate_copy_files,
+    elevate_manifest,
     has_changed,
-    has_changed_su,
+    has_changed_manifest,
+    ordered_map,
     paths2str,
+    source_state_index,
+    state_store,
+)
+from dotutil_cz.walk import (
+    Entry,
+    collapse_subtrees,
+    merge_sorted,
+    walk,
+    walk_subtrees,
 )
 
 """
@@ -45,12 +67,26 @@ from dotutil_cz.util import (
 log = logging.getLogger(__name__)
 
 
-def pre_sync_from_root(args: ChezmoiArgs):
+def pre_sync_from_root(
+    args: ChezmoiArgs,
+    workers: int = None,
+    plan: Optional[Plan] = None,
+    root: Path = Path(os.sep),
+):
+    """
+    比较/root与映射的.root文件，将/root中改变的文件复制回.root。
+
+    walk在当前线程中进行，比较在workers个线程中并发执行，复制与删除按walk顺序
+    在当前线程中执行。plan为dry run时只记录操作。root可以替换为其它目录，用于测试
+    """
     mapped_root_dir = args.mapped_root()
     target_paths = args.target_paths()
-    if target_paths and all(
-        mapped_root_dir not in p.parents and mapped_root_dir != p for p in target_paths
-    ):
+    subtrees = (
+        collapse_subtrees(mapped_root_dir, target_paths)
+        if target_paths
+        else [mapped_root_dir]
+    )
+    if not subtrees:
         log.debug(
             f"skipped copy root to {paths2str(mapped_root_dir)} for target paths: {paths2str(target_paths)}"
         )
@@ -61,56 +97,131 @@ def pre_sync_from_root(args: ChezmoiArgs):
     elif mapped_root_dir.is_file():
         raise SetupException(f"mapped root is not dir: {paths2str(mapped_root_dir)}")
 
-    log.info(f"syncing root to {paths2str(mapped_root_dir)} if changed")
-    count = 0
-    for path in mapped_root_dir.rglob("*"):
-        if path.is_file():
-            root_path = Path("/").joinpath(os.path.relpath(path, mapped_root_dir))
+    log.info(f"syncing root to {paths2str(subtrees)} if changed")
+
+    with phase(plan, "walk"):
+        files = [e for e in walk_subtrees(mapped_root_dir, subtrees) if e.is_file()]
+    root_paths = {e.path: root.joinpath(e.rel) for e in files}
+    with phase(plan, "elevate"):
+        private_manifest = private_root_manifest(root_paths)
+
+    def compare(entry: Entry):
+        path = entry.as_path()
+        root_path = root_paths[entry.path]
+
+        if root_path in private_manifest:
+            info = private_manifest[root_path]
+            if info is None:
+                return "remove", path, root_path
+            elif info["type"] != "file":
+                return "error", path, root_path
+            changed = has_changed_manifest(path, info)
+            return ("copy", path, root_path) if changed else None
+
+        try:
+            root_stat = root_path.stat()
+        # remove mapped root path if root path not exists
+        except (FileNotFoundError, NotADirectoryError):
+            return "remove", path, root_path
+        except PermissionError:
+            return "error", path, root_path
+
+        try:
+            changed = has_changed(
+                root_path, path, src_stat=root_stat, dst_stat=entry.stat()
+            )
+        except PermissionError:
+            return "error", path, root_path
+        return ("copy", path, root_path) if changed else None
 
-            privated_path = False
-            try:
-                root_path.exists()
-            except PermissionError:
-                log.debug(f"checking exists for private {str(root_path)}")
-                privated_path = True
-                privated_path_exists = (
-                    sp.run(["sudo", "test", "-e", root_path]).returncode == 0
-                )
+    with phase(plan, "compare"):
+        actions = [a for a in ordered_map(compare, files, workers) if a is not None]
 
-            # remove mapped root path if root path not exists
-            if (privated_path and not privated_path_exists) or (
-                not privated_path and not root_path.exists()
-            ):
+    count = 0
+    dry_run = plan is not None and plan.dry_run
+    with phase(plan, "copy"):
+        for op, path, root_path in actions:
+            if op == "remove":
                 log.info(
                     f"removing {paths2str(path)} for non exists {paths2str(root_path)}"
                 )
-                os.remove(path)
-                continue
-
-            changed = None
-            try:
-                changed = (
-                    has_changed(root_path, path)
-                    if not privated_path
-                    else has_changed_su(root_path, path)
-                )
-            except PermissionError:
+                if dry_run:
+                    plan.add("remove-mapped", path)
+                else:
+                    os.remove(path)
+            elif op == "error":
                 log.error(
                     f"skipped copying file {paths2str(path)} for permission error"
                 )
-            if changed:
+            elif op == "copy":
                 log.info(
                     f"copying changed file {paths2str(root_path)} -> {paths2str(path)}"
                 )
-                elevate_copy_file(root_path, path)
+                if dry_run:
+                    plan.add("copy-from-root", root_path, path)
+                else:
+                    elevate_copy_file(root_path, path)
                 count += 1
     log.info(f"found changed {count} files")
 
 
+PASSHOLE_TEMPLATE_PAT = re.compile(
+    rb'\{\{.*(passhole(\s+".+"){2})|(includeTemplate\s+"\s*restic-dump\s*"\s+).*\}\}'
+)
+PASSHOLE_SCAN_NAME = ".root.passhole-scan.json"
+# 超过该大小的文件使用mmap扫描，避免一次读入内存
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def search_file(path: Path, pat: "re.Pattern[bytes]") -> Tuple[os.stat_result, bool]:
+    """
+    在整个文件内容中查找pat，返回查找时文件的stat与是否找到
+    """
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return st, False
+        elif st.st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return st, pat.search(m) is not None
+        return st, pat.search(f.read()) is not None
+
+
+def find_template(
+    paths: Iterable[Path],
+    pat: "re.Pattern[bytes]",
+    cache: Optional[ScanCache] = None,
+    workers: Optional[int] = None,
+) -> Optional[Path]:
+    """
+    在线程池中扫描paths，返回按paths顺序第一个包含pat的文件。
+    cache中文件的size与mtime未改变时使用上次扫描的结果
+    """
+
+    def scan(path: Path) -> bool:
+        try:
+            if cache is not None:
+                if (found := cache.get(path, os.stat(path))) is not None:
+                    return found
+            st, found = search_file(path, pat)
+        except OSError as e:
+            log.info(f"skipped check template for {paths2str(path)}: {e}")
+            return False
+        if cache is not None:
+            cache.put(path, st, found)
+        return found
+
+    paths = list(paths)
+    for path, found in zip(paths, ordered_map(scan, paths, workers=workers)):
+        if found:
+            return path
+    return None
+
+
 def check_passhole(cz: ChezmoiArgs):
     if cz.data()["has_keepass"] is not True:
         return
-    elif not psutil.WINDOWS:
+    elif not WINDOWS:
         p = cz.home_dir().joinpath(".config/passhole.ini")
         # # allow this `chezmoi apply ~/.config/passhole.ini` pass
         if (
@@ -127,20 +238,15 @@ def check_passhole(cz: ChezmoiArgs):
     has_ph = False
     if cz.target_paths():
         # filtered if src path is none
-        src_paths = [
-            p for p in map(lambda p: cz.get_source_path(p), cz.target_paths()) if p
-        ]
+        src_paths = [p for p in cz.get_source_paths(cz.target_paths()).values() if p]
         log.debug(f"finding passhole template in {paths2str(src_paths)}")
 
         if src_paths:
-            pat = re.compile(
-                r'\{\{.*(passhole(\s+".+"){2})|(includeTemplate\s+"\s*restic-dump\s*"\s+).*\}\}'
-            )
             paths = set()
             # find all files
             for path in src_paths:
                 if path.is_dir():
-                    paths.update(p for p in path.rglob("*") if p.is_file())
+                    paths.update(e.as_path() for e in walk(path) if e.is_file())
                 elif path.exists():
                     # cz diff -v ~/.local/bin/gitea
                     # /home/navyd/.local/share/chezmoi/dot_local/bin/create_executable_: No such file or directory (os error 2)
@@ -148,30 +254,26 @@ def check_passhole(cz: ChezmoiArgs):
                     paths.add(path)
 
             # find one file if contains ph
-            for path in paths:
-                if path.suffix == ".tmpl":
-                    try:
-                        with open(path, encoding="utf8") as file:
-                            for line in file:
-                                if pat.search(line):
-                                    has_ph = True
-                                    log.info(
-                                        f"found passhole template in {paths2str(path)}"
-                                    )
-                                    break
-                        if has_ph:
-                            break
-                    except UnicodeDecodeError:
-                        log.info(
-                            f"skipped check passhole for non-text {paths2str(path)}"
-                        )
-                        continue
+            cache = None
+            if v := os.environ.get("CHEZMOI_CACHE_DIR"):
+                cache = ScanCache(
+                    Path(v).joinpath(PASSHOLE_SCAN_NAME),
+                    hashlib.sha256(PASSHOLE_TEMPLATE_PAT.pattern).hexdigest(),
+                )
+            try:
+                templates = sorted(p for p in paths if p.suffix == ".tmpl")
+                if path := find_template(templates, PASSHOLE_TEMPLATE_PAT, cache):
+                    has_ph = True
+                    log.info(f"found passhole template in {paths2str(path)}")
+            finally:
+                if cache is not None:
+                    cache.save()
     else:
         has_ph = True
 
     if has_ph:
         args = []
-        if psutil.WINDOWS:
+        if WINDOWS:
             if bin := which("wsl.exe"):
                 args = [bin, "--", "ph", "list"]
             else:
@@ -186,7 +288,9 @@ def check_passhole(cz: ChezmoiArgs):
             f"{paths2str(cz.target_paths() or ['~'])}"
         )
         # 用户ctrl+c终止后retcode=0但无输出
-        if not sp.check_output(args, encoding="utf8").strip():
+        with interactive():
+            out = sp.check_output(args, encoding="utf8")
+        if not out.strip():
             log.error(f"failed to check passhole with {args}")
             raise SetupException("no passhole output found")
 
@@ -198,21 +302,18 @@ def check_super_permission(cz: ChezmoiArgs):
     ):
         return
 
-    args = []
-    if psutil.WINDOWS:
-        # -p | --pid {pid} Specify which process can use the cache. (Use 0 for any, Default=caller pid)
-        # https://gerardog.github.io/gsudo/docs/credentials-cache#usage
-        args = [elevate.gsudo_path, "cache", "on", "-p", "0"]
-    elif psutil.POSIX:
-        args = [elevate.sudo_path, "echo"]
-    else:
-        raise SetupException("unsupported os")
+    b = elevate.backend()
+    args = b.check_args()
+    if args is None:
+        log.debug(f"skipped checking super permission with {b}")
+        return
 
     log.info(
         f"checking super permission with {args} "
         f"for {paths2str(target_paths) or '~'}"
     )
-    p = sp.run(args, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    with interactive():
+        p = sp.run(args, stdout=sp.DEVNULL, stderr=sp.PIPE)
     if p.returncode != 0:
         log.error(f"failed to check permission exited {p} with {args}")
         p.check_returncode()
@@ -226,10 +327,9 @@ def check_wsl(args: ChezmoiArgs):
     if data["has_systemd"] is False or not p.exists():
         # allow this `chezmoi apply ~/.root/etc/wsl.conf` pass
         if p not in args.target_paths() and len(args.target_paths()) != 1:
-            print(
+            raise SetupException(
                 f"found uninit wsl2 configuration {str(p)}. please run `chezmoi apply {str(p)}` to enable and reboot then reinit `chezmoi init`"
             )
-            exit(1)
         elif not p.parent.exists():
             # fix: stat .root/etc not exists
             p.parent.mkdir(parents=True)
@@ -245,10 +345,9 @@ def check_restic(args: ChezmoiArgs):
             and len(args.target_paths()) != 1
             and p not in args.target_paths()
         ):
-            print(
+            raise SetupException(
                 f"not found restic bin in {paths2str(p)}. please run `chezmoi apply {paths2str(p)}` at first"
             )
-            exit(1)
 
 
 def print_env():
@@ -259,20 +358,28 @@ def print_env():
 def pre_run():
     cz = ChezmoiArgs()
     config_log_cz(cz=cz)
-
     try:
-        check_passhole(cz)
-        check_super_permission(cz)
-        check_wsl(cz)
-        check_restic(cz)
-
-        pre_sync_from_root(cz)
+        plan = Plan.from_env()
+        # 检查之间相互独立，并发执行，需要用户输入的步骤按顺序执行
+        with phase(plan, "check"):
+            Preflight(
+                [
+                    ("passhole", lambda: check_passhole(cz)),
+                    ("super_permission", lambda: check_super_permission(cz)),
+                    ("wsl", lambda: check_wsl(cz)),
+                    ("restic", lambda: check_restic(cz)),
+                ]
+            ).run()
+
+        pre_sync_from_root(cz, plan=plan)
     except KeyboardInterrupt:
         print("Interrupt by user", file=sys.stderr)
         exit(1)
     except SetupException as e:
         print(f"{e}", file=sys.stderr)
         exit(2)
+    if plan is not None:
+        print(plan.report())
 
 
 """
@@ -280,93 +387,343 @@ def pre_run():
 """
 
 
-def get_root_path(mapped_path, mapped_root) -> Path:
-    return Path("/").joinpath(os.path.relpath(mapped_path, mapped_root)).absolute()
+def get_root_path(mapped_path, mapped_root, root: Path = Path(os.sep)) -> Path:
+    return root.joinpath(os.path.relpath(mapped_path, mapped_root)).absolute()
 
 
-def copy_to_root(mapped_root: Path):
-    diff_count = 0
+def private_root_manifest(
+    root_paths: Dict[str, Path],
+    need_digest: Callable[[Path, Dict[str, Any]], bool] = None,
+) -> Dict[Path, Optional[Dict[str, Any]]]:
+    """
+    找到当前用户无法访问的root paths，并通过一次提权请求获取它们的manifest，
+    以代替每个文件多次sudo test/stat。
 
-    def elevate_copy(src: Path, dst: Path):
-        nonlocal diff_count
-        elevate_copy_file(src, dst)
-        diff_count += 1
+    root_paths为mapped path -> root path，同一个目录只检查一次是否可访问。
+    只对mode与大小都一致并且need_digest返回True的文件计算digest
+    """
+    private_dirs = {}
+    private_paths = {}
+    for path, root_path in root_paths.items():
+        parent = root_path.parent
+        if parent not in private_dirs:
+            try:
+                # 需要目录的x权限才能访问其中的文件
+                os.stat(os.path.join(parent, os.curdir))
+                private_dirs[parent] = False
+            except PermissionError:
+                private_dirs[parent] = True
+            except OSError:
+                private_dirs[parent] = False
+        if private_dirs[parent]:
+            private_paths[root_path] = path
+    if not private_paths:
+        return {}
+
+    def same_stat(root_path: Path, info: Dict[str, Any]) -> bool:
+        s = os.stat(private_paths[root_path])
+        return (
+            s.st_mode == info["mode"]
+            and s.st_size == info["size"]
+            and (need_digest is None or need_digest(root_path, info))
+        )
 
-    for path in mapped_root.rglob("*"):
-        if path.is_file() or path.is_symlink():
-            root_path = get_root_path(path, mapped_root)
+    log.debug(f"checking private {len(private_paths)} root paths with elevated worker")
+    return elevate_manifest(private_paths, need_digest=same_stat)
+
+
+def existing_root_paths(paths: Iterable[Path]) -> Set[Path]:
+    """
+    返回paths中存在的root paths(跟随symlink)，当前用户无法访问的通过一次提权请求检查
+    """
+    found, private = set(), []
+    for p in paths:
+        try:
+            os.stat(p)
+            found.add(p)
+        except PermissionError:
+            private.append(p)
+        except (OSError, ValueError):
+            pass
+    if private:
+        log.debug(f"checking private {len(private)} root paths with elevated worker")
+        manifest = elevate.worker().manifest(private)
+        found.update(p for p, info in zip(private, manifest) if info is not None)
+    return found
+
+
+def copy_to_root(
+    mapped_root: Path,
+    target_paths: Iterable[Path] = None,
+    workers: int = None,
+    journal: Optional[StateStore] = None,
+    full: bool = None,
+    plan: Optional[Plan] = None,
+    root: Path = Path(os.sep),
+):
+    """
+    将.root中改变的文件复制到/root中，与pre_sync_from_root一样并发比较，按顺序复制。
+    target_paths不为空时只处理其中在.root下的子树
+
+    journal默认为apply_journal()，映射文件与root文件在上次应用后都没有改变时跳过比较，
+    只需要stat。full为True时忽略journal比较所有文件，默认从env DOTUTIL_CZ_FULL_SYNC读取。
+    plan为dry run时只记录需要复制的文件，不会修改journal。root可以替换为其它目录，用于测试
+    """
+    dry_run = plan is not None and plan.dry_run
+    if journal is None:
+        journal = apply_journal(dry_run)
+    if full is None:
+        full = bool(os.environ.get("DOTUTIL_CZ_FULL_SYNC"))
+
+    subtrees = (
+        collapse_subtrees(mapped_root, target_paths) if target_paths else [mapped_root]
+    )
+    with phase(plan, "walk"):
+        files = [
+            e
+            for e in walk_subtrees(mapped_root, subtrees)
+            if e.is_file() or e.is_symlink()
+        ]
+    root_paths = {e.path: root.joinpath(e.rel) for e in files}
+    root_entries = {root_paths[e.path]: e for e in files}
+    cache = digest_cache()
+
+    def known_digest(*stats) -> Optional[str]:
+        # 只使用已经缓存的摘要，不为journal额外读取文件
+        if cache is not None:
+            for st in stats:
+                if (digest := cache.get(st)) is not None:
+                    return digest
+        return None
+
+    def journal_unchanged(entry: Entry, root_stat) -> bool:
+        if journal is None or full:
+            return False
+        return journal.unchanged(entry.rel, entry.stat(), root_stat)
+
+    with phase(plan, "elevate"):
+        private_manifest = private_root_manifest(
+            root_paths,
+            need_digest=lambda p, info: not journal_unchanged(root_entries[p], info),
+        )
 
+    def compare(entry: Entry):
+        path = entry.as_path()
+        root_path = root_paths[entry.path]
+
+        if root_path in private_manifest:
+            info = private_manifest[root_path]
+            if info is None:
+                return entry, root_path
+            elif info["type"] != "file":
+                raise SetupException(f"invalid file {paths2str(root_path)}")
+            elif journal_unchanged(entry, info):
+                return None
+            elif has_changed_manifest(path, info):
+                return entry, root_path
+            elif journal is not None and not dry_run:
+                journal.put(entry.rel, entry.stat(), info, info.get("digest"))
+            return None
+
+        try:
+            root_stat = root_path.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            return entry, root_path
+        if stat.S_ISREG(root_stat.st_mode):
+            if journal_unchanged(entry, root_stat):
+                return None
             try:
-                root_path.exists()
-            except PermissionError:
-                log.debug(f"checking exists for private {str(root_path)}")
-                privated_path_exists = (
-                    sp.run(["sudo", "test", "-e", root_path]).returncode == 0
+                changed = has_changed(
+                    path, root_path, src_stat=entry.stat(), dst_stat=root_stat
+                )
+            except PermissionError as e:
+                log.error(
+                    f"Checking for changes fails with permission issues on files {paths2str(path)} -> {paths2str(root_path)}: {e}"
                 )
-                privated_path_is_file = (
-                    sp.run(["sudo", "test", "-f", root_path]).returncode == 0
+                raise SetupException(e)
+            if changed:
+                return entry, root_path
+            elif journal is not None and not dry_run:
+                journal.put(
+                    entry.rel,
+                    entry.stat(),
+                    root_stat,
+                    known_digest(root_stat, entry.stat()),
                 )
-                if not privated_path_exists:
-                    elevate_copy(path, root_path)
-                elif privated_path_is_file:
-                    if has_changed_su(path, root_path):
-                        elevate_copy(path, root_path)
-                else:
-                    raise SetupException(f"invalid file {paths2str(root_path)}")
-                continue
-
-            if not root_path.exists():
-                elevate_copy(path, root_path)
-            elif root_path.is_file():
-                changed = None
-                try:
-                    changed = has_changed(path, root_path)
-                except PermissionError as e:
-                    log.error(
-                        f"Checking for changes fails with permission issues on files {paths2str(path)} -> {paths2str(root_path)}: {e}"
-                    )
-                    raise SetupException(e)
-                if changed:
-                    elevate_copy(path, root_path)
-            else:
-                raise SetupException(f"invalid file {paths2str(root_path)}")
-    log.info(f"copied {diff_count} files from {paths2str(mapped_root)}")
+            return None
+        else:
+            raise SetupException(f"invalid file {paths2str(root_path)}")
+
+    with phase(plan, "compare"):
+        copies = [a for a in ordered_map(compare, files, workers) if a is not None]
+    if dry_run:
+        for entry, root_path in copies:
+            plan.add("copy-to-root", entry.path, root_path)
+        return
+
+    with phase(plan, "copy"):
+        results = (
+            elevate_copy_files(
+                ((entry.as_path(), root_path) for entry, root_path in copies),
+                root=root,
+            )
+            if copies
+            else {}
+        )
+    failed = []
+    for entry, root_path in copies:
+        res = results.get(root_path, {"error": "not copied"})
+        if "error" in res:
+            log.error(f"failed to copy {paths2str(entry.path)}: {res['error']}")
+            failed.append(root_path)
+        elif journal is not None:
+            journal.put(
+                entry.rel, entry.stat(), res["stat"], known_digest(entry.stat())
+            )
+    log.info(f"copied {len(copies) - len(failed)} files from {paths2str(mapped_root)}")
+
+    if journal is not None:
+        journal.retain(
+            (e.rel for e in files),
+            scopes=[os.path.relpath(p, mapped_root) for p in subtrees],
+        )
+        journal.save()
+    if failed:
+        raise SetupException(f"failed to copy {len(failed)} files to root")
+
+
+def _list_names(path: Path) -> Set[str]:
+    # 与Path.glob一样忽略不存在或无法读取的目录
+    try:
+        with os.scandir(path) as it:
+            return {e.name for e in it}
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return set()
+
+
+def _lexists(path: Path) -> bool:
+    # 与os.path.lexists不同，无法访问的私有root文件由worker判断，视为存在
+    try:
+        os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RemovalPolicy:
+    """
+    删除root文件的策略，用于无人值守的运行，避免等待stdin。
+
+    never_under中的目录下的文件从不删除，其次匹配allow中的glob(fnmatch，*可以匹配/)
+    或在remove_under中的目录下的文件直接删除，都不匹配时使用default：
+    ask询问用户，skip跳过，remove删除
+    """
+
+    ASK = "ask"
+    SKIP = "skip"
+    REMOVE = "remove"
+
+    def __init__(
+        self,
+        allow: Iterable[str] = (),
+        remove_under: Iterable[Path] = (),
+        never_under: Iterable[Path] = (),
+        default: str = ASK,
+    ) -> None:
+        if default not in (self.ASK, self.SKIP, self.REMOVE):
+            raise SetupException(f"unsupported removal default {default}")
+        self.allow = list(allow)
+        self.remove_under = [Path(p) for p in remove_under]
+        self.never_under = [Path(p) for p in never_under]
+        self.default = default
+
+    @classmethod
+    def from_env(cls) -> "RemovalPolicy":
+        """
+        从env中读取，多个值使用os.pathsep分隔：
+        DOTUTIL_CZ_RM_ALLOW, DOTUTIL_CZ_RM_UNDER, DOTUTIL_CZ_RM_NEVER, DOTUTIL_CZ_RM_DEFAULT
+        """
+
+        def values(key: str):
+            return [v for v in os.environ.get(key, "").split(os.pathsep) if v]
+
+        return cls(
+            allow=values("DOTUTIL_CZ_RM_ALLOW"),
+            remove_under=values("DOTUTIL_CZ_RM_UNDER"),
+            never_under=values("DOTUTIL_CZ_RM_NEVER"),
+            default=os.environ.get("DOTUTIL_CZ_RM_DEFAULT") or cls.ASK,
+        )
+
+    def decide(self, path: Path) -> str:
+        def under(prefixes):
+            return any(path == p or p in path.parents for p in prefixes)
+
+        if under(self.never_under):
+            return self.SKIP
+        elif under(self.remove_under) or any(
+            fnmatch.fnmatchcase(str(path), pat) for pat in self.allow
+        ):
+            return self.REMOVE
+        return self.default
 
 
 class RootCleaner:
     def __init__(
-        self, mapped_root: Path, rootlist_path: Path, cz_bin, cz_src_path: Path
+        self,
+        mapped_root: Path,
+        rootlist_path: Path,
+        cz_bin,
+        cz_src_path: Path,
+        source_index: Optional[SourceStateIndex] = None,
+        manifest: Optional[MappedManifest] = None,
+        state: Optional[StateStore] = None,
+        policy: Optional[RemovalPolicy] = None,
+        root: Path = Path(os.sep),
     ) -> None:
         self.log = logging.getLogger(__name__)
         self._rootlist_path = rootlist_path
         self._mapped_root = mapped_root
+        # 映射的root目录，可以替换为其它目录用于测试
+        self._root = root
         self._cz_bin = cz_bin
         self._exact_pat = re.compile(r"^(\w+_)*exact_.+")
         self._cz_src_path = cz_src_path
-
-        # rootlist仅保存上次跳过删除的文件
-        old_removable_mapped_paths = (
-            set(
-                Path(line)
-                for line in self._rootlist_path.read_text().splitlines()
-                if line.strip()
-            )
-            if self._rootlist_path.is_file()
-            else set()
+        # 延迟到第一次is_exact时加载
+        self._source_index = source_index
+        self._manifest = manifest or MappedManifest(
+            rootlist_path.with_name(MAPPED_MANIFEST_NAME)
         )
+
+        # 状态存储与rootlist在同一个目录中，第一次使用时会导入旧的rootlist文件
+        self._state = state if state is not None else state_store(rootlist_path.parent)
+        self._policy = policy or RemovalPolicy.from_env()
+        # 仅保存上次跳过删除的文件
+        old_removable_mapped_paths = self._state.skipped()
         self.log.debug(
             f"loaded removable mapped root {len(old_removable_mapped_paths)} paths: {paths2str(old_removable_mapped_paths)}"
         )
         self._old_removable_mapped_paths = old_removable_mapped_paths
 
-    def clean(self, target_paths: Iterable[Path]):
+    def clean(self, target_paths: Iterable[Path], plan: Optional[Plan] = None):
+        """
+        删除在.root中已经不存在的root文件。plan为dry run时只记录将要删除的文件
+        """
+        dry_run = plan is not None and plan.dry_run
         # get removed root paths
-        removable_paths = self.find_removable_mapped_paths(target_paths)
-        root_paths = set()
-        for path in removable_paths:
-            if rp := get_root_path(path, self._mapped_root):
-                if rp.exists():
-                    root_paths.add(rp)
+        with phase(plan, "clean"):
+            removable_paths = self.find_removable_mapped_paths(
+                target_paths, dry_run=dry_run
+            )
+            root_paths = existing_root_paths(
+                get_root_path(path, self._mapped_root, self._root)
+                for path in removable_paths
+            )
+        if dry_run:
+            for rp in sorted(root_paths):
+                plan.add("remove-root", rp)
+            return
 
         # remove paths
         self.log.info(
@@ -384,48 +741,100 @@ class RootCleaner:
         rest_paths.update(
             self._old_removable_mapped_paths - removed_mapped_root_paths  # noqa: W504
         )
+        rest_root_paths = {
+            get_root_path(p, self._mapped_root, self._root): p for p in rest_paths
+        }
         rest_paths = set(
-            p for p in rest_paths if get_root_path(p, self._mapped_root).exists()
+            rest_root_paths[rp] for rp in existing_root_paths(rest_root_paths)
         )
 
-        # save current root list and skipped for next apply
+        # save skipped for next apply, only update changed rows
         self.log.debug(
-            f"saving rest {len(rest_paths)} paths to {self._rootlist_path} after apply"
+            f"saving rest {len(rest_paths)} paths to {self._rootlist_path.parent} after apply"
         )
-        with open(self._rootlist_path, "w") as f:
-            for path in rest_paths:
-                f.write(f"{str(path)}\n")
+        self._state.remove_skipped(self._old_removable_mapped_paths - rest_paths)
+        self._state.add_skipped(rest_paths - self._old_removable_mapped_paths)
+        self._state.save()
+        # 跳过删除的文件已经保存，下次不会丢失
+        self._manifest.commit()
 
     def root_target_path(self, root_path: Path) -> Path:
-        return self._mapped_root.joinpath(str(root_path).lstrip(os.sep))
+        return self._mapped_root.joinpath(os.path.relpath(root_path, self._root))
 
-    def find_removable_mapped_paths(self, target_paths: Iterable[Path]) -> Set[Path]:
+    def find_removable_mapped_paths(
+        self, target_paths: Iterable[Path], dry_run=False
+    ) -> Set[Path]:
+        """
+        找到在.root中已经被删除的映射文件：将当前的映射目录与上次apply的清单按顺序
+        合并，只在旧清单中存在的文件就是被删除的。新的清单写入临时文件，
+        在clean完成后才会提交。dry_run为True时只合并不写入新的清单
+        """
         self.log.info(
             f"finding all removable paths for target paths {paths2str(target_paths)} in old mapped {len(self._old_removable_mapped_paths)} paths"
         )
 
-        target_mapped_paths = None
-        if target_paths:
-            target_mapped_paths = set(
-                p for path in target_paths for p in path.rglob("*")
-            )
-        else:
-            target_mapped_paths = set(p for p in self._mapped_root.rglob("*"))
-
-        target_mapped_paths.update(self._old_removable_mapped_paths)
-
         exact_paths = {}
         removable_paths = set()
-        # 找到在target不存在并找出exact目录
-        for path in target_mapped_paths:
-            pp = path.parent
-            if pp not in exact_paths:
-                exact_paths[pp] = self.is_exact(pp)
+        # 已经遍历过的目录中的文件名，exact目录不需要再scandir
+        listed_names: Dict[Path, Set[str]] = {}
+
+        def check_exact(path: Path):
+            if path not in exact_paths:
+                exact_paths[path] = self.is_exact(path)
+
+        subtrees = (
+            collapse_subtrees(self._mapped_root, target_paths)
+            if target_paths
+            else [self._mapped_root]
+        )
+        if subtrees == [self._mapped_root]:
+            listed_names[self._mapped_root] = set()
+        scopes = [os.path.relpath(p, self._mapped_root) for p in subtrees]
 
+        def in_scopes(rel: str) -> bool:
+            return any(
+                s == os.curdir or rel == s or rel.startswith(s + os.sep) for s in scopes
+            )
+
+        # walk返回的path都是存在的
+        def current_entries():
+            for entry in walk_subtrees(self._mapped_root, subtrees):
+                path = entry.as_path()
+                if (names := listed_names.get(path.parent)) is not None:
+                    names.add(entry.name)
+                check_exact(path.parent)
+                if entry.is_dir():
+                    listed_names[path] = set()
+                    check_exact(path)
+                    yield entry.rel, "d"
+                else:
+                    yield entry.rel, "f"
+
+        def merged_entries():
+            for rel, old, new in merge_sorted(self._manifest.read(), current_entries()):
+                if new is not None:
+                    yield rel, new
+                elif not in_scopes(rel):
+                    # 不在本次target中的保留
+                    yield rel, old
+                elif old != "d":
+                    # 目录对应的root目录中可能存在其它文件，只删除其中被删除的文件
+                    removable_paths.add(self._mapped_root.joinpath(rel))
+
+        if dry_run:
+            count = sum(1 for _ in merged_entries())
+        else:
+            count = self._manifest.write(merged_entries())
+        self.log.debug(
+            f"found removable {len(removable_paths)} paths in {count} mapped paths for removed files: {paths2str(removable_paths)}"
+        )
+
+        for path in self._old_removable_mapped_paths:
+            check_exact(path.parent)
             if not path.exists():
                 removable_paths.add(path)
-            elif path.is_dir() and path not in exact_paths:
-                exact_paths[path] = self.is_exact(path)
+            elif path.is_dir():
+                check_exact(path)
         self.log.debug(
             f"found removable {len(removable_paths)} paths for non exist files: {paths2str(removable_paths)}"
         )
@@ -433,12 +842,14 @@ class RootCleaner:
         # 对于exact目录找到对应root中多余存在的文件
         for path in exact_paths:
             if exact_paths[path]:
-                mapped_root_files = {p for p in path.glob("*")}
-                virtual_mapped_root_files = {
-                    self.root_target_path(p)
-                    for p in get_root_path(path, self._mapped_root).glob("*")
-                }
-                paths = virtual_mapped_root_files - mapped_root_files
+                mapped_names = listed_names.get(path)
+                if mapped_names is None:
+                    mapped_names = _list_names(path)
+                names = (
+                    _list_names(get_root_path(path, self._mapped_root, self._root))
+                    - mapped_names
+                )
+                paths = {path.joinpath(name) for name in names}
                 self.log.debug(
                     f"found removable {len(paths)} paths for mapped exact {paths2str(path)}: {paths2str(paths)}"
                 )
@@ -446,37 +857,28 @@ class RootCleaner:
 
         return removable_paths
 
+    def source_index(self) -> SourceStateIndex:
+        if self._source_index is None:
+            self._source_index = source_state_index(self._cz_src_path)
+            self.log.debug(
+                f"loaded source state index with {len(self._source_index)} entries for {self._cz_src_path}"
+            )
+        return self._source_index
+
     def is_exact(self, path: Path) -> bool:
         """
         检查path所在的目录是否包含exact属性。
-        首先使用glob在cz源码目录中检查是否存在相应目录，如果存在1个目录则检查，以避免使用命令
-        不存在则使用cz source-path命令查找
+        首先从源码目录的索引中查找，不存在时使用cz source-path命令查找
         """
         # include mapped root self:
         # ~/.root relative_to mappedroot:~/.root => .
         # ~/.root relative_to mappedroot:~ => .root
         relp = path.relative_to(self._mapped_root.parent)
-        glob_pat = ""
-        for name in relp.parts:
-            s = "*"
-            # Source state attribute: https://www.chezmoi.io/reference/source-state-attributes/
-            # only replace first dot
-            if name.startswith("."):
-                s += f"dot_{name[1:]}"
-            else:
-                s += name
-            glob_pat += f"{s}{os.sep}"
-        self.log.debug(
-            f"finding recursive {self._cz_src_path} with "
-            f"glob pat {glob_pat} for relative {relp} in {path}"
-        )
-        # no relative path: . => empty
-        glob_paths = [p for p in self._cz_src_path.rglob(glob_pat)] if glob_pat else []
-        self.log.debug(
-            f"checking if {len(glob_paths)} paths {paths2str(glob_paths)} is exact for {path}"
-        )
-        if len(glob_paths) == 1:
-            return self._exact_pat.match(glob_paths[0].name) is not None
+        # 目标目录本身对应源码目录，不可能是exact
+        if relp == Path(os.curdir):
+            return False
+        if (entry := self.source_index().get(str(relp))) is not None:
+            return entry.is_exact()
 
         args = [self._cz_bin, "source-path", path]
         self.log.debug(f"checking if {path} is exact with {args}")
@@ -496,64 +898,108 @@ class RootCleaner:
             return False
 
     def confirm_rm(self, paths: Set[Path]) -> Set[Path]:
-        removed_paths = set()
+        """
+        按策略或询问用户确定需要删除的文件，然后在一次提权请求中删除
+        """
+        approved = []
 
         if paths:
             print(f"WARN: preparing to remove root {len(paths)} files")
 
+            asked = 0
             try:
                 remove_all = False
-                for path in paths:
-                    skipped = False
-                    if not remove_all:
-                        while True:
-                            print(
-                                f"whether to remove root file {paths2str(path)}?[remove, all-remove, skip]:",
-                                end="",
-                                flush=True,
-                            )
-                            line = sys.stdin.readline().strip()
-                            if "remove".startswith(line):
-                                pass
-                            elif "all-remove".startswith(line):
-                                remove_all = True
-                            elif "skip".startswith(line):
-                                skipped = True
-                            else:
-                                print(f"unkown option: {line}")
-                                continue
-                            break
-
-                    if not skipped:
-                        try:
-                            self.elevate_rm(path)
-                            removed_paths.add(path)
-                        # skipped if failed to remove
-                        except sp.CalledProcessError as e:
-                            self.log.error(
-                                f"failed to remove {paths2str(path)}: returncode={e.returncode}"
-                            )
-                        except SetupException:
-                            pass
+                for path in sorted(paths):
+                    decision = self._policy.decide(path)
+                    if decision == RemovalPolicy.ASK and remove_all:
+                        decision = RemovalPolicy.REMOVE
+                    while decision == RemovalPolicy.ASK:
+                        print(
+                            f"whether to remove root file {paths2str(path)}?[remove, all-remove, skip]:",
+                            end="",
+                            flush=True,
+                        )
+                        line = sys.stdin.readline().strip()
+                        if "remove".startswith(line):
+                            decision = RemovalPolicy.REMOVE
+                        elif "all-remove".startswith(line):
+                            remove_all = True
+                            decision = RemovalPolicy.REMOVE
+                        elif "skip".startswith(line):
+                            decision = RemovalPolicy.SKIP
+                        else:
+                            print(f"unkown option: {line}")
+
+                    asked += 1
+                    if decision == RemovalPolicy.REMOVE:
+                        approved.append(path)
                     else:
                         self.log.info(f"skipped remove {paths2str(path)}")
             except KeyboardInterrupt:
                 self.log.warning(
-                    f"skipping removable {len(paths) - len(removed_paths)} for Interrupt"
+                    f"skipping removable {len(paths) - asked} for Interrupt"
                 )
 
+        return self.elevate_rm(approved) if approved else set()
+
+    def elevate_rm(self, paths: Iterable[Path]) -> Set[Path]:
+        """
+        通过一次提权请求删除所有paths，返回已经删除或不存在的paths
+        """
+        removed_paths = set()
+        valid_paths = []
+        for path in paths:
+            if path == Path(os.sep) or path == self._root:
+                self.log.error(f"invalid path {paths2str(path)}")
+            elif not _lexists(path):
+                self.log.warning(f"ignore not found root file {paths2str(path)}")
+                removed_paths.add(path)
+            else:
+                valid_paths.append(path)
+        if not valid_paths:
+            return removed_paths
+
+        self.log.info(
+            f"removing {len(valid_paths)} paths with elevated worker: {paths2str(valid_paths)}"
+        )
+        try:
+            results = elevate.worker().removes(valid_paths)
+        # skipped if failed to remove
+        except elevate.ElevateWorkerError as e:
+            self.log.error(f"failed to remove {len(valid_paths)} paths: {e}")
+            return removed_paths
+        for path, result in zip(valid_paths, results):
+            if "error" in result:
+                self.log.error(f"failed to remove {paths2str(path)}: {result['error']}")
+            else:
+                removed_paths.add(path)
         return removed_paths
 
-    def elevate_rm(self, path: Path):
-        if not path.exists():
-            self.log.warning(f"ignore not found root file {paths2str(path)}")
-            return
-        elif path == Path(os.sep):
-            raise SetupException(f"invalid path {paths2str(path)}")
 
-        if psutil.WINDOWS:
-            cmd = ["gsudo", "del", str(path)]
-        else:
-            cmd = ["sudo", "rm", "-rf", str(path)]
-        self.log.info(f"removing {paths2str(path)} with command: {cmd}")
-        sp.check_call(cmd)
+def post_run():
+    """
+    在chezmoi apply后将.root复制到/root中并清理已经删除的文件
+    """
+    cz = ChezmoiArgs()
+    config_log_cz(cz=cz)
+    try:
+        plan = Plan.from_env()
+        mapped_root = cz.mapped_root()
+        if mapped_root.is_dir():
+            copy_to_root(mapped_root, cz.target_paths(), plan=plan)
+            root_list = cz.root_list()
+            # dry run不会导入旧的rootlist或修改状态
+            state = state_store(
+                root_list.parent, dry_run=plan is not None and plan.dry_run
+            )
+            RootCleaner(
+                mapped_root, root_list, cz.bin_path(), cz.source_dir(), state=state
+            ).clean(cz.target_paths(), plan=plan)
+    except KeyboardInterrupt:
+        print("Interrupt by user", file=sys.stderr)
+        exit(1)
+    except SetupException as e:
+        print(f"{e}", file=sys.stderr)
+        exit(2)
+    if plan is not None:
+        print(plan.report())
@@ -1,45 +1,124 @@
+import atexit
+import errno
+import json
 import logging
 import os
 import shutil
+import stat
+import struct
 import subprocess as sp
 import sys
+import threading
+from io import BytesIO
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Iterable, List, Optional, Union
 
-import psutil
-
-from dotutil_cz import SetupException
+from dotutil_cz import POSIX, WINDOWS, SetupException
 
 log = logging.getLogger(__name__)
-gsudo_path = shutil.which("gsudo.exe")
-sudo_path = shutil.which("sudo")
 
 
 class ElevateExcetion(SetupException):
     pass
 
 
-def _gen_elevate_py_args(codestr: str, non_interactive=False):
+class ElevateWorkerError(ElevateExcetion):
+    """
+    worker进程中执行请求失败时抛出，保留原始异常类型名与errno
+    """
+
+    def __init__(self, msg: str, type_name: str = None, errno: int = None) -> None:
+        super().__init__(msg)
+        self.type_name = type_name
+        self.errno = errno
+
+
+class ElevateBackend:
+    """
+    提权运行命令的方式。in_process为True时当前进程已经有权限，worker的操作
+    直接在当前进程中执行，不需要启动任何提权子进程
+    """
+
+    name = ""
+    in_process = False
+
+    def wrap(self, args: List[str], keep_env=False, non_interactive=False) -> List[str]:
+        """
+        返回提权运行args的命令。keep_env为True时保留当前的环境变量
+        """
+        raise NotImplementedError
+
+    def py_args(self, codestr: str, non_interactive=False) -> List[str]:
+        return self.wrap(
+            [sys.executable, "-c", codestr], non_interactive=non_interactive
+        )
+
+    def check_args(self) -> Optional[List[str]]:
+        """
+        预先授权并缓存凭据的命令，如提前输入sudo密码，不需要时为None
+        """
+        return None
+
+    def worker(self) -> "Worker":
+        return ElevatedWorker(self) if not self.in_process else InProcessWorker()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class SudoBackend(ElevateBackend):
+    name = "sudo"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def wrap(self, args, keep_env=False, non_interactive=False):
+        return (
+            [self.path]
+            + (["-n"] if non_interactive else [])
+            + (["-E"] if keep_env else [])
+            + list(args)
+        )
+
+    def check_args(self):
+        return [self.path, "echo"]
+
+
+class DoasBackend(ElevateBackend):
+    """
+    doas没有-E，是否保留环境变量由doas.conf中的keepenv决定
+    """
+
+    name = "doas"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def wrap(self, args, keep_env=False, non_interactive=False):
+        return [self.path] + (["-n"] if non_interactive else []) + list(args)
+
+    def check_args(self):
+        return [self.path, "true"]
+
+
+class GsudoBackend(ElevateBackend):
     """
     在windows平台使用[gsudo](https://github.com/gerardog/gsudo)提权运行，
     默认可能与unix sudo不一样，最明显是cache是默认相关调用者进程的，每次父进程
     退出后调用gsudo都会重新授权，可以使用`gsudo cache on -p 0`取消限制
     参考：https://gerardog.github.io/gsudo/docs/credentials-cache#usage
     """
-    args = []
-    if psutil.POSIX:
-        if not sudo_path:
-            raise ElevateExcetion("not found sudo")
-        args += [sudo_path]
-        if non_interactive is True:
-            args += ["-n"]
-        args += [sys.executable, "-c", codestr]
-    elif psutil.WINDOWS:
-        if not gsudo_path:
-            raise ElevateExcetion("not found gsudo.exe")
 
+    name = "gsudo"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def wrap(self, args, keep_env=False, non_interactive=False):
         if non_interactive is True:
-            st_args = [gsudo_path, "status"]
+            st_args = [self.path, "status"]
             log.debug(f"checking if gsudo is non interactive by {st_args}")
-            s = sp.check_output([gsudo_path, "status"], text=True)
+            s = sp.check_output(st_args, text=True)
             has_elevated = "Available for this process: True" in s
             log.debug(
                 f"found gsudo evaluated={has_elevated} from {st_args} output: {s}"
@@ -47,25 +126,571 @@ def _gen_elevate_py_args(codestr: str, non_interactive=False):
             if not has_elevated:
                 raise ElevateExcetion("unelevate with non_interactive for gsudo")
         #  -d | --direct: Skip Shell detection. Assume CMD shell or CMD {command}.
-        args += [gsudo_path, "-d", sys.executable, "-c", codestr]
-    else:
-        raise ElevateExcetion(f"unsupported os {os.name}")
-    return args
+        return [self.path, "-d"] + list(args)
+
+    def check_args(self):
+        # -p | --pid {pid} Specify which process can use the cache. (Use 0 for any, Default=caller pid)
+        return [self.path, "cache", "on", "-p", "0"]
+
+
+class DirectBackend(ElevateBackend):
+    """
+    当前进程已经是root或管理员，如在容器或系统初始化镜像中运行
+    """
+
+    name = "direct"
+    in_process = True
+
+    def wrap(self, args, keep_env=False, non_interactive=False):
+        return list(args)
+
+
+class FakeBackend(ElevateBackend):
+    """
+    不提权，以当前用户运行worker子进程，用于测试与benchmark
+    """
+
+    name = "fake"
+
+    def wrap(self, args, keep_env=False, non_interactive=False):
+        return list(args)
+
+
+def _is_privileged() -> bool:
+    if POSIX:
+        return os.geteuid() == 0
+    elif WINDOWS:
+        import ctypes
+
+        try:
+            return bool(ctypes.windll.shell32.IsUserAnAdmin())
+        except (AttributeError, OSError):
+            return False
+    return False
+
+
+def _which_backend(name: str) -> ElevateBackend:
+    if name in ("direct", "fake"):
+        return DirectBackend() if name == "direct" else FakeBackend()
+    classes = {"sudo": SudoBackend, "doas": DoasBackend, "gsudo": GsudoBackend}
+    if name not in classes:
+        raise ElevateExcetion(f"unsupported elevate backend {name}")
+    path = shutil.which(f"{name}.exe" if name == "gsudo" else name)
+    if not path:
+        raise ElevateExcetion(f"not found {name}")
+    return classes[name](path)
+
+
+def _select_backend() -> ElevateBackend:
+    """
+    env DOTUTIL_CZ_ELEVATE可以指定sudo、doas、gsudo、direct或fake，
+    默认在已有权限时直接运行，否则posix使用sudo或doas，windows使用gsudo
+    """
+    name = os.environ.get("DOTUTIL_CZ_ELEVATE", "").strip().lower()
+    if name:
+        return _which_backend(name)
+    if _is_privileged():
+        return DirectBackend()
+    if POSIX:
+        for name in ("sudo", "doas"):
+            if shutil.which(name):
+                return _which_backend(name)
+        raise ElevateExcetion("not found sudo or doas")
+    elif WINDOWS:
+        return _which_backend("gsudo")
+    raise ElevateExcetion(f"unsupported os {os.name}")
+
+
+_backend: Optional[ElevateBackend] = None
+_backend_lock = threading.Lock()
+
+
+def backend() -> ElevateBackend:
+    """
+    当前进程使用的提权方式，只在第一次调用时选择
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _select_backend()
+            log.debug(f"selected elevate backend {_backend}")
+        return _backend
+
+
+def set_backend(b: Optional[ElevateBackend]):
+    """
+    替换当前进程的提权方式并关闭已有的worker，为None时下次使用时重新选择
+    """
+    global _backend, _worker
+    with _backend_lock, _worker_lock:
+        _backend = b
+        w, _worker = _worker, None
+    if w is not None:
+        w.close()
 
 
 def py_popen(codestr: str, non_interactive=False, **proc_kwargs):
-    args = _gen_elevate_py_args(codestr, non_interactive=non_interactive)
+    args = backend().py_args(codestr, non_interactive=non_interactive)
     log.debug(f"elevate running {args}")
     return sp.Popen(args, **proc_kwargs)
 
 
 def py_run(codestr: str, non_interactive=False, **proc_kwargs) -> sp.CompletedProcess:
-    args = _gen_elevate_py_args(codestr, non_interactive=non_interactive)
+    args = backend().py_args(codestr, non_interactive=non_interactive)
     log.debug(f"elevate running {args}")
     return sp.run(args, **proc_kwargs)
 
 
 def py_check_output(codestr: str, non_interactive=False, **proc_kwargs):
-    args = _gen_elevate_py_args(codestr, non_interactive=non_interactive)
+    args = backend().py_args(codestr, non_interactive=non_interactive)
     log.debug(f"elevate running {args}")
     return sp.check_output(args, **proc_kwargs)
+
+
+_FRAME_HEADER = struct.Struct(">I")
+# 发送stream时缓冲从_MIN_CHUNK开始，每次读满后加倍直到_MAX_FRAME
+_MIN_CHUNK = 64 * 1024
+_MAX_FRAME = 8 * 1024 * 1024
+_PIPE_SIZE = 1024 * 1024
+
+
+def _grow_pipe(fd: int, size: int = _PIPE_SIZE) -> int:
+    """
+    尽量增大pipe的容量以减少splice与唤醒次数，返回pipe的容量
+    """
+    try:
+        import fcntl
+
+        try:
+            return fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+    except (ImportError, AttributeError, OSError):
+        return _MIN_CHUNK
+
+
+class Worker:
+    """
+    在有权限的环境中执行文件操作，操作的处理逻辑见`dotutil_cz.elevate_worker`
+    """
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def call(
+        self, op: str, _stream: IO[bytes] = None, _chunk_size: int = None, **kwargs
+    ) -> Any:
+        raise NotImplementedError
+
+    def extract(
+        self,
+        root: Union[str, Path],
+        write_tar: Callable[[IO[bytes]], None],
+        chunk_size=1024 * 64,
+    ) -> List[Dict[str, Any]]:
+        """
+        在一次请求中将write_tar写入的tar流解压到root中，每个文件先写入临时文件再
+        rename，已存在文件保留原owner。返回每个成员的结果：name与stat或error
+        """
+        raise NotImplementedError
+
+    def copy(self, src: Union[str, Path], dst: Union[str, Path]):
+        self.call("copy", src=str(src), dst=str(dst))
+
+    def hash(self, path: Union[str, Path]) -> str:
+        return self.call("hash", path=str(path))
+
+    def stat(
+        self, path: Union[str, Path], follow_symlinks=False
+    ) -> Optional[Dict[str, Any]]:
+        """
+        返回path的stat信息dict，不存在时返回None
+        """
+        return self.call("stat", path=str(path), follow_symlinks=follow_symlinks)
+
+    def manifest(
+        self, paths: Iterable[Union[str, Path]]
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        一次请求获取所有paths的stat(跟随symlink)，不存在的为None，
+        无法stat的type为error
+        """
+        return self.call("manifest", paths=[str(p) for p in paths])
+
+    def hashes(self, paths: Iterable[Union[str, Path]]) -> List[Optional[str]]:
+        """
+        一次请求计算所有paths的sha256，读取失败的为None
+        """
+        return self.call("hashes", paths=[str(p) for p in paths])
+
+    def exists(self, path: Union[str, Path]) -> bool:
+        return self.call("exists", path=str(path))
+
+    def mkdir(self, path: Union[str, Path]):
+        self.call("mkdir", path=str(path))
+
+    def remove(self, path: Union[str, Path]) -> bool:
+        return self.call("remove", path=str(path))
+
+    def removes(self, paths: Iterable[Union[str, Path]]) -> List[Dict[str, Any]]:
+        """
+        一次请求删除所有paths，返回每个path的结果：removed表示是否存在并删除，
+        失败时为error
+        """
+        return self.call("removes", paths=[str(p) for p in paths])
+
+    def write(
+        self,
+        path: Union[str, Path],
+        src: Union[IO[bytes], bytes],
+        chunk_size: Optional[int] = None,
+    ) -> int:
+        """
+        将src的内容写入path，返回写入的字节数。chunk_size为None时使用自适应的缓冲
+        """
+        return self.call("write", _stream=src, _chunk_size=chunk_size, path=str(path))
+
+    def writefile(self, path: Union[str, Path], src: Union[str, Path]) -> int:
+        """
+        由worker直接打开src并在内核中复制到path，数据不经过当前进程。
+        worker可以读取当前用户无法读取的文件，调用者需要先确认src可以读取
+        """
+        return self.call("write", path=str(path), src=str(src))
+
+
+class ElevatedWorker(Worker):
+    """
+    常驻的提权python进程，避免每次提权操作都启动一次`sudo python -c`。
+
+    进程在第一次请求时启动，之后的请求通过stdin/stdout帧协议完成，
+    协议与处理逻辑见`dotutil_cz.elevate_worker`
+    """
+
+    def __init__(
+        self, backend: Optional[ElevateBackend] = None, non_interactive=False
+    ) -> None:
+        self.log = logging.getLogger(__name__)
+        self._backend = backend
+        self._non_interactive = non_interactive
+        self._proc: Optional[sp.Popen] = None
+        self._lock = threading.RLock()
+
+    def start(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                return
+            codestr = Path(__file__).with_name("elevate_worker.py").read_text()
+            b = self._backend or backend()
+            args = b.py_args(codestr, non_interactive=self._non_interactive)
+            self.log.debug(f"starting elevated worker with {b}")
+            self._proc = sp.Popen(args, stdin=sp.PIPE, stdout=sp.PIPE, bufsize=0)
+            ready = self._read_resp()
+            if POSIX:
+                _grow_pipe(self._proc.stdin.fileno())
+            self.log.debug(f"started elevated worker process {self._proc.pid}: {ready}")
+
+    def close(self):
+        with self._lock:
+            if self._proc is None:
+                return
+            p, self._proc = self._proc, None
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+            try:
+                code = p.wait(timeout=10)
+            except sp.TimeoutExpired:
+                p.kill()
+                code = p.wait()
+            p.stdout.close()
+            self.log.debug(f"elevated worker process {p.pid} exited with code {code}")
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        try:
+            while view:
+                n = self._proc.stdin.write(view)
+                view = view[n:]
+        except BrokenPipeError as e:
+            raise ElevateExcetion(
+                f"elevated worker process {self._proc.pid} is not running"
+            ) from e
+
+    def _write_frame(self, data: bytes):
+        # 分开写入header与数据，避免大的数据帧再复制一次
+        self._write(_FRAME_HEADER.pack(len(data)))
+        if data:
+            self._write(data)
+
+    def _abort(self, msg: str):
+        """
+        数据帧无法补齐时结束worker进程，下次请求时重新启动
+        """
+        self._proc.kill()
+        self.close()
+        raise ElevateExcetion(msg)
+
+    def _send_stream(self, src: Union[IO[bytes], bytes], chunk_size: int = None):
+        """
+        将src的内容以数据帧发送并以空帧结束。bytes直接发送，普通文件使用sendfile、
+        pipe使用splice写入worker的stdin，其它stream使用自适应的缓冲读取
+        """
+        if isinstance(src, (bytes, bytearray, memoryview)):
+            view = memoryview(src)
+            for i in range(0, len(view), _MAX_FRAME):
+                self._write_frame(view[i : i + _MAX_FRAME])
+        else:
+            from dotutil_cz.elevate_worker import raw_fd
+
+            fd = raw_fd(src) if POSIX and chunk_size is None else None
+            if fd is not None:
+                mode = os.fstat(fd).st_mode
+                if stat.S_ISREG(mode) and hasattr(os, "sendfile"):
+                    self._sendfile(fd)
+                elif stat.S_ISFIFO(mode) and hasattr(os, "splice"):
+                    self._splice(fd)
+            # 发送内核复制后剩余的数据，如sendfile后追加的数据
+            self._send_buffered(src, chunk_size)
+        self._write_frame(b"")
+
+    def _sendfile(self, fd: int):
+        out = self._proc.stdin.fileno()
+        size = os.fstat(fd).st_size - os.lseek(fd, 0, os.SEEK_CUR)
+        use_sendfile = True
+        while size > 0:
+            n = min(size, _MAX_FRAME)
+            self._write(_FRAME_HEADER.pack(n))
+            left = n
+            while left:
+                if use_sendfile:
+                    try:
+                        sent = os.sendfile(out, fd, None, left)
+                    except OSError as e:
+                        if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                            raise
+                        use_sendfile = False
+                        continue
+                else:
+                    buf = os.read(fd, left)
+                    self._write(buf)
+                    sent = len(buf)
+                if not sent:
+                    self._abort(f"source file {fd} was truncated while sending")
+                left -= sent
+            size -= n
+            # 不支持sendfile时补齐当前帧后返回，剩余的数据由调用者读取发送
+            if not use_sendfile:
+                return
+
+    def _splice(self, fd: int):
+        out = self._proc.stdin.fileno()
+        r, w = os.pipe()
+        try:
+            size = _grow_pipe(w)
+            while True:
+                try:
+                    n = os.splice(fd, w, size)
+                except OSError as e:
+                    # 还没有写入帧时可以回退到读取
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    return
+                if not n:
+                    return
+                self._write(_FRAME_HEADER.pack(n))
+                while n:
+                    n -= os.splice(r, out, n)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def _send_buffered(self, src: IO[bytes], chunk_size: int = None):
+        size = chunk_size or _MIN_CHUNK
+        buf = bytearray(size)
+        readinto = getattr(src, "readinto", None)
+        while True:
+            if readinto is not None:
+                n = readinto(memoryview(buf)[:size]) or 0
+                data = memoryview(buf)[:n]
+            else:
+                data = src.read(size)
+                n = len(data)
+            if not n:
+                return
+            self._write_frame(data)
+            # 读满时加倍缓冲，大文件使用更少的帧与系统调用
+            if chunk_size is None and n == size and size < _MAX_FRAME:
+                size *= 2
+                buf = bytearray(size)
+
+    def _read_exact(self, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self._proc.stdout.read(size - len(buf))
+            if not chunk:
+                code = self._proc.wait()
+                raise ElevateExcetion(
+                    f"elevated worker process {self._proc.pid} exited with code {code}"
+                )
+            buf += chunk
+        return bytes(buf)
+
+    def _read_resp(self) -> Any:
+        (size,) = _FRAME_HEADER.unpack(self._read_exact(_FRAME_HEADER.size))
+        resp = json.loads(self._read_exact(size))
+        if not resp["ok"]:
+            raise ElevateWorkerError(
+                resp["error"], type_name=resp["type"], errno=resp["errno"]
+            )
+        return resp["result"]
+
+    def call(
+        self, op: str, _stream: IO[bytes] = None, _chunk_size: int = None, **kwargs
+    ) -> Any:
+        """
+        发送一个请求并等待响应。如果存在_stream则在请求后将其内容以数据帧发送
+        """
+        if _stream is not None:
+            kwargs["stream"] = True
+        req = json.dumps({"op": op, **kwargs}).encode()
+        with self._lock:
+            self.start()
+            self._write_frame(req)
+            if _stream is not None:
+                self._send_stream(_stream, _chunk_size)
+            return self._read_resp()
+
+    def extract(
+        self,
+        root: Union[str, Path],
+        write_tar: Callable[[IO[bytes]], None],
+        chunk_size=1024 * 64,
+    ) -> List[Dict[str, Any]]:
+        req = json.dumps({"op": "extract", "root": str(root), "stream": True}).encode()
+        with self._lock:
+            self.start()
+            self._write_frame(req)
+            try:
+                with _FrameWriter(self._write_frame, chunk_size) as w:
+                    write_tar(w)
+            except Exception:
+                # 读取worker的响应以保持帧协议同步
+                try:
+                    self._read_resp()
+                except ElevateWorkerError:
+                    pass
+                raise
+            return self._read_resp()
+
+
+class InProcessWorker(Worker):
+    """
+    当前进程已经有权限时直接调用`dotutil_cz.elevate_worker`中的操作，不启动子进程
+    """
+
+    def __init__(self) -> None:
+        from dotutil_cz import elevate_worker
+
+        self._ops = elevate_worker.OPS
+
+    def call(
+        self, op: str, _stream: IO[bytes] = None, _chunk_size: int = None, **kwargs
+    ) -> Any:
+        if isinstance(_stream, (bytes, bytearray, memoryview)):
+            _stream = BytesIO(_stream)
+        fn = self._ops.get(op)
+        if fn is None:
+            raise ElevateWorkerError(f"unknown op {op}", type_name="ValueError")
+        try:
+            return fn({"op": op, **kwargs}, _stream)
+        except Exception as e:
+            raise ElevateWorkerError(
+                str(e), type_name=type(e).__name__, errno=getattr(e, "errno", None)
+            ) from e
+
+    def extract(
+        self,
+        root: Union[str, Path],
+        write_tar: Callable[[IO[bytes]], None],
+        chunk_size=1024 * 64,
+    ) -> List[Dict[str, Any]]:
+        # 通过pipe在另一个线程中边写边解压，不需要缓存整个tar流
+        r, w = os.pipe()
+        result: Dict[str, Any] = {}
+
+        def run():
+            with open(r, "rb") as f:
+                try:
+                    result["value"] = self.call("extract", f, root=str(root))
+                except BaseException as e:
+                    result["error"] = e
+                finally:
+                    # 读完剩余数据，避免写入端阻塞
+                    while f.read(chunk_size):
+                        pass
+
+        t = threading.Thread(target=run, name="extract", daemon=True)
+        t.start()
+        try:
+            with open(w, "wb") as f:
+                write_tar(f)
+        finally:
+            t.join()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+
+class _FrameWriter:
+    """
+    将写入的数据按chunk_size切分为数据帧发送，关闭时发送结束的空帧
+    """
+
+    def __init__(self, write_frame: Callable[[bytes], None], chunk_size: int) -> None:
+        self._write_frame = write_frame
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buf += data
+        while len(self._buf) >= self._chunk_size:
+            self._write_frame(bytes(self._buf[: self._chunk_size]))
+            del self._buf[: self._chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buf:
+            self._write_frame(bytes(self._buf))
+            self._buf.clear()
+        self._write_frame(b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_worker: Optional[Worker] = None
+_worker_lock = threading.Lock()
+
+
+def worker() -> Worker:
+    """
+    获取当前进程共享的worker，在进程退出时关闭。使用backend()选择的提权方式，
+    已经有权限时在当前进程中执行，不会启动子进程
+    """
+    global _worker
+    b = backend()
+    with _worker_lock:
+        if _worker is None:
+            _worker = b.worker()
+            atexit.register(_worker.close)
+        return _worker
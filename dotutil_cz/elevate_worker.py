@@ -0,0 +1,478 @@
+"""
+提权后常驻的worker进程，通过stdin/stdout使用帧协议处理请求。
+
+该模块的源码会通过`sudo <python> -c`整体传入提权进程中运行，所以只能依赖标准库，
+不能import dotutil_cz中的其它模块。当前进程已经有权限时也会直接import调用OPS。
+
+帧格式：4字节大端长度 + 数据。请求与响应都是一个json帧，stream为true的请求在
+json帧后跟随若干数据帧并以空帧结束，操作从stream中读取这些数据。
+"""
+
+import errno
+import hashlib
+import io
+import json
+import os
+import shutil
+import stat
+import struct
+import sys
+import tarfile
+
+HEADER = struct.Struct(">I")
+# 内核复制时每次请求的最大字节数
+COPY_CHUNK = 8 * 1024 * 1024
+# 这些错误表示fd不支持对应的内核复制方式，需要回退
+FALLBACK_ERRNOS = {
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EBADF,
+    getattr(errno, "EOPNOTSUPP", errno.EINVAL),
+}
+
+
+def read_exact(fd, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = os.read(fd, size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(fd):
+    header = read_exact(fd, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size == 0:
+        return b""
+    data = read_exact(fd, size)
+    if data is None:
+        raise EOFError("unexpected eof in frame")
+    return data
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def write_frame(fd, data):
+    write_all(fd, HEADER.pack(len(data)) + data)
+
+
+def raw_fd(stream):
+    """
+    返回可以直接读取stream剩余数据的fd，没有fd或可能有未读取的缓冲数据时返回None
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if isinstance(stream, io.RawIOBase):
+        return fd
+    try:
+        if stream.seekable() and stream.tell() == os.lseek(fd, 0, os.SEEK_CUR):
+            return fd
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def copy_fd(fd_in, fd_out):
+    """
+    将fd_in剩余的数据复制到fd_out，不经过用户空间：普通文件之间使用copy_file_range，
+    有pipe时使用splice，源为普通文件时使用sendfile，都不可用时回退到read/write。
+    返回复制的字节数
+    """
+    mode_in, mode_out = os.fstat(fd_in).st_mode, os.fstat(fd_out).st_mode
+    methods = []
+    if (
+        stat.S_ISREG(mode_in)
+        and stat.S_ISREG(mode_out)
+        and hasattr(os, "copy_file_range")
+    ):
+        methods.append(lambda n: os.copy_file_range(fd_in, fd_out, n))
+    if (stat.S_ISFIFO(mode_in) or stat.S_ISFIFO(mode_out)) and hasattr(os, "splice"):
+        methods.append(lambda n: os.splice(fd_in, fd_out, n))
+    if stat.S_ISREG(mode_in) and hasattr(os, "sendfile"):
+        methods.append(lambda n: os.sendfile(fd_out, fd_in, None, n))
+
+    total = 0
+    for method in methods:
+        try:
+            while n := method(COPY_CHUNK):
+                total += n
+            return total
+        except OSError as e:
+            # 已复制的部分会更新fd的offset，回退后从当前位置继续
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+    while buf := os.read(fd_in, COPY_CHUNK):
+        write_all(fd_out, buf)
+        total += len(buf)
+    return total
+
+
+def file_type(mode):
+    if stat.S_ISREG(mode):
+        return "file"
+    elif stat.S_ISDIR(mode):
+        return "dir"
+    elif stat.S_ISLNK(mode):
+        return "symlink"
+    return "other"
+
+
+def stat_dict(st):
+    return {
+        "type": file_type(st.st_mode),
+        "mode": st.st_mode,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "ctime_ns": st.st_ctime_ns,
+        "dev": st.st_dev,
+        "ino": st.st_ino,
+        "uid": st.st_uid,
+        "gid": st.st_gid,
+    }
+
+
+def digest(path, chunk_size=1024 * 64):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while buf := f.read(chunk_size):
+            h.update(buf)
+    return h.hexdigest()
+
+
+def op_copy(req, stream):
+    dst = req["dst"]
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    shutil.copyfile(req["src"], dst, follow_symlinks=False)
+
+
+def op_hash(req, stream):
+    return digest(req["path"])
+
+
+def op_stat(req, stream):
+    try:
+        st = os.stat(req["path"], follow_symlinks=req.get("follow_symlinks", False))
+    except FileNotFoundError:
+        return None
+    return stat_dict(st)
+
+
+def op_manifest(req, stream):
+    entries = []
+    for path in req["paths"]:
+        try:
+            entries.append(stat_dict(os.stat(path)))
+        except (FileNotFoundError, NotADirectoryError):
+            entries.append(None)
+        except OSError as e:
+            entries.append({"type": "error", "error": str(e)})
+    return entries
+
+
+def op_hashes(req, stream):
+    digests = []
+    for path in req["paths"]:
+        try:
+            digests.append(digest(path))
+        except OSError:
+            digests.append(None)
+    return digests
+
+
+def op_exists(req, stream):
+    return os.path.exists(req["path"])
+
+
+def op_mkdir(req, stream):
+    os.makedirs(req["path"], exist_ok=True)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+    else:
+        return False
+    return True
+
+
+def op_remove(req, stream):
+    return remove_path(req["path"])
+
+
+def op_removes(req, stream):
+    results = []
+    for path in req["paths"]:
+        try:
+            results.append({"removed": remove_path(path)})
+        except OSError as e:
+            results.append({"error": str(e)})
+    return results
+
+
+def op_write(req, stream):
+    """
+    将src路径或stream的内容写入path。先打开src，无法读取时不会清空path
+    """
+    if req.get("src") is not None:
+        with open(req["src"], "rb") as s, open(req["path"], "wb") as f:
+            return copy_fd(s.fileno(), f.fileno())
+    with open(req["path"], "wb") as f:
+        if isinstance(stream, FrameReader):
+            return stream.copy_into(f.fileno())
+        elif (fd := raw_fd(stream)) is not None:
+            return copy_fd(fd, f.fileno())
+        shutil.copyfileobj(stream, f, COPY_CHUNK)
+        return f.tell()
+
+
+class FrameReader:
+    """
+    将后续的数据帧作为一个只读流，读到空帧时结束
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._buf = b""
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            frame = read_frame(self._fd)
+            if not frame:
+                self._eof = True
+            else:
+                self._buf += frame
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def drain(self):
+        while not self._eof:
+            self._buf = b""
+            self.read(1024 * 1024)
+
+    def copy_into(self, fd_out):
+        """
+        将剩余的数据写入fd_out。fd为pipe时每个数据帧使用splice直接写入，
+        不需要读取到用户空间。返回写入的字节数
+        """
+        total = len(self._buf)
+        if self._buf:
+            write_all(fd_out, self._buf)
+            self._buf = b""
+        use_splice = hasattr(os, "splice")
+        while not self._eof:
+            header = read_exact(self._fd, HEADER.size)
+            if header is None:
+                raise EOFError("unexpected eof in stream")
+            (size,) = HEADER.unpack(header)
+            if size == 0:
+                self._eof = True
+                break
+            try:
+                while size:
+                    if use_splice:
+                        try:
+                            n = os.splice(self._fd, fd_out, size)
+                        except OSError as e:
+                            if e.errno not in FALLBACK_ERRNOS:
+                                raise
+                            use_splice = False
+                            continue
+                    else:
+                        buf = os.read(self._fd, min(size, COPY_CHUNK))
+                        write_all(fd_out, buf)
+                        n = len(buf)
+                    if not n:
+                        raise EOFError("unexpected eof in frame")
+                    size -= n
+                    total += n
+            except OSError:
+                # 跳过当前帧剩余的数据，保持帧同步
+                while size:
+                    buf = os.read(self._fd, min(size, COPY_CHUNK))
+                    if not buf:
+                        break
+                    size -= len(buf)
+                raise
+        return total
+
+
+def _fchmod(fd, path, mode):
+    if hasattr(os, "fchmod"):
+        os.fchmod(fd, mode)
+    else:
+        os.chmod(path, mode)
+
+
+def _open_tmp(parent, name, mode, uid, gid):
+    """
+    在parent中以随机名称独占创建临时文件，不跟随symlink。写入内容之前先设置owner与mode，
+    避免内容以umask的权限短暂可见
+    """
+    for _ in range(100):
+        tmp = os.path.join(parent, f".{name}.{os.urandom(6).hex()}.tmp")
+        try:
+            fd = os.open(
+                tmp,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0),
+                0o600,
+            )
+        except FileExistsError:
+            continue
+        try:
+            if uid is not None and hasattr(os, "fchown"):
+                os.fchown(fd, uid, gid)
+            _fchmod(fd, tmp, mode)
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp)
+            raise
+        return tmp, fd
+    raise FileExistsError(errno.EEXIST, "no usable temporary file name", parent)
+
+
+def _write_member(tar, member, fd):
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(tar.extractfile(member), f, 1024 * 1024)
+
+
+def extract_member(tar, member, root):
+    """
+    将member写入root下，返回实际写入的路径。
+
+    文件先写入同目录的临时文件再rename，已存在的dst为symlink时写入其指向的文件，
+    与shutil.copyfile一样不替换symlink本身；有多个硬链接时直接在原文件中写入，
+    避免拆分硬链接。已存在的文件保留原owner，新文件属于当前提权用户
+    """
+    parts = member.name.split("/")
+    if member.name.startswith("/") or ".." in parts:
+        raise ValueError(f"invalid member name {member.name}")
+    dst = os.path.join(root, *parts)
+    if not member.issym() and os.path.islink(dst):
+        dst = os.path.realpath(dst)
+    parent = os.path.dirname(dst)
+    os.makedirs(parent, exist_ok=True)
+
+    try:
+        old = os.lstat(dst)
+    except FileNotFoundError:
+        old = None
+    uid, gid = (old.st_uid, old.st_gid) if old is not None else (None, None)
+
+    if member.isfile():
+        mode = stat.S_IMODE(member.mode)
+        if old is not None and stat.S_ISREG(old.st_mode) and old.st_nlink > 1:
+            fd = os.open(dst, os.O_WRONLY | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0))
+            try:
+                _fchmod(fd, dst, mode)
+            except BaseException:
+                os.close(fd)
+                raise
+            _write_member(tar, member, fd)
+            return dst
+        tmp, fd = _open_tmp(parent, os.path.basename(dst), mode, uid, gid)
+        try:
+            _write_member(tar, member, fd)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+    elif member.issym():
+        # symlink没有可以提前打开的fd，只能在随机名称上创建后再设置owner
+        tmp = os.path.join(
+            parent, f".{os.path.basename(dst)}.{os.urandom(6).hex()}.tmp"
+        )
+        try:
+            os.symlink(member.linkname, tmp)
+            if uid is not None and hasattr(os, "lchown"):
+                os.lchown(tmp, uid, gid)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+    else:
+        raise ValueError(f"unsupported member type for {member.name}")
+    return dst
+
+
+def op_extract(req, stream):
+    """
+    从stream中读取tar流，每个文件先写入同目录的临时文件再rename到root中
+    """
+    results = []
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            try:
+                dst = extract_member(tar, member, req["root"])
+                results.append({"name": member.name, "stat": stat_dict(os.lstat(dst))})
+            except Exception as e:
+                results.append({"name": member.name, "error": str(e)})
+    return results
+
+
+OPS = {
+    "copy": op_copy,
+    "hash": op_hash,
+    "stat": op_stat,
+    "manifest": op_manifest,
+    "hashes": op_hashes,
+    "exists": op_exists,
+    "mkdir": op_mkdir,
+    "remove": op_remove,
+    "removes": op_removes,
+    "write": op_write,
+    "extract": op_extract,
+}
+
+
+def main():
+    fd_in, fd_out = sys.stdin.fileno(), sys.stdout.fileno()
+    # ready frame
+    write_frame(
+        fd_out,
+        json.dumps({"ok": True, "result": {"pid": os.getpid()}}).encode(),
+    )
+    while (frame := read_frame(fd_in)) is not None:
+        if not frame:
+            continue
+        req = json.loads(frame)
+        # stream请求后跟随数据帧，无论成功与否都必须读完，否则后续请求会错位
+        stream = FrameReader(fd_in) if req.get("stream") else None
+        try:
+            op = OPS.get(req.get("op"))
+            if op is None:
+                raise ValueError(f"unknown op {req.get('op')}")
+            resp = {"ok": True, "result": op(req, stream)}
+        except Exception as e:
+            resp = {
+                "ok": False,
+                "type": type(e).__name__,
+                "errno": getattr(e, "errno", None),
+                "error": str(e),
+            }
+        finally:
+            if stream is not None:
+                stream.drain()
+        write_frame(fd_out, json.dumps(resp).encode())
+
+
+if __name__ == "__main__":
+    main()
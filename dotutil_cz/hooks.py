@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+chezmoi hook的入口，只在运行时才导入dotroot，避免`--help`等情况下的导入开销
+
+    python -m dotutil_cz.hooks pre
+    python -m dotutil_cz.hooks post
+"""
+
+import sys
+
+
+def pre_run():
+    from dotutil_cz.dotroot import pre_run
+
+    pre_run()
+
+
+def post_run():
+    from dotutil_cz.dotroot import post_run
+
+    post_run()
+
+
+HOOKS = {"pre": pre_run, "post": post_run}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1 or argv[0] not in HOOKS:
+        print(f"usage: {sys.argv[0]} {{{','.join(HOOKS)}}}", file=sys.stderr)
+        exit(2)
+    HOOKS[argv[0]]()
+
+
+if __name__ == "__main__":
+    main()
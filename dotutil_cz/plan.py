@@ -0,0 +1,127 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional, Union
+
+from dotutil_cz import SetupException
+
+_subprocess_count = 0
+_audit_lock = threading.Lock()
+_audit_installed = False
+
+
+def _audit(event: str, args):
+    global _subprocess_count
+    if event == "subprocess.Popen":
+        _subprocess_count += 1
+
+
+def subprocess_count() -> int:
+    """
+    当前进程中已经启动的子进程数，通过audit hook统计，在第一次调用时开始计数
+    """
+    global _audit_installed
+    with _audit_lock:
+        if not _audit_installed:
+            sys.addaudithook(_audit)
+            _audit_installed = True
+    return _subprocess_count
+
+
+class Plan:
+    """
+    记录hook将要执行的操作以及每个阶段的耗时与子进程数。
+
+    dry_run为True时hook只记录操作，不会修改任何文件
+    """
+
+    FORMATS = ("human", "json")
+
+    def __init__(self, dry_run=True, fmt="human") -> None:
+        if fmt not in self.FORMATS:
+            raise ValueError(f"unsupported plan format {fmt}")
+        self.dry_run = dry_run
+        self.fmt = fmt
+        self.actions: List[Dict[str, Optional[str]]] = []
+        self.phases: Dict[str, Dict[str, Union[int, float]]] = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._start_subprocesses = subprocess_count()
+
+    @classmethod
+    def from_env(cls) -> Optional["Plan"]:
+        """
+        env DOTUTIL_CZ_PLAN为human或json时返回对应格式的dry run plan，为1时使用human
+        """
+        v = os.environ.get("DOTUTIL_CZ_PLAN", "").strip().lower()
+        if not v or v in ("0", "false"):
+            return None
+        fmt = "human" if v in ("1", "true") else v
+        if fmt not in cls.FORMATS:
+            raise SetupException(f"unsupported DOTUTIL_CZ_PLAN {v}")
+        return cls(fmt=fmt)
+
+    def add(self, action: str, src, dst=None):
+        with self._lock:
+            self.actions.append(
+                {
+                    "action": action,
+                    "src": str(src),
+                    "dst": None if dst is None else str(dst),
+                }
+            )
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        累计name阶段的耗时与子进程数，同一个阶段可以多次进入
+        """
+        start, count = time.perf_counter(), subprocess_count()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                p = self.phases.setdefault(name, {"seconds": 0.0, "subprocesses": 0})
+                p["seconds"] += elapsed
+                p["subprocesses"] += subprocess_count() - count
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "dry_run": self.dry_run,
+            "actions": self.actions,
+            "phases": self.phases,
+            "seconds": time.perf_counter() - self._start,
+            "subprocesses": subprocess_count() - self._start_subprocesses,
+        }
+
+    def report(self) -> str:
+        data = self.to_dict()
+        if self.fmt == "json":
+            return json.dumps(data, indent=2)
+
+        lines = [f"plan: {len(self.actions)} actions"]
+        for a in self.actions:
+            s = f"  {a['action']:<15} {a['src']}"
+            if a["dst"] is not None:
+                s += f" -> {a['dst']}"
+            lines.append(s)
+        lines.append("phases:")
+        for name, p in self.phases.items():
+            lines.append(
+                f"  {name:<8} {p['seconds']:>9.3f}s  subprocesses={p['subprocesses']}"
+            )
+        lines.append(
+            f"total {data['seconds']:.3f}s  subprocesses={data['subprocesses']}"
+        )
+        return "\n".join(lines)
+
+
+def phase(plan: Optional[Plan], name: str):
+    """
+    plan为None时不统计
+    """
+    return nullcontext() if plan is None else plan.phase(name)
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class _Skipped(Exception):
+    pass
+
+
+class Preflight:
+    """
+    并发执行相互独立的检查，总耗时接近最慢的检查而不是所有检查之和。
+
+    需要用户输入的步骤(如sudo密码、ph list)应该在interactive()中执行：
+    同一时间只有一个检查可以交互，并且按checks的顺序进行，前面的检查失败时
+    后面的检查不会再提示用户。错误按checks的顺序报告，只抛出第一个错误
+    """
+
+    def __init__(self, checks: Sequence[Tuple[str, Callable[[], Any]]]) -> None:
+        self._checks = list(checks)
+        self._done = [False] * len(self._checks)
+        self._errors: Dict[int, BaseException] = {}
+        self._cond = threading.Condition()
+
+    def _run(self, i: int):
+        name, fn = self._checks[i]
+        _local.current = (self, i)
+        start = time.perf_counter()
+        try:
+            fn()
+        except BaseException as e:
+            self._errors[i] = e
+        finally:
+            _local.current = None
+            log.debug(f"finished check {name} in {time.perf_counter() - start:.3f}s")
+            with self._cond:
+                self._done[i] = True
+                self._cond.notify_all()
+
+    def run(self):
+        threads: List[threading.Thread] = []
+        for i, (name, _) in enumerate(self._checks):
+            t = threading.Thread(
+                target=self._run, args=(i,), name=f"preflight-{name}", daemon=True
+            )
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        errors = [
+            (self._checks[i][0], e)
+            for i, e in sorted(self._errors.items())
+            if not isinstance(e, _Skipped)
+        ]
+        for name, e in errors[1:]:
+            log.error(f"check {name} also failed: {e!r}")
+        if errors:
+            raise errors[0][1]
+
+    @contextmanager
+    def _interactive(self, i: int):
+        with self._cond:
+            self._cond.wait_for(lambda: all(self._done[:i]))
+            if any(j in self._errors for j in range(i)):
+                raise _Skipped(f"skipped {self._checks[i][0]} for failed checks")
+        yield
+
+
+@contextmanager
+def interactive():
+    """
+    在Preflight中等待前面所有的检查完成后再执行，不在Preflight中时直接执行
+    """
+    current = getattr(_local, "current", None)
+    if current is None:
+        yield
+        return
+    preflight, i = current
+    with preflight._interactive(i):
+        yield
@@ -4,8 +4,6 @@ from pathlib import Path
 from shutil import which
 from subprocess import check_call
 
-import dotenv
-
 log = logging.getLogger(Path(__file__).stem)
 
 # restic check && restic unlock
@@ -73,6 +71,8 @@ def main():
 
     envfile = Path.home().joinpath(".autorestic.env")
     log.debug(f"loading restic env from {envfile}")
+    import dotenv
+
     dotenv.load_dotenv(envfile)
 
     try:
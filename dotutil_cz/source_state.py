@@ -0,0 +1,306 @@
+"""
+chezmoi源码目录中文件名的属性解析。
+参考：https://www.chezmoi.io/reference/source-state-attributes/
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from dotutil_cz.walk import walk
+
+log = logging.getLogger(__name__)
+
+DIR_PREFIXES = ("exact_", "private_", "readonly_")
+FILE_PREFIXES = ("encrypted_", "private_", "readonly_", "empty_", "executable_")
+CREATE_PREFIXES = FILE_PREFIXES
+MODIFY_PREFIXES = ("encrypted_", "private_", "readonly_", "executable_")
+ENCRYPTED_SUFFIXES = (".age", ".asc")
+IGNORE_NAME = ".chezmoiignore"
+# 只有模板指令的行，如{{ if eq .chezmoi.os "linux" }}
+_TEMPLATE_LINE_PAT = re.compile(r"^(\{\{.*?\}\}\s*)+$")
+
+
+def _strip_prefixes(name: str, prefixes: Iterable[str], attrs: set) -> str:
+    for prefix in prefixes:
+        if name.startswith(prefix):
+            attrs.add(prefix[:-1])
+            name = name[len(prefix) :]
+    return name
+
+
+def _target_name(name: str) -> str:
+    if name.startswith("literal_"):
+        return name[len("literal_") :]
+    elif name.startswith("dot_"):
+        return "." + name[len("dot_") :]
+    return name
+
+
+def decode_dir(name: str) -> Tuple[str, str, FrozenSet[str]]:
+    """
+    解析源码目录名，返回(目标名, 类型, 属性)
+    """
+    attrs = set()
+    kind = "dir"
+    if name.startswith("remove_"):
+        kind, name = "remove", name[len("remove_") :]
+    elif name.startswith("external_"):
+        attrs.add("external")
+        name = name[len("external_") :]
+    name = _strip_prefixes(name, DIR_PREFIXES, attrs)
+    return _target_name(name), kind, frozenset(attrs)
+
+
+def decode_file(name: str) -> Tuple[Optional[str], str, FrozenSet[str]]:
+    """
+    解析源码文件名，返回(目标名, 类型, 属性)，脚本没有目标名
+    """
+    attrs = set()
+    if name.startswith("run_"):
+        return None, "script", frozenset()
+    elif name.startswith("create_"):
+        kind = "create"
+        name = _strip_prefixes(name[len("create_") :], CREATE_PREFIXES, attrs)
+    elif name.startswith("modify_"):
+        kind = "modify"
+        name = _strip_prefixes(name[len("modify_") :], MODIFY_PREFIXES, attrs)
+    elif name.startswith("remove_"):
+        kind, name = "remove", name[len("remove_") :]
+    elif name.startswith("symlink_"):
+        kind, name = "symlink", name[len("symlink_") :]
+    else:
+        kind = "file"
+        name = _strip_prefixes(name, FILE_PREFIXES, attrs)
+    name = _target_name(name)
+
+    if name.endswith(".literal"):
+        name = name[: -len(".literal")]
+    else:
+        if name.endswith(".tmpl"):
+            attrs.add("template")
+            name = name[: -len(".tmpl")]
+        if "encrypted" in attrs:
+            for suffix in ENCRYPTED_SUFFIXES:
+                if name.endswith(suffix):
+                    name = name[: -len(suffix)]
+                    break
+    return name, kind, frozenset(attrs)
+
+
+def ignore_patterns(text: str) -> Optional[List[str]]:
+    """
+    解析.chezmoiignore中可能忽略目标的pattern。
+
+    .chezmoiignore是模板，无法在不执行模板的情况下确定结果，所以条件中的pattern
+    与!排除的pattern都作为可能忽略的pattern返回。pattern本身包含模板时返回None，
+    表示无法确定忽略的目标
+    """
+    patterns = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or _TEMPLATE_LINE_PAT.match(line):
+            continue
+        elif "{{" in line:
+            return None
+        line = line.split("#", 1)[0].strip()
+        if line:
+            patterns.append(line.lstrip("!"))
+    return patterns
+
+
+def _source_root(source_dir: Path) -> Path:
+    # .chezmoiroot指定了真正的源码目录
+    if (p := source_dir.joinpath(".chezmoiroot")).is_file():
+        return source_dir.joinpath(p.read_text().strip())
+    return source_dir
+
+
+class SourceEntry:
+    __slots__ = ("source", "kind", "attrs")
+
+    def __init__(self, source: str, kind: str, attrs: Iterable[str]) -> None:
+        # 相对于源码目录
+        self.source = source
+        self.kind = kind
+        self.attrs = frozenset(attrs)
+
+    def __repr__(self) -> str:
+        return f"SourceEntry({self.source!r}, {self.kind!r}, {sorted(self.attrs)})"
+
+    def is_exact(self) -> bool:
+        return "exact" in self.attrs
+
+
+class SourceStateIndex:
+    """
+    chezmoi源码目录的索引：目标路径(相对于目标目录如~) -> SourceEntry。
+
+    可能被.chezmoiignore忽略的目标不在索引中，由调用者使用`chezmoi source-path`查找，
+    与chezmoi的结果保持一致。
+
+    索引可以保存在cache_path中，加载时检查源码目录中所有目录与.chezmoiignore的mtime，
+    有目录增删改文件时重新构建
+    """
+
+    VERSION = 2
+
+    def __init__(
+        self,
+        source_dir: Path,
+        entries: Dict[str, SourceEntry],
+        dir_mtimes: Dict[str, int],
+    ) -> None:
+        self._source_dir = source_dir
+        self._entries = entries
+        self._dir_mtimes = dir_mtimes
+
+    @classmethod
+    def build(cls, source_dir: Path) -> "SourceStateIndex":
+        source_root = _source_root(source_dir)
+        entries: Dict[str, SourceEntry] = {}
+        dir_mtimes = {os.curdir: os.stat(source_root).st_mtime_ns}
+        # 源码目录的相对路径 -> 目标相对路径
+        targets = {"": ""}
+        # (目录的目标相对路径, .chezmoiignore的源码相对路径)
+        ignores = []
+
+        def prune(entry) -> bool:
+            return entry.rel not in targets
+
+        for entry in walk(source_root, prune=prune):
+            parent, _ = os.path.split(entry.rel)
+            if parent not in targets:
+                continue
+            if entry.name == IGNORE_NAME and not entry.is_dir():
+                ignores.append((targets[parent], entry.rel))
+                dir_mtimes[entry.rel] = entry.stat().st_mtime_ns
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                name, kind, attrs = decode_dir(entry.name)
+                dir_mtimes[entry.rel] = entry.stat().st_mtime_ns
+            else:
+                name, kind, attrs = decode_file(entry.name)
+                if name is None:
+                    continue
+            target = os.path.join(targets[parent], name)
+            if entry.is_dir():
+                targets[entry.rel] = target
+            entries[target] = SourceEntry(
+                os.path.relpath(entry.path, source_dir), kind, attrs
+            )
+        for target_dir, rel in ignores:
+            cls._remove_ignored(entries, target_dir, source_root.joinpath(rel))
+        log.debug(f"built source state index with {len(entries)} entries")
+        return cls(source_dir, entries, dir_mtimes)
+
+    @staticmethod
+    def _remove_ignored(entries: Dict[str, SourceEntry], target_dir: str, path: Path):
+        """
+        从entries中删除target_dir下可能被path忽略的目标与其子路径
+        """
+        try:
+            patterns = ignore_patterns(path.read_text())
+        except (OSError, UnicodeDecodeError) as e:
+            log.debug(f"failed to read {path}: {e}")
+            patterns = None
+        if patterns is None:
+            # 无法解析时target_dir下的目标都交给chezmoi查找
+            patterns = ["*"]
+        if not patterns:
+            return
+        patterns = [os.path.normpath(os.path.join(target_dir, p)) for p in patterns]
+
+        def ignored(target: str) -> bool:
+            if target_dir and not target.startswith(target_dir + os.sep):
+                return False
+            # 目录被忽略时其中的目标也被忽略
+            while target:
+                if any(fnmatch.fnmatchcase(target, p) for p in patterns):
+                    return True
+                target = os.path.dirname(target)
+            return False
+
+        removed = [t for t in entries if ignored(t)]
+        for t in removed:
+            del entries[t]
+        log.debug(f"removed {len(removed)} entries possibly ignored by {path}")
+
+    @classmethod
+    def load(
+        cls, source_dir: Path, cache_path: Optional[Path] = None
+    ) -> "SourceStateIndex":
+        """
+        从cache_path加载索引，不存在或源码目录已改变时重新构建并保存
+        """
+        if cache_path is not None and cache_path.is_file():
+            try:
+                data = json.loads(cache_path.read_text())
+                if (
+                    data.get("version") == cls.VERSION
+                    and data["source_dir"] == str(source_dir)
+                    and cls._dirs_unchanged(source_dir, data["dirs"])
+                ):
+                    entries = {k: SourceEntry(*v) for k, v in data["entries"].items()}
+                    log.debug(f"loaded source state index from {cache_path}")
+                    return cls(source_dir, entries, data["dirs"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                log.warning(f"ignore invalid source state index {cache_path}: {e}")
+
+        index = cls.build(source_dir)
+        if cache_path is not None:
+            index.save(cache_path)
+        return index
+
+    @staticmethod
+    def _dirs_unchanged(source_dir: Path, dir_mtimes: Dict[str, int]) -> bool:
+        source_root = _source_root(source_dir)
+        for rel, mtime in dir_mtimes.items():
+            try:
+                if os.stat(source_root.joinpath(rel)).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def save(self, cache_path: Path):
+        data = {
+            "version": self.VERSION,
+            "source_dir": str(self._source_dir),
+            "dirs": self._dir_mtimes,
+            "entries": {
+                k: [e.source, e.kind, sorted(e.attrs)] for k, e in self._entries.items()
+            },
+        }
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps(data, separators=(",", ":")))
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            log.warning(f"failed to save source state index {cache_path}: {e}")
+            tmp.unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, target: str) -> Optional[SourceEntry]:
+        """
+        target为相对于目标目录的路径
+        """
+        return self._entries.get(os.path.normpath(target))
+
+    def source_path(self, target: str) -> Optional[Path]:
+        """
+        target对应的源码路径，目标目录本身对应源码目录
+        """
+        if os.path.normpath(target) == os.curdir:
+            return _source_root(self._source_dir)
+        if entry := self.get(target):
+            return self._source_dir.joinpath(entry.source)
+        return None
@@ -0,0 +1,234 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Set, Union
+
+from dotutil_cz.cache import DigestCache
+
+log = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    保存在chezmoi缓存目录中的sqlite状态：
+    * skipped: 上次跳过删除的映射路径
+    * sync: 每个映射文件上次应用到root时映射文件与root文件的stat key，
+      root文件的摘要(未知时为NULL)、mode、owner与应用的时间
+
+    只查询与更新需要的行，不需要每次读取并重写整个文件。
+    写入在save()时提交，可以在多个线程中使用。
+
+    dry_run为True时将已有的状态复制到内存数据库中，所有写入与导入都不会修改文件
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path, dry_run=False) -> None:
+        # sqlite3只在需要时导入，避免增加hook的启动时间
+        import sqlite3
+
+        self._path = path
+        self._dry_run = dry_run
+        self._lock = threading.RLock()
+        if dry_run:
+            self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+            if path.is_file():
+                src = sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)
+                try:
+                    src.backup(self._conn)
+                finally:
+                    src.close()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.VERSION:
+                self._create(version)
+
+    def _create(self, version: int):
+        log.debug(f"creating state store {self._path} from version {version}")
+        self._conn.executescript(f"""
+            DROP TABLE IF EXISTS skipped;
+            DROP TABLE IF EXISTS sync;
+            CREATE TABLE skipped (path TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE sync (
+                rel TEXT PRIMARY KEY,
+                mapped TEXT NOT NULL,
+                root TEXT NOT NULL,
+                digest TEXT,
+                mode INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                gid INTEGER NOT NULL,
+                applied_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            PRAGMA user_version = {self.VERSION};
+            """)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def save(self):
+        with self._lock:
+            self._conn.commit()
+        log.debug(f"saved state store {self._path}")
+
+    def migrate(self, rootlist_path: Optional[Path] = None):
+        """
+        导入旧的文本rootlist，导入后删除旧文件，dry run时保留
+        """
+        if rootlist_path is not None and rootlist_path.is_file():
+            paths = [
+                Path(line)
+                for line in rootlist_path.read_text().splitlines()
+                if line.strip()
+            ]
+            self.add_skipped(paths)
+            self.save()
+            if self._dry_run:
+                return
+            rootlist_path.unlink()
+            log.info(f"migrated {len(paths)} skipped paths from {rootlist_path}")
+
+    # skipped
+
+    def skipped(self) -> Set[Path]:
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM skipped").fetchall()
+        return {Path(r[0]) for r in rows}
+
+    def add_skipped(self, paths: Iterable[Path]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO skipped VALUES (?)", ((str(p),) for p in paths)
+            )
+
+    def remove_skipped(self, paths: Iterable[Path]):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM skipped WHERE path = ?", ((str(p),) for p in paths)
+            )
+
+    # sync
+
+    _SYNC_COLUMNS = ("mapped", "root", "digest", "mode", "uid", "gid", "applied_at")
+
+    @staticmethod
+    def _owner_mode(st: Union[os.stat_result, Dict[str, Any]]):
+        # 兼容提权worker返回的stat dict
+        if isinstance(st, dict):
+            return st["mode"], st["uid"], st["gid"]
+        return st.st_mode, st.st_uid, st.st_gid
+
+    def __contains__(self, rel: str) -> bool:
+        return self.get(rel) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM sync").fetchone()[0]
+
+    def get(self, rel: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self._SYNC_COLUMNS)} FROM sync WHERE rel = ?",
+                (rel,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self._SYNC_COLUMNS, row))
+
+    def unchanged(
+        self,
+        rel: str,
+        mapped_stat: Union[os.stat_result, Dict[str, Any]],
+        root_stat: Union[os.stat_result, Dict[str, Any], None],
+    ) -> bool:
+        """
+        映射文件与root文件在上次应用后是否都没有改变，root文件的mode或owner
+        改变时也视为改变，需要重新比较
+        """
+        if root_stat is None:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mapped, root, mode, uid, gid FROM sync WHERE rel = ?", (rel,)
+            ).fetchone()
+        if row is None:
+            return False
+        mode, uid, gid = self._owner_mode(root_stat)
+        if (uid, gid) != row[3:]:
+            log.warning(
+                f"owner of root file {rel} changed from {row[3]}:{row[4]} to {uid}:{gid} since last apply"
+            )
+            return False
+        return row[:3] == (
+            DigestCache.key(mapped_stat),
+            DigestCache.key(root_stat),
+            mode,
+        )
+
+    def put(
+        self,
+        rel: str,
+        mapped_stat: Union[os.stat_result, Dict[str, Any]],
+        root_stat: Union[os.stat_result, Dict[str, Any]],
+        digest: Optional[str] = None,
+    ):
+        """
+        记录rel应用到root后的状态，digest为root文件的摘要，调用者不应该为此额外读取文件
+        """
+        row = (
+            rel,
+            DigestCache.key(mapped_stat),
+            DigestCache.key(root_stat),
+            digest,
+            *self._owner_mode(root_stat),
+            time.time(),
+        )
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row
+            )
+
+    def retain(self, rels: Iterable[str], scopes: Iterable[str] = None):
+        """
+        删除scopes子树中不在rels中的记录，即已经不存在的映射文件。
+        scopes为None或包含"."时表示所有记录
+        """
+        scopes = None if scopes is None else set(scopes)
+        if scopes is not None and os.curdir in scopes:
+            scopes = None
+
+        def in_scopes(rel: str) -> bool:
+            return scopes is None or any(
+                rel == s or rel.startswith(s + os.sep) for s in scopes
+            )
+
+        with self._lock:
+            self._conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS keep (rel TEXT PRIMARY KEY)"
+            )
+            self._conn.execute("DELETE FROM temp.keep")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO temp.keep VALUES (?)", ((r,) for r in rels)
+            )
+            removed = [
+                r
+                for (r,) in self._conn.execute(
+                    "SELECT rel FROM sync WHERE rel NOT IN (SELECT rel FROM temp.keep)"
+                )
+                if in_scopes(r)
+            ]
+            self._conn.executemany(
+                "DELETE FROM sync WHERE rel = ?", ((r,) for r in removed)
+            )
+            self._conn.execute("DELETE FROM temp.keep")
+        if removed:
+            log.debug(f"removed {len(removed)} sync entries from {self._path}")
@@ -6,8 +6,6 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Callable
 
-import docker
-
 
 @dataclass
 class MdcData:
@@ -21,6 +19,8 @@ class MdcData:
 
 class AvUpdater:
     def __init__(self, mdc: MdcData) -> None:
+        import docker
+
         self._mdc = mdc
         self._docker = docker.from_env()
         self._stop_timeout = 2
@@ -101,10 +101,12 @@ class AvUpdater:
 
     def _start_mdc(self):
         """generate jellyfin metadata from av videos"""
+        from docker.errors import NotFound
+
         name = "mdc"
         try:
             c = self._docker.containers.get(name)
-        except docker.errors.NotFound:
+        except NotFound:
             self.log.info(f"Creating new container {name}")
             c = self._docker.containers.create(
                 "navyd/mdc",
@@ -128,10 +130,12 @@ class AvUpdater:
 
     def _start_gfriends_inputer(self):
         """update actor thumb"""
+        from docker.errors import NotFound
+
         name = "gfriends-inputer"
         try:
             c = self._docker.containers.get(name)
-        except docker.errors.NotFound:
+        except NotFound:
             self.log.info(f"Creating new container {name}")
             volname = "gfriends-inputer-data"
             self._docker.volumes.create(volname)
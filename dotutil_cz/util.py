@@ -1,65 +1,268 @@
+import atexit
+import errno
 import hashlib
 import json
 import logging
 import os
 import re
+import stat
 import subprocess as sp
+import threading
+from collections import deque
 from collections.abc import Iterable
-from io import BytesIO
 from pathlib import Path
-from typing import IO, Dict, Generator, List, Set, Union
-from urllib.request import urlopen
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from dotutil_cz import SetupException, elevate, logger
+from dotutil_cz.cache import DigestCache, DumpCache, SnapshotCache
+from dotutil_cz.source_state import SourceStateIndex
+from dotutil_cz.state import StateStore
+from dotutil_cz.walk import Entry, walk
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+R = TypeVar("R")
 
-def get_digest(path: Path) -> str:
+ROOT_LIST_NAME = ".root"
+STATE_STORE_NAME = ".root.state.db"
+DIGEST_CACHE_NAME = ".root.digests.json"
+SOURCE_INDEX_NAME = ".root.source-index.json"
+DATA_CACHE_NAME = ".root.data.json"
+MAPPED_MANIFEST_NAME = ".root.manifest.jsonl"
+
+_digest_cache: Optional[DigestCache] = None
+_digest_cache_lock = threading.Lock()
+_state_stores: Dict[Tuple[Path, bool], StateStore] = {}
+_state_store_lock = threading.Lock()
+
+
+def digest_cache() -> Optional[DigestCache]:
+    """
+    获取当前进程共享的摘要缓存，保存在CHEZMOI_CACHE_DIR中并在进程退出时写回。
+    不在chezmoi中运行时返回None
+    """
+    global _digest_cache
+    with _digest_cache_lock:
+        if _digest_cache is None and (v := os.environ.get("CHEZMOI_CACHE_DIR")):
+            _digest_cache = DigestCache(Path(v).joinpath(DIGEST_CACHE_NAME))
+            atexit.register(_digest_cache.save)
+        return _digest_cache
+
+
+def state_store(cache_dir: Path, dry_run=False) -> StateStore:
+    """
+    获取cache_dir中当前进程共享的状态存储，第一次打开时导入旧的rootlist，
+    并在进程退出时提交。dry_run为True时不会修改cache_dir中的任何文件
+    """
+    with _state_store_lock:
+        if (store := _state_stores.get((cache_dir, dry_run))) is None:
+            store = StateStore(cache_dir.joinpath(STATE_STORE_NAME), dry_run=dry_run)
+            store.migrate(cache_dir.joinpath(ROOT_LIST_NAME))
+            atexit.register(store.close)
+            _state_stores[(cache_dir, dry_run)] = store
+        return store
+
+
+def close_caches():
+    """
+    保存并关闭当前进程共享的摘要缓存与状态存储，之后再次获取时按当时的
+    CHEZMOI_CACHE_DIR重新打开。用于在一个进程中切换多个缓存目录，如benchmark
+    """
+    global _digest_cache
+    with _digest_cache_lock:
+        if _digest_cache is not None:
+            _digest_cache.save()
+            atexit.unregister(_digest_cache.save)
+            _digest_cache = None
+    with _state_store_lock:
+        for store in _state_stores.values():
+            store.close()
+            atexit.unregister(store.close)
+        _state_stores.clear()
+
+
+def apply_journal(dry_run=False) -> Optional[StateStore]:
+    """
+    加载CHEZMOI_CACHE_DIR中上次应用到root的记录，不在chezmoi中运行时返回None
+    """
+    if v := os.environ.get("CHEZMOI_CACHE_DIR"):
+        return state_store(Path(v), dry_run=dry_run)
+    return None
+
+
+def source_state_index(source_dir: Path) -> SourceStateIndex:
+    """
+    加载chezmoi源码目录的索引，在chezmoi中运行时缓存在CHEZMOI_CACHE_DIR中
+    """
+    cache_path = None
+    if v := os.environ.get("CHEZMOI_CACHE_DIR"):
+        cache_path = Path(v).joinpath(SOURCE_INDEX_NAME)
+    return SourceStateIndex.load(source_dir, cache_path)
+
+
+def get_digest(path: Path, cache: Optional[DigestCache] = None) -> str:
+    """
+    计算文件sha256，如果文件stat未改变则从cache中获取。cache为None时使用digest_cache()
+    """
     chunk_size = 1024 * 4
+    if cache is None:
+        cache = digest_cache()
     h = hashlib.sha256()
     try:
         with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if cache is not None and (digest := cache.get(st)) is not None:
+                return digest
             while buf := f.read(chunk_size):
                 h.update(buf)
-            return h.hexdigest()
+            digest = h.hexdigest()
+            if cache is not None:
+                cache.put(st, digest)
+            return digest
     except PermissionError as e:
         log.debug(f"try elevate to read file {path} without read permission")
-        pycode = f"""
-import hashlib
-h = hashlib.sha256()
-with open({repr(str(path))}, "rb") as f:
-    while buf := f.read({chunk_size}):
-        h.update(buf)
-    print(h.hexdigest(), end='')
-"""
         try:
-            return elevate.py_check_output(pycode).decode()
-        except sp.CalledProcessError as e1:
+            w = elevate.worker()
+            st = None
+            if cache is not None and (st := w.stat(path, follow_symlinks=True)):
+                if (digest := cache.get(st)) is not None:
+                    return digest
+            digest = w.hash(path)
+            if st is not None:
+                cache.put(st, digest)
+            return digest
+        except elevate.ElevateExcetion as e1:
             log.warning(
-                f"failed to read file {path} using {e1.cmd}: "
-                f"{e1.stderr.decode()}. Please enter password with sudo in advance"
+                f"failed to read file {path} using elevated worker: "
+                f"{e1}. Please enter password with sudo in advance"
             )
             raise e
 
 
-def has_changed_su(src: Path, dst: Path) -> bool:
-    def get_mode(path):
-        return sp.check_output(["sudo", "stat", "--format", "%a", path], text=True)
+def same_content(a: Path, b: Path, buf_size=1024 * 1024) -> bool:
+    """
+    逐块比较两个文件的内容，在第一个不同的块时返回False。不检查文件大小，
+    调用者应该先比较大小。
 
-    smode = get_mode(src)
-    dmode = get_mode(dst)
-    return smode != dmode or get_digest(src) != get_digest(dst)
+    与mmap比较过，对大文件page fault的开销反而更慢，所以使用readinto复用缓冲
+    """
+    with open(a, "rb", buffering=0) as fa, open(b, "rb", buffering=0) as fb:
+        # 小文件不需要分配完整的缓冲
+        buf_size = min(buf_size, os.fstat(fa.fileno()).st_size + 1)
+        ba, bb = bytearray(buf_size), bytearray(buf_size)
+        while True:
+            na, nb = fa.readinto(ba), fb.readinto(bb)
+            if na != nb:
+                return False
+            elif na == 0:
+                return True
+            elif na == buf_size:
+                if ba != bb:
+                    return False
+            elif ba[:na] != bb[:nb]:
+                return False
 
 
-def has_changed(src: Path, dst: Path) -> bool:
-    if not src.exists():
+def has_changed(
+    src: Path,
+    dst: Path,
+    src_stat: os.stat_result = None,
+    dst_stat: os.stat_result = None,
+) -> bool:
+    """
+    先比较mode与大小，再比较缓存的摘要，最后逐块比较内容。
+    仅在其中一方没有读权限时使用提权hash比较。
+
+    如果调用者已经有stat结果(如walk)可以传入src_stat/dst_stat避免重复stat
+    """
+    try:
+        s = src.stat() if src_stat is None else src_stat
+    except FileNotFoundError:
         raise SetupException(f"{src} is not exists")
-    if not src.is_file():
+    if not stat.S_ISREG(s.st_mode):
         raise SetupException(f"{src} is not a file")
-    s = src.stat()
-    d = dst.stat()
-    return s.st_mode != d.st_mode or get_digest(src) != get_digest(dst)
+    d = dst.stat() if dst_stat is None else dst_stat
+    if s.st_mode != d.st_mode or s.st_size != d.st_size:
+        return True
+    elif os.path.samestat(s, d):
+        return False
+
+    cache = digest_cache()
+    if (
+        cache is not None
+        and (sd := cache.get(s)) is not None
+        and (dd := cache.get(d)) is not None
+    ):
+        return sd != dd
+
+    try:
+        return not same_content(src, dst)
+    except PermissionError:
+        return get_digest(src) != get_digest(dst)
+
+
+def elevate_manifest(
+    paths: Iterable[Path],
+    need_digest: Callable[[Path, Dict[str, Any]], bool] = None,
+    cache: Optional[DigestCache] = None,
+) -> Dict[Path, Optional[Dict[str, Any]]]:
+    """
+    通过一次提权请求获取所有paths的manifest：类型、mode、大小、mtime等，不存在的为None。
+    对need_digest返回True的文件(默认所有文件)在dict中增加digest，已缓存的不再计算，
+    其余的再通过一次请求计算
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+    if cache is None:
+        cache = digest_cache()
+    w = elevate.worker()
+    manifest = dict(zip(paths, w.manifest(paths)))
+
+    pending = []
+    for path, st in manifest.items():
+        if st is None or st["type"] != "file":
+            continue
+        elif need_digest is not None and not need_digest(path, st):
+            continue
+        elif cache is not None and (digest := cache.get(st)) is not None:
+            st["digest"] = digest
+        else:
+            pending.append(path)
+    if pending:
+        log.debug(f"computing {len(pending)} digests with elevated worker")
+        for path, digest in zip(pending, w.hashes(pending)):
+            st = manifest[path]
+            st["digest"] = digest
+            if cache is not None and digest is not None:
+                cache.put(st, digest)
+    return manifest
+
+
+def has_changed_manifest(path: Path, entry: Dict[str, Any]) -> bool:
+    """
+    比较可读的path与elevate_manifest中另一个文件的entry
+    """
+    s = path.stat()
+    return (
+        s.st_mode != entry["mode"]
+        or s.st_size != entry["size"]
+        or get_digest(path) != entry.get("digest")
+    )
 
 
 def config_global_log(level=logging.CRITICAL, stream=None):
@@ -100,21 +303,80 @@ def config_log_cz(log: logging.Logger = None, cz=None, level=logging.DEBUG):
 
 
 def elevate_copy_file(src: Path, dst: Path):
-    pycode = f"""\
-from pathlib import Path
-import shutil
-dst = Path(r'{str(dst)}')
-dst.parent.mkdir(parents=True, exist_ok=True)
-shutil.copyfile(r'{str(src)}', dst, follow_symlinks=False)
-"""
     logging.info(f"copying file {src} -> {dst}")
-    out = elevate.py_check_output(pycode)
-    logging.debug(f'coppied output: {out.decode(errors="ignore")}')
+    elevate.worker().copy(src, dst)
+
+
+def default_workers() -> int:
+    """
+    并发比较文件时使用的线程数，可以使用env DOTUTIL_CZ_WORKERS配置
+    """
+    if v := os.environ.get("DOTUTIL_CZ_WORKERS"):
+        return max(1, int(v))
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def ordered_map(
+    fn: Callable[[T], R], items: Iterable[T], workers: int = None
+) -> Iterator[R]:
+    """
+    在线程池中执行fn并按items的顺序返回结果，同时最多提交workers * 2个任务，
+    避免walk过快时在内存中堆积过多的结果。workers <= 1时在当前线程中执行
+    """
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+def elevate_copy_files(
+    files: Iterable[Tuple[Path, Path]], root: Path = Path(os.sep)
+) -> Dict[Path, Dict[str, Any]]:
+    """
+    将所有(src, dst)作为一个tar流发送给提权的worker，在一次请求中写入root下的dst。
+    每个文件先写入临时文件再原子rename，mode与src一致，已存在的dst保留原owner，
+    dst为symlink时写入其指向的文件，有多个硬链接时在原文件中写入。
+
+    返回dst -> worker的结果，成功时包含新的stat，失败时包含error
+    """
+    files = list(files)
+    names = {}
+
+    def write_tar(f: IO[bytes]):
+        import tarfile
+
+        with tarfile.open(fileobj=f, mode="w|") as tar:
+            for src, dst in files:
+                name = dst.relative_to(root).as_posix()
+                logging.info(f"copying file {src} -> {dst}")
+                tar.add(src, arcname=name, recursive=False)
+                names[name] = dst
+
+    results = elevate.worker().extract(root, write_tar)
+    return {names[r["name"]]: r for r in results}
 
 
 def download_file(url, file):
     CHUNK = 10 * 1024
     logging.info(f"downloading to {file.name} from {url}")
+    from urllib.request import urlopen
+
     response = urlopen(url)
     while chunk := response.read(CHUNK):
         file.write(chunk)
@@ -155,29 +417,49 @@ def paths2str(paths, delimiter=",") -> str:
     return delimiter.join(str(p) for p in paths)
 
 
-def elevate_writefile(path: str, src: Union[IO[bytes], str], chunk_size=4096):
-    """
-    从src读取数据并使用sudo/gsudo启动另一个py进程写入path中。没有其它依赖
+def elevate_writefile(
+    path: str,
+    src: Union[IO[bytes], str, bytes, os.PathLike],
+    chunk_size: int = None,
+):
     """
+    通过提权的worker将src写入path中：
+    * str、bytes: 写入的内容，直接作为数据帧发送
+    * os.PathLike: 源文件路径，先以当前用户打开，避免通过worker读取当前用户无法读取的
+      文件。worker再通过/proc中的fd打开同一个文件并在内核中复制，无法打开时，
+      如root无法访问的fuse挂载，回退到当前进程读取后发送
+    * IO[bytes]: 读取后发送，普通文件与pipe使用sendfile/splice，写入后关闭
 
-    if type(src) is str:
-        src = BytesIO(src.encode())
-
-    pycp_str = f"""
-import sys
-with open({repr(str(path))}, 'wb+') as f, sys.stdin.buffer as i:
-    while buf := i.read({chunk_size}):
-        f.write(buf)
-"""
-    with elevate.py_popen(pycp_str, stdin=sp.PIPE) as p, src as s:
-        with p.stdin as i:
-            while buf := s.read(chunk_size):
-                i.write(buf)
-        if (code := p.wait()) != 0:
-            logging.error(
-                f"Process {p.pid} writing to file {path} failed with exit code {code}"
-            )
-            raise SetupException(f"failed to write {path} for process {p.pid}")
+    chunk_size为None时使用自适应的缓冲
+    """
+    w = elevate.worker()
+    try:
+        if isinstance(src, os.PathLike):
+            try:
+                s = open(src, "rb")
+            except OSError as e:
+                raise SetupException(f"failed to read {src}: {e}")
+            with s:
+                fd_path = f"/proc/{os.getpid()}/fd/{s.fileno()}"
+                if os.path.exists(fd_path):
+                    try:
+                        w.writefile(path, fd_path)
+                        return
+                    except elevate.ElevateWorkerError as e:
+                        if e.errno not in (errno.EACCES, errno.EPERM):
+                            raise
+                        logging.debug(
+                            f"elevated worker can not read {src}, sending it: {e}"
+                        )
+                w.write(path, s, chunk_size=chunk_size)
+        elif isinstance(src, (str, bytes)):
+            w.write(path, src.encode() if isinstance(src, str) else src)
+        else:
+            with src as s:
+                w.write(path, s, chunk_size=chunk_size)
+    except elevate.ElevateWorkerError as e:
+        logging.error(f"Elevated worker writing to file {path} failed: {e}")
+        raise SetupException(f"failed to write {path}: {e}")
 
 
 class ChezmoiArgs:
@@ -206,6 +488,10 @@ class ChezmoiArgs:
         )
 
         self._data = None
+        # preflight中的检查会在多个线程中同时获取data
+        self._data_lock = threading.Lock()
+        self._source_paths: Dict[Path, Optional[Path]] = {}
+        self._source_index: Optional[SourceStateIndex] = None
 
     def has_debug(self) -> bool:
         return self._is_debug
@@ -226,13 +512,13 @@ class ChezmoiArgs:
             raise SetupException("not found env CHEZMOI_HOME_DIR")
 
     def home_dir(self) -> Path:
-        if s := os.environ.get("CHEZMOI_HOME_DIR", self.data().get("homeDir")):
+        if s := os.environ.get("CHEZMOI_HOME_DIR") or self.data().get("homeDir"):
             return Path(s)
         raise SetupException("not found chezmoi home dir")
 
     def root_list(self) -> Path:
         if v := os.environ["CHEZMOI_CACHE_DIR"]:
-            return Path(v).joinpath(".root")
+            return Path(v).joinpath(ROOT_LIST_NAME)
         else:
             raise SetupException("not found env CHEZMOI_CACHE_DIR")
 
@@ -243,23 +529,160 @@ class ChezmoiArgs:
             raise SetupException("not found env CHEZMOI_EXECUTABLE")
 
     def data(self) -> Dict[str, str]:
+        """
+        chezmoi data的结果，在CHEZMOI_CACHE_DIR中缓存，配置文件、chezmoi或源码目录中
+        .chezmoi*文件改变时重新运行`chezmoi data`
+        """
+        with self._data_lock:
+            if self._data is None:
+                self._load_data()
+        return self._data
+
+    def _load_data(self):
+        path, key = None, None
+        if v := os.environ.get("CHEZMOI_CACHE_DIR"):
+            path = Path(v).joinpath(DATA_CACHE_NAME)
+            try:
+                key = self._data_cache_key()
+            except OSError as e:
+                log.debug(f"skipped data cache: {e}")
+        if path is not None and key is not None:
+            self._data = self._load_data_cache(path, key)
         if self._data is None:
             out = sp.check_output(
                 [self.bin_path(), "data", "--format", "json"], text=True
             )
             self._data = json.loads(out)
-        return self._data
+            if path is not None and key is not None:
+                self._save_data_cache(path, key, self._data)
+
+    def _data_cache_key(self) -> Optional[str]:
+        """
+        data缓存的key，无法确定配置文件或源码目录时返回None表示不缓存
+        """
+        config = os.environ.get("CHEZMOI_CONFIG_FILE")
+        source_dir = os.environ.get("CHEZMOI_SOURCE_DIR")
+        bin = os.environ.get("CHEZMOI_EXECUTABLE")
+        if not config or not source_dir or not bin:
+            return None
+
+        h = hashlib.sha256()
+        for path in [config, bin]:
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+        h.update(Path(config).read_bytes())
+
+        # 源码目录中的.chezmoi.<format>.tmpl与.chezmoidata*都会影响data
+        source_root = Path(source_dir)
+        if (p := source_root.joinpath(".chezmoiroot")).is_file():
+            source_root = source_root.joinpath(p.read_text().strip())
+        h.update(f"{source_root}\n".encode())
+        with os.scandir(source_root) as it:
+            names = sorted(d.name for d in it if d.name.startswith(".chezmoi"))
+        for name in names:
+            top = source_root.joinpath(name)
+            for e in [Entry.from_path(top, name), *walk(top, root=source_root)]:
+                st = e.stat(follow_symlinks=False)
+                h.update(f"{e.rel}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+        return h.hexdigest()
 
-    def get_source_path(self, target: Path) -> Path:
+    @staticmethod
+    def _load_data_cache(path: Path, key: str) -> Optional[Dict[str, str]]:
+        try:
+            data = json.loads(path.read_text())
+            if data.get("key") == key:
+                log.debug(f"loaded chezmoi data from cache {path}")
+                return data["data"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f"ignore invalid data cache {path}: {e}")
+        return None
+
+    @staticmethod
+    def _save_data_cache(path: Path, key: str, data: Dict[str, str]):
+        # data中可能包含密码管理器中的数据，只允许当前用户读取
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as f:
+                json.dump({"key": key, "data": data}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning(f"failed to save data cache {path}: {e}")
+            tmp.unlink(missing_ok=True)
+
+    def get_source_path(self, target: Path) -> Optional[Path]:
         if target is None:
             raise SetupException("target is none")
-        p = sp.run(
-            [self.bin_path(), "source-path", target],
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            text=True,
+        return self.get_source_paths([target])[target]
+
+    def get_source_paths(self, targets: Iterable[Path]) -> Dict[Path, Optional[Path]]:
+        """
+        批量查找targets对应的源码路径，不存在时为None。
+
+        结果在当前进程中缓存。首先从源码目录的索引中查找，
+        剩下的使用一次`chezmoi source-path`命令查找
+        """
+        targets = list(targets)
+        rest = [t for t in dict.fromkeys(targets) if t not in self._source_paths]
+        if rest:
+            rest = self._resolve_source_paths_local(rest)
+        if rest:
+            self._resolve_source_paths_cz(rest)
+        return {t: self._source_paths[t] for t in targets}
+
+    def _resolve_source_paths_local(self, targets: List[Path]) -> List[Path]:
+        """
+        使用源码目录的索引查找，返回未找到的targets
+        """
+        try:
+            if self._source_index is None:
+                self._source_index = source_state_index(self.source_dir())
+            dest_dir = os.environ.get("CHEZMOI_DEST_DIR") or str(self.home_dir())
+        except (OSError, KeyError, sp.CalledProcessError, SetupException) as e:
+            log.debug(f"failed to load source state index: {e}")
+            return targets
+
+        rest = []
+        for target in targets:
+            rel = os.path.relpath(os.path.abspath(target), dest_dir)
+            if rel != os.pardir and not rel.startswith(os.pardir + os.sep):
+                if p := self._source_index.source_path(rel):
+                    self._source_paths[target] = p
+                    continue
+            rest.append(target)
+        log.debug(
+            f"found {len(targets) - len(rest)} source paths in index, rest {len(rest)} targets: {paths2str(rest)}"
         )
-        return Path(p.stdout.strip()) if p.returncode == 0 else None
+        return rest
+
+    def _resolve_source_paths_cz(self, targets: List[Path]):
+        args = [self.bin_path(), "source-path", *targets]
+        log.debug(f"finding source paths with {args}")
+        p = sp.run(args, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+        lines = p.stdout.splitlines()
+        if p.returncode == 0 and len(lines) == len(targets):
+            self._source_paths.update(
+                (t, Path(line.strip())) for t, line in zip(targets, lines)
+            )
+            return
+
+        # 存在无法找到的target时cz会失败，只能逐个查找
+        log.debug(
+            f"failed to find {len(targets)} source paths at once on status {p.returncode}: {p.stderr.strip()}"
+        )
+        for target in targets:
+            p = sp.run(
+                [self.bin_path(), "source-path", target],
+                stdout=sp.PIPE,
+                stderr=sp.PIPE,
+                text=True,
+            )
+            self._source_paths[target] = (
+                Path(p.stdout.strip()) if p.returncode == 0 else None
+            )
 
     def source_dir(self) -> Path:
         if not (v := os.environ.get("CHEZMOI_SOURCE_DIR")):
@@ -267,8 +690,63 @@ class ChezmoiArgs:
         return Path(v)
 
 
+def _iter_chunks(data: bytes, chunk_size=1024 * 64) -> Iterator[bytes]:
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+class _MemberChunks:
+    """
+    按块读取tar流中的一个成员，tar流前进到下一个成员后不能再读取
+    """
+
+    def __init__(self, f: IO[bytes], chunk_size: int) -> None:
+        self._f = f
+        self._chunk_size = chunk_size
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self._closed:
+            raise SetupException("restic dump chunks are read after the next file")
+        if chunk := self._f.read(self._chunk_size):
+            return chunk
+        raise StopIteration
+
+    def close(self):
+        self._closed = True
+
+
+# 选择snapshot的参数只传给dump与snapshots，其它参数作为全局参数传给所有命令
+_RESTIC_FILTER_OPTS = ("host", "path", "tag")
+# 当前进程中已经查询的仓库id、snapshots与文件列表，每次运行只查询一次
+_restic_resolved: Dict[Tuple, Any] = {}
+_restic_lock = threading.RLock()
+
+
+def _global_opts(kwargs: Dict[str, str]) -> Dict[str, str]:
+    return {k: v for k, v in kwargs.items() if k not in _RESTIC_FILTER_OPTS}
+
+
+def _restic_path(path: Union[str, Path]) -> str:
+    """
+    restic中的路径，windows的C:\\a为/C/a
+    """
+    p = Path(path)
+    if p.drive:
+        return "/".join(["", p.drive.rstrip(":"), *p.parts[1:]])
+    return p.as_posix()
+
+
 class Restic:
-    def __init__(self, bin: str, env=None) -> None:
+    def __init__(
+        self, bin: str, env=None, cache: Union[DumpCache, bool, None] = None
+    ) -> None:
+        """
+        cache为None时从env创建DumpCache(见DumpCache.from_env)，为False时不使用缓存
+        """
         self.log = logging.getLogger(__name__)
         self._bin = Path(bin)
         if not self._bin.exists():
@@ -278,15 +756,248 @@ class Restic:
             self.log.debug(f"using restic env: {env}")
             # restic error: unable to open cache: unable to locate cache directory: neither $XDG_CACHE_HOME nor $HOME are defined
             self._env.update(env)
+        self._cache = cache
+
+    def _args(self, cmd: str, kwargs: Dict[str, str], filters=True) -> List[str]:
+        args = [str(self._bin), cmd]
+        for k, v in kwargs.items():
+            if filters or k not in _RESTIC_FILTER_OPTS:
+                args += [f"--{k}", v]
+        return args
+
+    def _repo_key(self, kwargs: Dict[str, str]) -> Tuple:
+        return (
+            str(self._bin),
+            self._env.get("RESTIC_REPOSITORY"),
+            self._env.get("RESTIC_REPOSITORY_FILE"),
+            tuple(sorted(kwargs.items())),
+        )
+
+    def _resolve(self, key: Tuple, query: Callable[[], T]) -> T:
+        with _restic_lock:
+            if (v := _restic_resolved.get(key)) is None:
+                v = _restic_resolved[key] = query()
+        return v
+
+    def repo_id(self, **kwargs) -> str:
+        """
+        仓库的id，每个进程只查询一次，并按仓库参数缓存在SnapshotCache.base_dir()中
+        """
+        kwargs = _global_opts(kwargs)
+        key = self._repo_key(kwargs)
+
+        def query():
+            base_dir = SnapshotCache.base_dir(self._env)
+            repo_key = json.dumps(key)
+            if v := SnapshotCache.get_repo_id(base_dir, repo_key):
+                return v
+            args = self._args("cat", kwargs) + ["config"]
+            self.log.debug(f"start running command {args}")
+            v = json.loads(sp.check_output(args, env=self._env))["id"]
+            try:
+                SnapshotCache.put_repo_id(base_dir, repo_key, v)
+            except OSError as e:
+                self.log.warning(f"failed to cache restic repository id: {e}")
+            return v
+
+        return self._resolve((key, "config"), query)
+
+    def metadata(self, **kwargs) -> SnapshotCache:
+        return SnapshotCache.from_env(self._env, self.repo_id(**kwargs))
+
+    def snapshots(self, fresh=False, **kwargs) -> List[Dict[str, Any]]:
+        """
+        仓库中所有的snapshot，按时间顺序。结果缓存在SnapshotCache中，过期前不需要查询仓库。
+
+        fresh为True时忽略SnapshotCache，当前进程中还没有查询过仓库时重新查询，
+        用于解析latest，避免在新的备份后使用缓存中旧的snapshot
+        """
+        kwargs = _global_opts(kwargs)
+        key = self._repo_key(kwargs)
+
+        def query_repo():
+            meta = self.metadata(**kwargs)
+            args = self._args("snapshots", kwargs) + ["--json"]
+            self.log.debug(f"start running command {args}")
+            snapshots = json.loads(sp.check_output(args, env=self._env)) or []
+            meta.put_snapshots(snapshots)
+            _restic_resolved[(key, "snapshots")] = snapshots
+            _restic_resolved[(key, "snapshots", "fresh")] = snapshots
+            return snapshots
+
+        def query():
+            if (snapshots := self.metadata(**kwargs).snapshots()) is not None:
+                return snapshots
+            return query_repo()
+
+        if fresh:
+            return self._resolve((key, "snapshots", "fresh"), query_repo)
+        return self._resolve((key, "snapshots"), query)
+
+    def find_snapshots(
+        self, snapshot_id="latest", fresh=False, **kwargs
+    ) -> List[Dict[str, Any]]:
+        """
+        在本地按snapshot_id(latest或id前缀)与host、path、tag参数过滤snapshots，按时间顺序。
+        fresh见snapshots()
+        """
+
+        def match(s: Dict[str, Any]) -> bool:
+            if snapshot_id != "latest" and not s["id"].startswith(snapshot_id):
+                return False
+            if (v := kwargs.get("host")) and s.get("hostname") != v:
+                return False
+            if (v := kwargs.get("path")) and v not in (s.get("paths") or []):
+                return False
+            if (v := kwargs.get("tag")) and not set(v.split(",")) <= set(
+                s.get("tags") or []
+            ):
+                return False
+            return True
+
+        return [s for s in self.snapshots(fresh=fresh, **kwargs) if match(s)]
+
+    def resolve_snapshot(self, snapshot_id="latest", **kwargs) -> str:
+        """
+        将latest或短id解析为完整的snapshot id。短id先在缓存的snapshots中查找，
+        未找到时重新查询仓库；latest总是使用当前进程中查询仓库的结果，不使用缓存
+        """
+        if re.fullmatch(r"[0-9a-f]{64}", snapshot_id):
+            return snapshot_id
+
+        def query():
+            latest = snapshot_id == "latest"
+            snapshots = self.find_snapshots(snapshot_id, fresh=latest, **kwargs)
+            if not snapshots and not latest:
+                snapshots = self.find_snapshots(snapshot_id, fresh=True, **kwargs)
+            if not snapshots:
+                raise SetupException(f"not found restic snapshot {snapshot_id}")
+            return snapshots[-1]["id"]
+
+        return self._resolve((self._repo_key(kwargs), "snapshot", snapshot_id), query)
+
+    def tree(self, snapshot_id: str, **kwargs) -> Dict[str, List[Any]]:
+        """
+        snapshot中所有的文件：restic路径 -> [type, size, mtime]。snapshot不会改变，
+        `restic ls`的结果一直缓存在SnapshotCache中
+        """
+        snapshot_id = self.resolve_snapshot(snapshot_id, **kwargs)
+        kwargs = _global_opts(kwargs)
+
+        def query():
+            meta = self.metadata(**kwargs)
+            if (entries := meta.tree(snapshot_id)) is not None:
+                return entries
+            args = self._args("ls", kwargs) + ["--json", snapshot_id]
+            self.log.debug(f"start running command {args}")
+            entries = {}
+            with sp.Popen(args, stdout=sp.PIPE, env=self._env) as p:
+                for line in p.stdout:
+                    node = json.loads(line)
+                    if node.get("struct_type", "node") == "node" and "path" in node:
+                        entries[node["path"]] = [
+                            node.get("type"),
+                            node.get("size", 0),
+                            node.get("mtime"),
+                        ]
+            if p.returncode != 0:
+                raise SetupException(f"restic ls {snapshot_id} exited {p.returncode}")
+            meta.put_tree(snapshot_id, entries)
+            return entries
+
+        return self._resolve((self._repo_key(kwargs), "tree", snapshot_id), query)
+
+    def _cached_tree(
+        self, snapshot_id: str, **kwargs
+    ) -> Optional[Dict[str, List[Any]]]:
+        """
+        已经缓存的完整snapshot id的文件列表，没有缓存时返回None，不会运行`restic ls`
+        """
+        kwargs = _global_opts(kwargs)
+        key = (self._repo_key(kwargs), "tree", snapshot_id)
+        with _restic_lock:
+            if (entries := _restic_resolved.get(key)) is not None:
+                return entries
+        if (entries := self.metadata(**kwargs).tree(snapshot_id)) is not None:
+            with _restic_lock:
+                _restic_resolved[key] = entries
+        return entries
+
+    def _known_missing(self, snapshot_id: str, file: Path, **kwargs) -> bool:
+        """
+        根据已经缓存的文件列表，file在snapshot中是否一定不存在
+        """
+        tree = self._cached_tree(snapshot_id, **kwargs)
+        return tree is not None and _restic_path(file) not in tree
+
+    def stat(
+        self, path: Path, snapshot_id="latest", **kwargs
+    ) -> Optional[Dict[str, Any]]:
+        """
+        snapshot中path的type、size与mtime，不存在时返回None
+        """
+        snapshot_id = self.resolve_snapshot(snapshot_id, **kwargs)
+        if (entry := self.tree(snapshot_id, **kwargs).get(_restic_path(path))) is None:
+            return None
+        return dict(zip(("type", "size", "mtime"), entry))
+
+    def exists(self, path: Path, snapshot_id="latest", **kwargs) -> bool:
+        return self.stat(path, snapshot_id, **kwargs) is not None
+
+    def latest_snapshot_with(self, path: Path, **kwargs) -> Optional[str]:
+        """
+        包含path的最新snapshot id，只检查备份路径包含path的snapshot，都不包含时返回None
+        """
+        rp = _restic_path(path)
+        for s in reversed(self.find_snapshots("latest", fresh=True, **kwargs)):
+            paths = [_restic_path(Path(p)) for p in s.get("paths") or []]
+            if not any(rp == p or rp.startswith(p.rstrip("/") + "/") for p in paths):
+                continue
+            if rp in self.tree(s["id"], **kwargs):
+                return s["id"]
+        return None
+
+    def dump_cache(self, **kwargs) -> Optional[DumpCache]:
+        if self._cache is None:
+            try:
+                self._cache = (
+                    DumpCache.from_env(self._env, lambda: self.repo_id(**kwargs))
+                    or False
+                )
+            except (sp.CalledProcessError, OSError, ValueError, KeyError) as e:
+                self.log.warning(f"disabled restic dump cache: {e}")
+                self._cache = False
+        return self._cache or None
 
     def dump(
         self, file: Path, snapshot_id="latest", **kwargs
+    ) -> Generator[bytes, None, None]:
+        """
+        dump snapshot中的文件。使用DumpCache时先将snapshot_id解析为完整的id，
+        命中时直接从本地缓存读取，不需要运行restic dump。解析latest在每个进程中
+        仍需要运行一次`restic snapshots`，见resolve_snapshot。
+
+        未命中时如果snapshot的文件列表已经缓存(见tree)且其中没有file，直接抛出
+        SetupException，不运行restic dump
+        """
+        if (cache := self.dump_cache(**kwargs)) is None:
+            yield from self._dump(file, snapshot_id, **kwargs)
+            return
+        snapshot_id = self.resolve_snapshot(snapshot_id, **kwargs)
+        if (data := cache.get(snapshot_id, str(file))) is not None:
+            yield from _iter_chunks(data)
+            return
+        if self._known_missing(snapshot_id, file, **kwargs):
+            raise SetupException(f"not found {file} in restic snapshot {snapshot_id}")
+        yield from cache.tee(
+            snapshot_id, str(file), self._dump(file, snapshot_id, **kwargs)
+        )
+
+    def _dump(
+        self, file: Path, snapshot_id="latest", **kwargs
     ) -> Generator[bytes, None, None]:
         chunk_size = 1024 * 4
-        args = [str(self._bin), "dump"]
-        for k, v in kwargs.items():
-            args += [f"--{k}", v]
-        args += [snapshot_id, str(file)]
+        args = self._args("dump", kwargs) + [snapshot_id, str(file)]
         self.log.debug(f"start running command {args}")
 
         with sp.Popen(args, stdout=sp.PIPE, text=False, env=self._env) as p:
@@ -303,11 +1014,104 @@ class Restic:
                 self.log.debug(
                     f"read the stdout of restic process {p.pid} for a total of {count} bytes"
                 )
+            # 失败时的输出不完整，不能作为文件内容缓存
+            if (code := p.wait()) != 0:
+                raise SetupException(f"restic dump {file} exited with code {code}")
+
+    def dump_many(
+        self,
+        files: Iterable[Path],
+        snapshot_id="latest",
+        chunk_size=1024 * 64,
+        **kwargs,
+    ) -> Generator[Tuple[Path, Iterator[bytes]], None, None]:
+        """
+        在一个restic进程中dump同一个snapshot中的多个文件，避免每个文件都重新打开仓库、
+        加载index与解密tree：将所有文件的公共父目录dump为tar流，只返回其中需要的文件。
+
+        按tar中的顺序返回(file, chunks)，chunks必须在获取下一个文件前读取，未读取的数据
+        会被跳过，不会缓存到内存中。所有文件都找到后结束restic进程，不存在的文件在最后
+        抛出SetupException。公共父目录下的其它文件也会从仓库读取，文件分散在不同目录时
+        可以分组调用。使用DumpCache时先返回命中缓存的文件，只dump其它的文件，
+        缓存的文件列表中不存在的文件不会dump
+        """
+        files = list(dict.fromkeys(Path(f) for f in files))
+        cache = self.dump_cache(**kwargs) if files else None
+        missing = []
+        if cache is not None:
+            snapshot_id = self.resolve_snapshot(snapshot_id, **kwargs)
+            misses = []
+            for file in files:
+                if (data := cache.get(snapshot_id, str(file))) is not None:
+                    yield file, _iter_chunks(data, chunk_size)
+                elif self._known_missing(snapshot_id, file, **kwargs):
+                    missing.append(file)
+                else:
+                    misses.append(file)
+            files = misses
+        if len(files) <= 1:
+            for file in files:
+                yield file, self.dump(file, snapshot_id, **kwargs)
+            if missing:
+                raise SetupException(
+                    f"not found {paths2str(missing)} in restic snapshot {snapshot_id}"
+                )
+            return
+
+        import posixpath
+        import tarfile
+
+        parent = os.path.commonpath([f.parent for f in files])
+        wanted = {f.as_posix().lstrip("/"): f for f in files}
+        parent_name = Path(parent).as_posix().lstrip("/")
+
+        args = self._args("dump", kwargs) + ["--archive", "tar", snapshot_id, parent]
+        self.log.debug(f"start running command {args} for {len(files)} files")
+
+        stopped = False
+        with sp.Popen(args, stdout=sp.PIPE, text=False, env=self._env) as p:
+            try:
+                with tarfile.open(fileobj=p.stdout, mode="r|") as tar:
+                    for member in tar:
+                        name = posixpath.normpath(member.name).lstrip("/")
+                        # 兼容相对于dump目录的成员名
+                        file = wanted.pop(name, None) or wanted.pop(
+                            posixpath.join(parent_name, name), None
+                        )
+                        if file is None:
+                            continue
+                        if not member.isfile():
+                            raise SetupException(
+                                f"{file} is not a regular file in restic snapshot {snapshot_id}"
+                            )
+                        chunks = _MemberChunks(tar.extractfile(member), chunk_size)
+                        try:
+                            if cache is not None:
+                                yield file, cache.tee(snapshot_id, str(file), chunks)
+                            else:
+                                yield file, chunks
+                        finally:
+                            chunks.close()
+                        if not wanted:
+                            break
+            finally:
+                if p.poll() is None:
+                    stopped = True
+                    p.kill()
+            code = p.wait()
+        if code != 0 and not stopped:
+            raise SetupException(f"restic dump {parent} exited with code {code}")
+        if missing := [*wanted.values(), *missing]:
+            raise SetupException(
+                f"not found {paths2str(missing)} in restic snapshot {snapshot_id}"
+            )
 
     def restore(
         self, target: Path, include_pats: List[str], snapshot_id="latest", **kwargs
     ):
-        args = ["sudo", "-E", str(self._bin), "restore", "--target", str(target)]
+        args = elevate.backend().wrap(
+            [str(self._bin), "restore", "--target", str(target)], keep_env=True
+        )
         if include_pats:
             for p in include_pats:
                 args += ["--include", p]
@@ -0,0 +1,201 @@
+import os
+import stat
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+
+class WalkCounters:
+    """
+    统计walk过程中的系统调用次数，用于对比不同walk方式的开销
+    """
+
+    __slots__ = ("scandir", "stat")
+
+    def __init__(self) -> None:
+        self.scandir = 0
+        self.stat = 0
+
+    def __repr__(self) -> str:
+        return f"WalkCounters(scandir={self.scandir}, stat={self.stat})"
+
+
+class Entry:
+    """
+    walk返回的目录项，缓存了stat结果与相对于root的路径。
+
+    类型判断优先使用scandir返回的d_type，不需要额外的stat
+    """
+
+    __slots__ = ("path", "rel", "name", "_dirent", "_lstat", "_stat", "_counters")
+
+    def __init__(
+        self,
+        dirent: Optional[os.DirEntry],
+        rel: str,
+        counters: WalkCounters,
+        path: str = None,
+    ) -> None:
+        self.path: str = dirent.path if dirent is not None else path
+        self.rel: str = rel
+        self.name: str = os.path.basename(self.path)
+        self._dirent = dirent
+        self._lstat: Optional[os.stat_result] = None
+        self._stat: Optional[os.stat_result] = None
+        self._counters = counters
+
+    @classmethod
+    def from_path(
+        cls, path: Union[str, Path], rel: str, counters: WalkCounters = None
+    ) -> "Entry":
+        """
+        不通过scandir创建entry，类型判断需要一次lstat
+        """
+        return cls(None, rel, counters or WalkCounters(), path=os.fspath(path))
+
+    def __repr__(self) -> str:
+        return f"Entry({self.rel!r})"
+
+    def as_path(self) -> Path:
+        return Path(self.path)
+
+    def is_symlink(self) -> bool:
+        if self._dirent is None:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        return self._dirent.is_symlink()
+
+    def is_dir(self) -> bool:
+        if self._dirent is None:
+            return stat.S_ISDIR(self.stat(follow_symlinks=False).st_mode)
+        return self._dirent.is_dir(follow_symlinks=False)
+
+    def is_file(self, follow_symlinks=True) -> bool:
+        if follow_symlinks and self.is_symlink():
+            try:
+                return stat.S_ISREG(self.stat().st_mode)
+            except OSError:
+                return False
+        elif self._dirent is None:
+            return stat.S_ISREG(self.stat(follow_symlinks=False).st_mode)
+        return self._dirent.is_file(follow_symlinks=False)
+
+    def stat(self, follow_symlinks=True) -> os.stat_result:
+        if self._lstat is None:
+            self._counters.stat += 1
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+            return self._lstat
+        if self._stat is None:
+            self._counters.stat += 1
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def _scan(dir: str, rel_dir: str, counters: WalkCounters) -> Iterator[Entry]:
+    counters.scandir += 1
+    try:
+        with os.scandir(dir) as it:
+            dirents = sorted(it, key=lambda d: d.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        # 与Path.rglob一样忽略无法读取的目录
+        return iter(())
+    return (Entry(d, rel_dir + d.name, counters) for d in dirents)
+
+
+def walk(
+    top: Union[str, Path],
+    root: Union[str, Path] = None,
+    prune: Callable[[Entry], bool] = None,
+    counters: WalkCounters = None,
+) -> Iterator[Entry]:
+    """
+    使用os.scandir先序遍历top下的所有文件与目录(不包含top)，与`Path.rglob("*")`
+    返回的路径一致，但每个目录只有一次scandir且不会跟随symlink目录。
+
+    同一个目录中按名称排序，所以遍历的顺序与按路径parts排序的顺序一致。
+    rel为相对于root(默认为top)的路径，prune对目录返回True时不再进入该目录
+    """
+    if counters is None:
+        counters = WalkCounters()
+    top = os.fspath(top)
+    root = top if root is None else os.fspath(root)
+    prefix = os.path.relpath(top, root)
+    prefix = "" if prefix == os.curdir else prefix + os.sep
+
+    stack = [_scan(top, prefix, counters)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        yield entry
+        if entry.is_dir() and not (prune and prune(entry)):
+            stack.append(_scan(entry.path, entry.rel + os.sep, counters))
+
+
+def collapse_subtrees(root: Path, paths: Iterable[Path]) -> List[Path]:
+    """
+    找到paths中在root下的最小子树集合：去重并合并嵌套的路径，按parts排序。
+    paths中存在root或root的祖先时返回[root]，不在root下的路径会被忽略
+    """
+    subtrees = []
+    for path in sorted(
+        {Path(os.path.abspath(p)) for p in paths}, key=lambda p: p.parts
+    ):
+        if path == root or path in root.parents:
+            return [root]
+        elif root not in path.parents:
+            continue
+        elif subtrees and subtrees[-1] in path.parents:
+            continue
+        subtrees.append(path)
+    return subtrees
+
+
+def walk_subtrees(
+    root: Union[str, Path],
+    subtrees: Iterable[Path],
+    counters: WalkCounters = None,
+) -> Iterator[Entry]:
+    """
+    遍历root下的subtrees，返回每个subtree本身(不是root时)与其中所有的目录项，
+    rel都相对于root。subtrees应该是collapse_subtrees的结果，这样返回的顺序与walk一致
+    """
+    if counters is None:
+        counters = WalkCounters()
+    root = os.fspath(root)
+    for subtree in subtrees:
+        subtree = os.fspath(subtree)
+        if subtree != root:
+            entry = Entry.from_path(subtree, os.path.relpath(subtree, root), counters)
+            try:
+                is_dir = entry.is_dir()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            yield entry
+            if not is_dir:
+                continue
+        yield from walk(subtree, root=root, counters=counters)
+
+
+def merge_sorted(
+    old: Iterable[Tuple[str, T]], new: Iterable[Tuple[str, U]]
+) -> Iterator[Tuple[str, Optional[T], Optional[U]]]:
+    """
+    合并两个按路径parts排序的(rel, value)序列，返回(rel, old value, new value)，
+    只在一边存在时另一边为None。两边都是流式读取
+    """
+    old, new = iter(old), iter(new)
+    o, n = next(old, None), next(new, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and o[0].split(os.sep) < n[0].split(os.sep)):
+            yield o[0], o[1], None
+            o = next(old, None)
+        elif o is None or n[0].split(os.sep) < o[0].split(os.sep):
+            yield n[0], None, n[1]
+            n = next(new, None)
+        else:
+            yield o[0], o[1], n[1]
+            o, n = next(old, None), next(new, None)
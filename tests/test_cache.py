@@ -0,0 +1,169 @@
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from dotutil_cz.cache import DigestCache, ScanCache
+from dotutil_cz.dotroot import PASSHOLE_TEMPLATE_PAT, find_template
+from dotutil_cz.state import StateStore
+from dotutil_cz.util import (
+    DIGEST_CACHE_NAME,
+    close_caches,
+    digest_cache,
+    get_digest,
+    state_store,
+)
+
+
+def _write_old(path: Path, data: str):
+    path.write_text(data)
+    # avoid racy timestamps skipped by the cache
+    os.utime(path, ns=(10**18, 10**18))
+
+
+def test_digest_cache():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        cache_path = dir.joinpath("digests.json")
+        a, b = dir.joinpath("a"), dir.joinpath("b")
+        _write_old(a, "a")
+        _write_old(b, "b")
+
+        cache = DigestCache(cache_path, max_entries=1)
+        digest = get_digest(a, cache=cache)
+        assert cache.get(a.stat()) == digest
+        get_digest(b, cache=cache)
+        # evicted by lru
+        assert cache.get(a.stat()) is None
+        cache.save()
+
+        cache = DigestCache(cache_path)
+        assert len(cache) == 1
+        assert cache.get(b.stat()) == get_digest(b)
+
+        _write_old(b, "bb")
+        assert cache.get(b.stat()) is None
+        assert get_digest(b, cache=cache) != digest
+
+
+def test_close_caches(monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        dirs = [Path(dir, "1"), Path(dir, "2")]
+        for d in dirs:
+            d.mkdir()
+            monkeypatch.setenv("CHEZMOI_CACHE_DIR", str(d))
+            a = d.joinpath("a")
+            _write_old(a, d.name)
+            get_digest(a)
+            state_store(d).add_skipped([a])
+            close_caches()
+            # 每个缓存目录保存自己的状态
+            assert DigestCache(d.joinpath(DIGEST_CACHE_NAME)).get(a.stat())
+            assert state_store(d).skipped() == {a}
+            close_caches()
+        assert digest_cache() is not None
+        close_caches()
+
+
+def test_scan_cache():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        a, b, c = dir.joinpath("a.tmpl"), dir.joinpath("b.tmpl"), dir.joinpath("c.tmpl")
+        _write_old(a, "{{ .chezmoi.os }}\n")
+        _write_old(b, 'x\n{{ passhole "entry" "password" }}\n')
+        _write_old(c, '{{- includeTemplate "restic-dump" . -}}')
+
+        cache = ScanCache(dir.joinpath("scan.json"), "tag")
+        assert find_template([a, b, c], PASSHOLE_TEMPLATE_PAT, cache) == b
+        assert find_template([c, a], PASSHOLE_TEMPLATE_PAT, cache, workers=1) == c
+        assert find_template([a], PASSHOLE_TEMPLATE_PAT, cache) is None
+        assert cache.get(a, os.stat(a)) is False
+        cache.save()
+
+        # 使用缓存的结果，不会重新读取文件
+        cache = ScanCache(dir.joinpath("scan.json"), "tag")
+        assert len(cache) == 3
+        a.chmod(0)
+        if os.geteuid() != 0:
+            assert find_template([a, b], PASSHOLE_TEMPLATE_PAT, cache) == b
+        # 文件改变后重新扫描
+        a.chmod(0o644)
+        _write_old(a, '{{ passhole "a" "b" }}')
+        assert cache.get(a, os.stat(a)) is None
+        assert find_template([a, b], PASSHOLE_TEMPLATE_PAT, cache) == a
+        # tag不同时全部失效
+        assert len(ScanCache(dir.joinpath("scan.json"), "other")) == 0
+
+        # 保存时删除已经不存在的文件
+        c.unlink()
+        cache.save()
+        cache = ScanCache(dir.joinpath("scan.json"), "tag")
+        assert len(cache) == 2
+
+
+def test_state_store():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        mapped, root = dir.joinpath("mapped"), dir.joinpath("root")
+        _write_old(mapped, "a")
+        _write_old(root, "a")
+        # 旧的rootlist
+        rootlist = dir.joinpath(".root")
+        rootlist.write_text("/home/u/.root/etc/a\n\n/home/u/.root/etc/b\n")
+
+        store = StateStore(dir.joinpath("state.db"))
+        store.migrate(rootlist)
+        assert not rootlist.exists()
+        assert not store.unchanged("a", mapped.stat(), root.stat())
+        store.put("a", mapped.stat(), root.stat(), "digest")
+        assert store.skipped() == {
+            Path("/home/u/.root/etc/a"),
+            Path("/home/u/.root/etc/b"),
+        }
+        assert store.unchanged("a", mapped.stat(), root.stat())
+        row = store.get("a")
+        assert row.pop("applied_at") > 0
+        assert row == {
+            "mapped": DigestCache.key(mapped.stat()),
+            "root": DigestCache.key(root.stat()),
+            "digest": "digest",
+            "mode": root.stat().st_mode,
+            "uid": root.stat().st_uid,
+            "gid": root.stat().st_gid,
+        }
+
+        store.remove_skipped([Path("/home/u/.root/etc/a")])
+        store.add_skipped([Path("/home/u/.root/etc/c")])
+        store.put(os.path.join("x", "b"), mapped.stat(), root.stat())
+        store.put(os.path.join("y", "c"), mapped.stat(), root.stat())
+        store.retain(["a"], scopes=["x"])
+        store.save()
+        store.close()
+
+        store = StateStore(dir.joinpath("state.db"))
+        assert store.skipped() == {
+            Path("/home/u/.root/etc/b"),
+            Path("/home/u/.root/etc/c"),
+        }
+        assert os.path.join("x", "b") not in store
+        assert os.path.join("y", "c") in store
+        assert len(store) == 2
+        # drift in root
+        _write_old(root, "ab")
+        assert not store.unchanged("a", mapped.stat(), root.stat())
+        store.close()
+
+
+def test_state_store_metadata(caplog):
+    with tempfile.TemporaryDirectory() as dir:
+        store = StateStore(Path(dir).joinpath("state.db"))
+        mapped = {"dev": 1, "ino": 2, "size": 3, "mtime_ns": 4, "ctime_ns": 5}
+        root = dict(mapped, ino=6, mode=0o100644, uid=0, gid=0)
+        store.put("a", mapped, root)
+        assert store.unchanged("a", mapped, root)
+        # root文件的mode或owner改变时重新比较
+        assert not store.unchanged("a", mapped, dict(root, mode=0o100600))
+        with caplog.at_level(logging.WARNING):
+            assert not store.unchanged("a", mapped, dict(root, uid=1000))
+        assert "owner of root file a changed from 0:0 to 1000:0" in caplog.text
+        store.close()
@@ -0,0 +1,264 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from dotutil_cz import SetupException, elevate
+from dotutil_cz.cache import MappedManifest
+from dotutil_cz.dotroot import (
+    RemovalPolicy,
+    RootCleaner,
+    check_restic,
+    copy_to_root,
+)
+from dotutil_cz.preflight import Preflight
+from dotutil_cz.source_state import SourceStateIndex
+from dotutil_cz.state import StateStore
+
+
+def test_find_removable_mapped_paths():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        mapped_root = dir.joinpath("home", ".root")
+        cache = dir.joinpath("cache")
+        cache.mkdir()
+        # root中的目录与对应的映射目录
+        root = dir.joinpath("rootside")
+        mapped = mapped_root.joinpath(str(root).lstrip("/"))
+        for d in [root, mapped]:
+            d.joinpath("sub").mkdir(parents=True)
+            for name in ["a", "b", os.path.join("sub", "c")]:
+                d.joinpath(name).write_text(name)
+        # root目录为exact
+        src = dir.joinpath("src")
+        src.joinpath("dot_root", *root.parent.parts[1:], "exact_rootside").mkdir(
+            parents=True
+        )
+        index = SourceStateIndex.build(src)
+
+        def cleaner():
+            return RootCleaner(
+                mapped_root, cache.joinpath(".root"), "false", src, source_index=index
+            )
+
+        c = cleaner()
+        assert c.find_removable_mapped_paths(set()) == set()
+        c.clean(set())
+
+        # 被chezmoi删除的映射文件
+        mapped.joinpath("b").unlink()
+        shutil.rmtree(mapped.joinpath("sub"))
+        # exact目录中多余的root文件
+        root.joinpath("extra").write_text("")
+
+        c = cleaner()
+        # target之外被删除的文件不会删除，exact目录中多余的仍会删除
+        assert c.find_removable_mapped_paths({mapped.joinpath("a")}) == {
+            mapped.joinpath("b"),
+            mapped.joinpath("sub"),
+            mapped.joinpath("extra"),
+        }
+        c._manifest.discard()
+        assert c.find_removable_mapped_paths(set()) == {
+            mapped.joinpath("b"),
+            mapped.joinpath("sub", "c"),
+            mapped.joinpath("sub"),
+            mapped.joinpath("extra"),
+        }
+
+
+def test_confirm_rm_policy():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        paths = {
+            dir.joinpath("a", "x"),
+            dir.joinpath("a", "keep", "y"),
+            dir.joinpath("b", "z.bak"),
+            dir.joinpath("b", "w"),
+        }
+        for p in paths:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_text("")
+        policy = RemovalPolicy(
+            allow=["*.bak"],
+            remove_under=[dir.joinpath("a")],
+            never_under=[dir.joinpath("a", "keep")],
+            default=RemovalPolicy.SKIP,
+        )
+        assert policy.decide(dir.joinpath("a")) == RemovalPolicy.REMOVE
+        assert policy.decide(dir.joinpath("a", "keep")) == RemovalPolicy.SKIP
+        assert RemovalPolicy().decide(dir) == RemovalPolicy.ASK
+
+        cleaner = RootCleaner(
+            dir.joinpath("home", ".root"),
+            dir.joinpath("cache", ".root"),
+            "false",
+            dir.joinpath("src"),
+            policy=policy,
+        )
+        missing = dir.joinpath("a", "missing")
+        removed = cleaner.confirm_rm(paths | {missing})
+        assert removed == {dir.joinpath("a", "x"), dir.joinpath("b", "z.bak"), missing}
+        assert {p for p in paths if p.exists()} == paths - removed
+
+
+def test_copy_to_root_with_root():
+    elevate.set_backend(elevate.FakeBackend())
+    try:
+        with tempfile.TemporaryDirectory() as dir:
+            dir = Path(dir)
+            mapped_root = dir.joinpath("home", ".root")
+            root = dir.joinpath("root")
+            mapped_root.joinpath("etc").mkdir(parents=True)
+            root.joinpath("etc").mkdir(parents=True)
+            for name in ["a", "b"]:
+                mapped_root.joinpath("etc", name).write_text(name)
+            root.joinpath("etc", "a").write_text("a")
+            state = StateStore(dir.joinpath("state.db"))
+
+            copy_to_root(mapped_root, journal=state, root=root)
+            assert root.joinpath("etc", "b").read_text() == "b"
+            assert len(state) == 2
+
+            src = dir.joinpath("src")
+            src.mkdir()
+
+            def cleaner():
+                return RootCleaner(
+                    mapped_root,
+                    dir.joinpath(".root"),
+                    "false",
+                    src,
+                    source_index=SourceStateIndex.build(src),
+                    manifest=MappedManifest(dir.joinpath("manifest.jsonl")),
+                    state=state,
+                    policy=RemovalPolicy(default=RemovalPolicy.REMOVE),
+                    root=root,
+                )
+
+            cleaner().clean(set())
+            # 映射文件被删除后从root中删除
+            mapped_root.joinpath("etc", "b").unlink()
+            cleaner().clean(set())
+            assert not root.joinpath("etc", "b").exists()
+            assert root.joinpath("etc", "a").exists()
+            state.close()
+    finally:
+        elevate.set_backend(None)
+
+
+def test_copy_to_root_through_links():
+    elevate.set_backend(elevate.FakeBackend())
+    try:
+        with tempfile.TemporaryDirectory() as dir:
+            dir = Path(dir)
+            mapped_root = dir.joinpath("home", ".root")
+            root = dir.joinpath("root")
+            mapped_root.joinpath("etc").mkdir(parents=True)
+            root.joinpath("etc").mkdir(parents=True)
+            root.joinpath("run").mkdir()
+            # root中的symlink与硬链接
+            root.joinpath("run", "resolv.conf").write_text("old")
+            root.joinpath("etc", "resolv.conf").symlink_to("../run/resolv.conf")
+            root.joinpath("etc", "hosts").write_text("old")
+            os.link(root.joinpath("etc", "hosts"), root.joinpath("etc", "hosts.link"))
+            for name in ["resolv.conf", "hosts", "secret"]:
+                p = mapped_root.joinpath("etc", name)
+                p.write_text("new")
+                p.chmod(0o600)
+
+            copy_to_root(mapped_root, journal=None, root=root)
+            # 写入symlink指向的文件，不替换symlink
+            assert root.joinpath("etc", "resolv.conf").is_symlink()
+            assert root.joinpath("run", "resolv.conf").read_text() == "new"
+            # 不拆分硬链接
+            assert root.joinpath("etc", "hosts.link").read_text() == "new"
+            assert root.joinpath("etc", "hosts").stat().st_nlink == 2
+            assert root.joinpath("etc", "secret").stat().st_mode & 0o777 == 0o600
+            assert [
+                p.name for p in root.joinpath("etc").iterdir() if ".tmp" in p.name
+            ] == []
+    finally:
+        elevate.set_backend(None)
+
+
+def test_clean_private_root_paths(monkeypatch):
+    elevate.set_backend(elevate.FakeBackend())
+    try:
+        with tempfile.TemporaryDirectory() as dir:
+            dir = Path(dir)
+            mapped_root = dir.joinpath("home", ".root")
+            root = dir.joinpath("root")
+            src = dir.joinpath("src")
+            src.mkdir()
+            for d in [mapped_root, root]:
+                d.joinpath("etc", "private").mkdir(parents=True)
+                for name in ["a", "b"]:
+                    d.joinpath("etc", "private", name).write_text(name)
+            state = StateStore(dir.joinpath("state.db"))
+
+            def cleaner():
+                return RootCleaner(
+                    mapped_root,
+                    dir.joinpath(".root"),
+                    "false",
+                    src,
+                    source_index=SourceStateIndex.build(src),
+                    manifest=MappedManifest(dir.joinpath("manifest.jsonl")),
+                    state=state,
+                    policy=RemovalPolicy(default=RemovalPolicy.REMOVE),
+                    root=root,
+                )
+
+            cleaner().clean(set())
+            mapped_root.joinpath("etc", "private", "a").unlink()
+
+            # 当前用户无法访问的root目录，只能由worker检查与删除
+            private = str(root.joinpath("etc", "private")) + os.sep
+
+            def denied(fn):
+                def f(path, *args, **kwargs):
+                    if os.fspath(path).startswith(private):
+                        raise PermissionError(13, "Permission denied", path)
+                    return fn(path, *args, **kwargs)
+
+                return f
+
+            monkeypatch.setattr(os, "stat", denied(os.stat))
+            monkeypatch.setattr(os, "lstat", denied(os.lstat))
+            cleaner().clean(set())
+            monkeypatch.undo()
+
+            assert not root.joinpath("etc", "private", "a").exists()
+            assert root.joinpath("etc", "private", "b").exists()
+            assert state.skipped() == set()
+            state.close()
+    finally:
+        elevate.set_backend(None)
+
+
+class _Args:
+    def __init__(self, data, target_paths):
+        self._data = data
+        self._target_paths = target_paths
+
+    def data(self):
+        return self._data
+
+    def target_paths(self):
+        return self._target_paths
+
+
+def test_check_restic():
+    with tempfile.TemporaryDirectory() as dir:
+        bin = Path(dir).joinpath("restic")
+        args = _Args({"has_restic": True, "restic": {"path": str(bin)}}, [])
+        # 在Preflight线程中失败时抛出SetupException而不是退出进程
+        with pytest.raises(SetupException, match="not found restic bin"):
+            Preflight([("restic", lambda: check_restic(args))]).run()
+
+        Preflight([("restic", lambda: check_restic(_Args(args.data(), [bin])))]).run()
+        bin.touch()
+        Preflight([("restic", lambda: check_restic(args))]).run()
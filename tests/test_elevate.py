@@ -1,4 +1,10 @@
+import hashlib
 import subprocess as sp
+import tarfile
+import tempfile
+from pathlib import Path
+
+import pytest
 
 from dotutil_cz import elevate
 
@@ -25,3 +31,79 @@ for line in s.splitlines():
         res = p.stdout.readlines()
         assert list(map(lambda s: s.rstrip(), res)) == data.splitlines()
         assert p.wait() == 0
+
+
+@pytest.fixture(params=["subprocess", "in_process"])
+def w(request):
+    if request.param == "subprocess":
+        w = elevate.ElevatedWorker(elevate.FakeBackend())
+    else:
+        w = elevate.InProcessWorker()
+    yield w
+    w.close()
+
+
+def test_worker(w):
+    with tempfile.TemporaryDirectory() as dir:
+        src = Path(dir).joinpath("a.txt")
+        src.write_text("worker")
+        dst = Path(dir).joinpath("b", "c.txt")
+        w.copy(src, dst)
+        assert dst.read_text() == "worker"
+        assert w.exists(dst)
+        assert w.stat(dst)["size"] == len("worker")
+        assert w.hash(dst) == hashlib.sha256(b"worker").hexdigest()
+        assert w.remove(dst.parent)
+        assert w.stat(dst) is None
+
+        # 写入失败时仍然读完数据，不影响后续请求
+        with open(src, "rb") as f, pytest.raises(elevate.ElevateWorkerError) as e:
+            w.write(dst, f)
+        assert e.value.type_name == "FileNotFoundError"
+        with open(src, "rb") as f:
+            w.write(Path(dir).joinpath("d.txt"), f)
+        assert Path(dir).joinpath("d.txt").read_text() == "worker"
+
+
+def test_worker_extract(w):
+    with tempfile.TemporaryDirectory() as dir:
+        src = Path(dir).joinpath("a.txt")
+        src.write_text("extract")
+        src.chmod(0o600)
+        root = Path(dir).joinpath("root")
+
+        def write_tar(f):
+            with tarfile.open(fileobj=f, mode="w|") as tar:
+                tar.add(src, arcname="etc/a.txt")
+                tar.add(src, arcname="../b.txt")
+
+        res = w.extract(root, write_tar)
+        assert res[0]["name"] == "etc/a.txt"
+        assert res[0]["stat"]["mode"] & 0o777 == 0o600
+        assert root.joinpath("etc", "a.txt").read_text() == "extract"
+        assert "error" in res[1]
+        assert not Path(dir).joinpath("b.txt").exists()
+
+
+def test_backend(monkeypatch):
+    monkeypatch.setenv("DOTUTIL_CZ_ELEVATE", "fake")
+    monkeypatch.setattr(elevate, "_backend", None)
+    assert isinstance(elevate.backend(), elevate.FakeBackend)
+    assert elevate.backend() is elevate.backend()
+
+    monkeypatch.setenv("DOTUTIL_CZ_ELEVATE", "unknown")
+    with pytest.raises(elevate.ElevateExcetion):
+        elevate._select_backend()
+    monkeypatch.setenv("DOTUTIL_CZ_ELEVATE", "direct")
+    b = elevate._select_backend()
+    assert isinstance(b.worker(), elevate.InProcessWorker)
+    assert b.check_args() is None
+
+    sudo = elevate.SudoBackend("/usr/bin/sudo")
+    assert sudo.wrap(["restic"], keep_env=True, non_interactive=True) == [
+        "/usr/bin/sudo",
+        "-n",
+        "-E",
+        "restic",
+    ]
+    assert elevate.DoasBackend("doas").wrap(["ls"], keep_env=True) == ["doas", "ls"]
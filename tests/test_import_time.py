@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess as sp
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+
+# hook中不应该导入的重量级模块
+HEAVY_MODULES = [
+    "psutil",
+    "docker",
+    "dotenv",
+    "urllib.request",
+    "tarfile",
+    "concurrent.futures",
+    "cryptography",
+]
+HOOK_MODULES = ["dotutil_cz.hooks", "dotutil_cz.dotroot"]
+# 导入时间与机器相关，只在设置env DOTUTIL_CZ_IMPORT_BUDGET_MS时检查
+IMPORT_BUDGET_MS = os.environ.get("DOTUTIL_CZ_IMPORT_BUDGET_MS")
+
+
+def run_python(code: str, *opts: str) -> sp.CompletedProcess:
+    env = os.environ.copy()
+    # 与安装后一样使用pyc
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(ROOT), env.get("PYTHONPATH")])
+    )
+    return sp.run(
+        [sys.executable, *opts, "-c", code],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        text=True,
+        env=env,
+        check=True,
+    )
+
+
+def import_time_ms(module: str) -> float:
+    """
+    使用`python -X importtime`获取module的累计导入时间
+    """
+    p = run_python(f"import {module}", "-X", "importtime")
+    for line in p.stderr.splitlines():
+        if (
+            line.startswith("import time:")
+            and line.rsplit("|", 1)[-1].strip() == module
+        ):
+            return int(line.split("|")[1]) / 1000
+    raise AssertionError(f"not found import time of {module}: {p.stderr}")
+
+
+def test_hook_lazy_imports():
+    code = f"""
+import json, sys
+for m in {HOOK_MODULES!r}:
+    __import__(m)
+print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))
+"""
+    assert json.loads(run_python(code).stdout) == []
+
+
+@pytest.mark.skipif(
+    IMPORT_BUDGET_MS is None, reason="DOTUTIL_CZ_IMPORT_BUDGET_MS is not set"
+)
+def test_hook_import_budget():
+    budget = float(IMPORT_BUDGET_MS)
+    for module in HOOK_MODULES:
+        # 第一次可能需要编译pyc
+        best = min(import_time_ms(module) for _ in range(3))
+        assert (
+            best <= budget
+        ), f"importing {module} took {best:.1f}ms over budget {budget}ms"
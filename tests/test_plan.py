@@ -0,0 +1,137 @@
+import json
+import subprocess as sp
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from dotutil_cz import SetupException
+from dotutil_cz.cache import MappedManifest
+from dotutil_cz.dotroot import RemovalPolicy, RootCleaner, copy_to_root
+from dotutil_cz.plan import Plan
+from dotutil_cz.source_state import SourceStateIndex
+from dotutil_cz.state import StateStore
+
+
+def test_plan_phase():
+    plan = Plan(fmt="json")
+    with plan.phase("check"):
+        sp.check_call([sys.executable, "-c", ""])
+    with plan.phase("check"):
+        pass
+    plan.add("remove-root", "/a")
+
+    data = json.loads(plan.report())
+    assert data["phases"]["check"]["subprocesses"] == 1
+    assert data["subprocesses"] == 1
+    assert data["actions"] == [{"action": "remove-root", "src": "/a", "dst": None}]
+
+
+def test_copy_to_root_dry_run():
+    with tempfile.TemporaryDirectory() as dir:
+        mapped_root = Path(dir).joinpath(".root")
+        # mapped to a root path that does not exist
+        missing = Path(dir).joinpath("missing", "a.conf")
+        mapped = mapped_root.joinpath(str(missing).lstrip("/"))
+        mapped.parent.mkdir(parents=True)
+        mapped.write_text("a")
+
+        plan = Plan()
+        copy_to_root(mapped_root, plan=plan)
+        assert plan.actions == [
+            {"action": "copy-to-root", "src": str(mapped), "dst": str(missing)}
+        ]
+        assert set(plan.phases) == {"walk", "elevate", "compare"}
+        assert not missing.exists()
+        assert "copy-to-root" in plan.report()
+
+
+class _ReadOnlyManifest(MappedManifest):
+    def write(self, entries):
+        raise AssertionError("manifest written in dry run")
+
+
+def test_clean_dry_run():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        mapped_root = dir.joinpath("home", ".root")
+        root = dir.joinpath("root")
+        cache = dir.joinpath("cache")
+        src = dir.joinpath("src")
+        src.mkdir()
+        for d in [mapped_root, root]:
+            d.joinpath("etc").mkdir(parents=True)
+            d.joinpath("etc", "a").write_text("a")
+        state = StateStore(cache.joinpath("state.db"))
+
+        def clean(plan=None, manifest=MappedManifest):
+            RootCleaner(
+                mapped_root,
+                cache.joinpath(".root"),
+                "false",
+                src,
+                source_index=SourceStateIndex.build(src),
+                manifest=manifest(cache.joinpath("manifest.jsonl")),
+                state=state,
+                policy=RemovalPolicy(default=RemovalPolicy.REMOVE),
+                root=root,
+            ).clean(set(), plan=plan)
+
+        clean()
+        mapped_root.joinpath("etc", "a").unlink()
+        names = sorted(p.name for p in cache.iterdir())
+        data = cache.joinpath("manifest.jsonl").read_bytes()
+
+        # 只计算需要删除的文件，不会写入新的清单
+        plan = Plan()
+        clean(plan, _ReadOnlyManifest)
+        assert plan.actions == [
+            {
+                "action": "remove-root",
+                "src": str(root.joinpath("etc", "a")),
+                "dst": None,
+            }
+        ]
+        assert sorted(p.name for p in cache.iterdir()) == names
+        assert cache.joinpath("manifest.jsonl").read_bytes() == data
+        assert root.joinpath("etc", "a").exists()
+        state.close()
+
+
+def test_plan_from_env(monkeypatch):
+    monkeypatch.setenv("DOTUTIL_CZ_PLAN", "yaml")
+    with pytest.raises(SetupException):
+        Plan.from_env()
+    monkeypatch.setenv("DOTUTIL_CZ_PLAN", "1")
+    assert Plan.from_env().fmt == "human"
+
+
+def test_state_store_dry_run():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        rootlist = dir.joinpath(".root")
+        rootlist.write_text("/home/u/.root/etc/a\n")
+
+        # 不存在时不会创建
+        store = StateStore(dir.joinpath("state.db"), dry_run=True)
+        store.migrate(rootlist)
+        assert store.skipped() == {Path("/home/u/.root/etc/a")}
+        store.close()
+        assert rootlist.exists()
+        assert not dir.joinpath("state.db").exists()
+
+        store = StateStore(dir.joinpath("state.db"))
+        store.add_skipped([Path("/b")])
+        store.close()
+        data = dir.joinpath("state.db").read_bytes()
+
+        # 读取已有的状态，写入只在内存中
+        store = StateStore(dir.joinpath("state.db"), dry_run=True)
+        store.migrate(rootlist)
+        store.remove_skipped([Path("/b")])
+        store.save()
+        store.close()
+        assert rootlist.exists()
+        assert dir.joinpath("state.db").read_bytes() == data
+        assert StateStore(dir.joinpath("state.db")).skipped() == {Path("/b")}
@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from dotutil_cz import SetupException
+from dotutil_cz.preflight import Preflight, interactive
+
+
+def test_preflight_concurrent():
+    barrier = threading.Barrier(3, timeout=5)
+    events = []
+
+    def check(name, delay):
+        def f():
+            # 所有检查同时开始
+            barrier.wait()
+            time.sleep(delay)
+            with interactive():
+                events.append(f"{name}-start")
+                time.sleep(0.05)
+                events.append(f"{name}-end")
+
+        return f
+
+    Preflight(
+        [("a", check("a", 0.2)), ("b", check("b", 0)), ("c", check("c", 0))]
+    ).run()
+    # 交互按顺序串行执行
+    assert events == ["a-start", "a-end", "b-start", "b-end", "c-start", "c-end"]
+
+
+def test_preflight_errors():
+    prompted = []
+
+    def fail(msg, delay=0):
+        def f():
+            time.sleep(delay)
+            raise SetupException(msg)
+
+        return f
+
+    def prompt():
+        with interactive():
+            prompted.append(True)
+
+    with pytest.raises(SetupException, match="first"):
+        Preflight(
+            [
+                ("a", fail("first", 0.1)),
+                ("b", prompt),
+                ("c", fail("second")),
+            ]
+        ).run()
+    # 前面的检查失败时不会再提示
+    assert not prompted
+
+    with pytest.raises(SystemExit):
+        Preflight([("a", lambda: exit(1)), ("b", lambda: None)]).run()
+
+    with interactive():
+        prompted.append(True)
+    assert prompted
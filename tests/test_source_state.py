@@ -0,0 +1,114 @@
+import os
+import tempfile
+from pathlib import Path
+
+from dotutil_cz.source_state import (
+    SourceStateIndex,
+    decode_dir,
+    decode_file,
+    ignore_patterns,
+)
+
+
+def test_decode():
+    assert decode_dir("exact_private_dot_root") == (
+        ".root",
+        "dir",
+        frozenset({"exact", "private"}),
+    )
+    assert decode_dir("dot_config") == (".config", "dir", frozenset())
+    assert decode_dir("literal_dot_x") == ("dot_x", "dir", frozenset())
+    assert decode_file("private_executable_dot_foo.sh.tmpl") == (
+        ".foo.sh",
+        "file",
+        frozenset({"private", "executable", "template"}),
+    )
+    assert decode_file("encrypted_dot_key.age") == (
+        ".key",
+        "file",
+        frozenset({"encrypted"}),
+    )
+    assert decode_file("symlink_dot_vimrc") == (".vimrc", "symlink", frozenset())
+    assert decode_file("modify_dot_bashrc") == (".bashrc", "modify", frozenset())
+    assert decode_file("x.tmpl.literal") == ("x.tmpl", "file", frozenset())
+    assert decode_file("run_once_before_setup.sh")[0] is None
+
+
+def test_source_state_index():
+    with tempfile.TemporaryDirectory() as dir:
+        src = Path(dir).joinpath("src")
+        cache = Path(dir).joinpath("index.json")
+        src.joinpath("dot_root", "exact_etc", "private_ssh").mkdir(parents=True)
+        src.joinpath("dot_root", "exact_etc", "hosts.tmpl").touch()
+        src.joinpath("dot_git").mkdir()
+        src.joinpath("dot_git", "config").touch()
+        src.joinpath(".git", "exact_objects").mkdir(parents=True)
+        src.joinpath(".chezmoiignore").touch()
+        src.joinpath("run_once_setup.sh").touch()
+
+        index = SourceStateIndex.load(src, cache)
+        assert cache.is_file()
+        assert len(index) == 6
+        etc = os.path.join(".root", "etc")
+        assert index.get(etc).is_exact()
+        assert index.get(".root/etc/") is index.get(etc)
+        assert not index.get(os.path.join(etc, "ssh")).is_exact()
+        assert index.get(os.path.join(etc, "hosts")).attrs == {"template"}
+        assert index.source_path(os.path.join(".git", "config")) == src.joinpath(
+            "dot_git", "config"
+        )
+        assert index.get(".git/objects") is None
+        assert index.get("setup.sh") is None
+
+        # 未改变时从缓存加载
+        cached = SourceStateIndex.load(src, cache)
+        assert cached.get(etc).is_exact()
+        assert len(cached) == len(index)
+
+        # 目录mtime改变时重新构建
+        src.joinpath("dot_root", "exact_etc", "exact_var").mkdir()
+        st = os.stat(src.joinpath("dot_root", "exact_etc"))
+        os.utime(
+            src.joinpath("dot_root", "exact_etc"),
+            ns=(st.st_atime_ns, st.st_mtime_ns + 10**9),
+        )
+        index = SourceStateIndex.load(src, cache)
+        assert len(index) == 7
+        assert index.get(os.path.join(etc, "var")).is_exact()
+
+
+def test_chezmoiignore():
+    assert ignore_patterns("# x\n.root/etc/hosts\n\n!*.txt # y\n") == [
+        ".root/etc/hosts",
+        "*.txt",
+    ]
+    assert ignore_patterns('{{ if ne .chezmoi.os "linux" }}\n.x\n{{ end }}') == [".x"]
+    assert ignore_patterns("{{ .name }}/config") is None
+
+    with tempfile.TemporaryDirectory() as dir:
+        src = Path(dir).joinpath("src")
+        cache = Path(dir).joinpath("index.json")
+        src.joinpath("dot_root", "exact_etc", "private_ssh").mkdir(parents=True)
+        src.joinpath("dot_root", "exact_etc", "hosts").touch()
+        src.joinpath("dot_git").mkdir()
+        src.joinpath("dot_git", "config").touch()
+        src.joinpath(".chezmoiignore").write_text(
+            '{{ if ne .chezmoi.os "linux" }}\n.root/etc/ssh\n{{ end }}\n'
+        )
+        src.joinpath("dot_git", ".chezmoiignore").write_text("config\n")
+
+        index = SourceStateIndex.load(src, cache)
+        etc = os.path.join(".root", "etc")
+        assert index.get(etc).is_exact()
+        assert index.get(os.path.join(etc, "hosts")) is not None
+        assert index.get(os.path.join(etc, "ssh")) is None
+        assert index.get(".git") is not None
+        assert index.get(os.path.join(".git", "config")) is None
+
+        # .chezmoiignore改变时重新构建
+        ignore = src.joinpath(".chezmoiignore")
+        ignore.write_text("{{ .dir }}/x\n")
+        st = os.stat(ignore)
+        os.utime(ignore, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        index = SourceStateIndex.load(src, cache)
+        assert len(index) == 0
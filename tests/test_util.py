@@ -1,9 +1,26 @@
+import os
+import shutil
+import subprocess as sp
+import sys
 import tempfile
+import time
+from io import BytesIO
 from pathlib import Path
 
 import psutil
+import pytest
 
-from dotutil_cz.util import elevate_writefile
+from dotutil_cz import SetupException, elevate
+from dotutil_cz.cache import DumpCache
+from dotutil_cz.util import (
+    ChezmoiArgs,
+    Restic,
+    _restic_resolved,
+    elevate_writefile,
+    has_changed,
+    ordered_map,
+    same_content,
+)
 
 # class ChezmoiArgsTest(TestCase):
 #     def test_args(self):
@@ -45,3 +62,440 @@ def test_elevate_writefile():
         if psutil.LINUX:
             assert path.stat().st_uid == 0
         assert path.read_text() == input
+
+
+@pytest.fixture(params=[elevate.FakeBackend(), elevate.DirectBackend()], ids=repr)
+def backend(request):
+    elevate.set_backend(request.param)
+    yield request.param
+    elevate.set_backend(None)
+
+
+def test_elevate_writefile_sources(backend):
+    data = os.urandom(3 * 1024 * 1024 + 1)
+    with tempfile.TemporaryDirectory() as dir:
+        src = Path(dir).joinpath("src")
+        src.write_bytes(data)
+        dst = Path(dir).joinpath("dst")
+
+        elevate_writefile(str(dst), src)
+        assert dst.read_bytes() == data
+        elevate_writefile(str(dst), b"bytes")
+        assert dst.read_bytes() == b"bytes"
+        elevate_writefile(str(dst), open(src, "rb"))
+        assert dst.read_bytes() == data
+        elevate_writefile(str(dst), BytesIO(data), chunk_size=4096)
+        assert dst.read_bytes() == data
+
+        # pipe
+        with sp.Popen(["cat", str(src)], stdout=sp.PIPE, bufsize=0) as p:
+            elevate_writefile(str(dst), p.stdout)
+        assert dst.read_bytes() == data
+
+        with pytest.raises(SetupException):
+            elevate_writefile(str(dst), Path(dir).joinpath("missing"))
+        assert dst.read_bytes() == data
+
+        # 当前用户无法读取的源文件不会通过worker读取
+        if os.geteuid() != 0:
+            private = Path(dir).joinpath("private")
+            private.write_bytes(b"secret")
+            private.chmod(0)
+            with pytest.raises(SetupException):
+                elevate_writefile(str(dst), private)
+            assert dst.read_bytes() == data
+
+
+def test_has_changed():
+    with tempfile.TemporaryDirectory() as dir:
+        a, b = Path(dir).joinpath("a"), Path(dir).joinpath("b")
+        a.write_bytes(b"x" * 100 + b"y")
+        b.write_bytes(b"x" * 100 + b"y")
+        assert same_content(a, b, buf_size=8)
+        assert not has_changed(a, b)
+
+        b.write_bytes(b"x" * 100 + b"z")
+        assert not same_content(a, b, buf_size=8)
+        assert has_changed(a, b)
+
+        b.write_bytes(b"x" * 100)
+        assert has_changed(a, b)
+
+
+def test_ordered_map():
+    def slow(i):
+        time.sleep(0.001 * (10 - i % 10))
+        return i * 2
+
+    assert list(ordered_map(slow, range(50), workers=4)) == [i * 2 for i in range(50)]
+    assert list(ordered_map(slow, range(5), workers=1)) == [i * 2 for i in range(5)]
+
+
+def test_get_source_paths(monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        home, src = dir.joinpath("home"), dir.joinpath("src")
+        src.joinpath("dot_config", "exact_foo").mkdir(parents=True)
+        src.joinpath("dot_bashrc.tmpl").touch()
+        # 记录调用次数的chezmoi
+        calls = dir.joinpath("calls")
+        bin = dir.joinpath("chezmoi")
+        bin.write_text(f"""#!/bin/sh
+echo "$@" >> {calls}
+shift
+for p in "$@"; do echo "{src}/unmanaged_$(basename $p)"; done
+""")
+        bin.chmod(0o755)
+        for k, v in {
+            "CHEZMOI_HOME_DIR": home,
+            "CHEZMOI_SOURCE_DIR": src,
+            "CHEZMOI_EXECUTABLE": bin,
+        }.items():
+            monkeypatch.setenv(k, str(v))
+        monkeypatch.delenv("CHEZMOI_CACHE_DIR", raising=False)
+        monkeypatch.delenv("CHEZMOI_DEST_DIR", raising=False)
+
+        cz = ChezmoiArgs("chezmoi apply")
+        targets = [
+            home.joinpath(".bashrc"),
+            home.joinpath(".config", "foo"),
+            home.joinpath("a"),
+            home.joinpath("b"),
+        ]
+        paths = cz.get_source_paths(targets)
+        assert paths[targets[0]] == src.joinpath("dot_bashrc.tmpl")
+        assert paths[targets[1]] == src.joinpath("dot_config", "exact_foo")
+        assert paths[targets[2]] == src.joinpath("unmanaged_a")
+        assert paths[targets[3]] == src.joinpath("unmanaged_b")
+        assert cz.get_source_path(targets[2]) == src.joinpath("unmanaged_a")
+        assert cz.get_source_path(home) == src
+        # 只有一次批量调用
+        assert calls.read_text().splitlines() == [
+            f"source-path {targets[2]} {targets[3]}"
+        ]
+
+
+def test_data_cache(monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        src, cache = dir.joinpath("src"), dir.joinpath("cache")
+        src.mkdir()
+        src.joinpath(".chezmoi.toml.tmpl").write_text("")
+        config = dir.joinpath("chezmoi.toml")
+        config.write_text('[data]\nname = "a"\n')
+        calls = dir.joinpath("calls")
+        bin = dir.joinpath("chezmoi")
+        bin.write_text(f"""#!/bin/sh
+echo "$@" >> {calls}
+echo '{{"name": "'$(sed -n 's/name = "\\(.*\\)"/\\1/p' {config})'"}}'
+""")
+        bin.chmod(0o755)
+        for k, v in {
+            "CHEZMOI_CACHE_DIR": cache,
+            "CHEZMOI_CONFIG_FILE": config,
+            "CHEZMOI_SOURCE_DIR": src,
+            "CHEZMOI_EXECUTABLE": bin,
+        }.items():
+            monkeypatch.setenv(k, str(v))
+
+        def ncalls():
+            return len(calls.read_text().splitlines())
+
+        assert ChezmoiArgs("chezmoi apply").data() == {"name": "a"}
+        assert ChezmoiArgs("chezmoi apply").data() == {"name": "a"}
+        assert ncalls() == 1
+        assert cache.joinpath(".root.data.json").stat().st_mode & 0o777 == 0o600
+
+        # 配置文件内容改变
+        config.write_text('[data]\nname = "b"\n')
+        assert ChezmoiArgs("chezmoi apply").data() == {"name": "b"}
+        assert ncalls() == 2
+        # 源码目录中的.chezmoi*改变
+        src.joinpath(".chezmoidata").mkdir()
+        assert ChezmoiArgs("chezmoi apply").data() == {"name": "b"}
+        assert ChezmoiArgs("chezmoi apply").data() == {"name": "b"}
+        assert ncalls() == 3
+        src.joinpath(".chezmoidata", "x.yaml").write_text("")
+        ChezmoiArgs("chezmoi apply").data()
+        assert ncalls() == 4
+
+
+# 模拟restic：dump目录时输出成员名相对于/的tar流，文件直接输出内容
+FAKE_RESTIC = """
+import json, os, sys, tarfile
+from pathlib import Path
+
+if log := os.environ.get("FAKE_RESTIC_LOG"):
+    with open(log, "a") as f:
+        f.write(sys.argv[1] + "\\n")
+path = Path(sys.argv[-1])
+if sys.argv[1] == "cat":
+    print(json.dumps({"id": "repo"}))
+elif sys.argv[1] == "snapshots":
+    root = os.environ.get("FAKE_RESTIC_ROOT", "/")
+    snapshots = [
+        {"id": "1" * 64, "hostname": "a", "paths": ["/other"]},
+        {"id": "2" * 64, "hostname": "b", "paths": [root]},
+    ]
+    # 模拟新的备份
+    if new := os.environ.get("FAKE_RESTIC_NEW"):
+        snapshots.append({"id": new, "hostname": "b", "paths": [root]})
+    print(json.dumps(snapshots))
+elif sys.argv[1] == "ls":
+    print(json.dumps({"id": sys.argv[-1], "struct_type": "snapshot"}))
+    for p in Path(os.environ["FAKE_RESTIC_ROOT"]).rglob("*"):
+        st = p.stat()
+        node = {"path": p.as_posix(), "type": "dir" if p.is_dir() else "file"}
+        if p.is_file():
+            node["size"] = st.st_size
+        node["mtime"] = "2024-01-01T00:00:00Z"
+        print(json.dumps({**node, "struct_type": "node"}))
+elif path.is_dir():
+    with tarfile.open(fileobj=sys.stdout.buffer, mode="w|") as tar:
+        for p in sorted(path.rglob("*")):
+            tar.add(p, arcname=p.as_posix().lstrip("/"), recursive=False)
+else:
+    sys.stdout.buffer.write(path.read_bytes())
+"""
+
+
+def fake_restic(dir: Path) -> Path:
+    bin = dir.joinpath("restic")
+    bin.write_text(f"#!{sys.executable}\n{FAKE_RESTIC}")
+    bin.chmod(0o755)
+    return bin
+
+
+def test_restic_dump_many():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        bin = fake_restic(dir)
+        data = dir.joinpath("data")
+        data.joinpath("a", "b").mkdir(parents=True)
+        files = {
+            data.joinpath("a", "x"): os.urandom(200 * 1024),
+            data.joinpath("a", "b", "y"): b"y",
+            data.joinpath("z"): b"z",
+        }
+        for p, content in files.items():
+            p.write_bytes(content)
+        data.joinpath("a", "other").write_text("other")
+
+        restic = Restic(str(bin), cache=False)
+        dumped = {p: b"".join(chunks) for p, chunks in restic.dump_many(files)}
+        assert dumped == files
+
+        pairs = restic.dump_many(files)
+        _, chunks = next(pairs)
+        next(pairs)
+        # 前一个文件的数据已经被跳过
+        with pytest.raises(SetupException):
+            next(chunks)
+        pairs.close()
+
+        with pytest.raises(SetupException, match="missing"):
+            for _ in restic.dump_many([data.joinpath("z"), data.joinpath("missing")]):
+                pass
+
+
+@pytest.mark.skipif(not shutil.which("restic"), reason="restic is not installed")
+def test_restic_dump_many_repo():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        env = {
+            "RESTIC_REPOSITORY": str(dir.joinpath("repo")),
+            "RESTIC_PASSWORD": "test",
+        }
+        data = dir.joinpath("data")
+        data.joinpath("sub").mkdir(parents=True)
+        files = {data.joinpath("a"): b"a" * 100000, data.joinpath("sub", "b"): b"b"}
+        for p, content in files.items():
+            p.write_bytes(content)
+        full_env = {**os.environ, **env}
+        sp.run(["restic", "init"], env=full_env, check=True, capture_output=True)
+        sp.run(
+            ["restic", "backup", str(data)],
+            env=full_env,
+            check=True,
+            capture_output=True,
+        )
+
+        restic = Restic(shutil.which("restic"), env=env)
+        assert {p: b"".join(c) for p, c in restic.dump_many(files)} == files
+
+
+class XorCipher:
+    def encrypt(self, data: bytes) -> bytes:
+        return b"v1" + bytes(b ^ 0x5A for b in data)
+
+    def decrypt(self, token: bytes) -> bytes:
+        if not token.startswith(b"v1"):
+            raise ValueError("invalid token")
+        return bytes(b ^ 0x5A for b in token[2:])
+
+
+def test_restic_dump_cache():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        bin = fake_restic(dir)
+        log = dir.joinpath("log")
+        files = [dir.joinpath("data", name) for name in ["a", "b", "c"]]
+        files[0].parent.mkdir()
+        for p in files:
+            p.write_bytes(p.name.encode() * 1000)
+
+        cache = DumpCache(
+            dir.joinpath("cache"), XorCipher(), max_size=2500, max_entry_size=2000
+        )
+        env = {
+            "FAKE_RESTIC_LOG": str(log),
+            "DOTUTIL_CZ_RESTIC_META_DIR": str(dir.joinpath("meta")),
+        }
+        restic = Restic(str(bin), env=env, cache=cache)
+        assert b"".join(restic.dump(files[0])) == b"a" * 1000
+        # 缓存内容不是明文
+        (entry,) = dir.joinpath("cache").iterdir()
+        assert b"a" * 1000 not in entry.read_bytes()
+        assert b"".join(restic.dump(files[0])) == b"a" * 1000
+        # latest只解析一次，第二次命中缓存不需要dump
+        assert log.read_text().split() == ["cat", "snapshots", "dump"]
+
+        time.sleep(0.01)
+        dumped = {p: b"".join(c) for p, c in restic.dump_many(files)}
+        assert dumped == {p: p.name.encode() * 1000 for p in files}
+        assert log.read_text().split() == ["cat", "snapshots", "dump", "dump"]
+        # 超过max_size时淘汰最久未使用的a
+        assert cache.get("2" * 64, str(files[0])) is None
+        assert cache.get("2" * 64, str(files[2])) == b"c" * 1000
+
+        # 新的备份后latest的内容不会从旧snapshot的缓存中读取
+        _restic_resolved.clear()
+        files[2].write_bytes(b"new")
+        restic = Restic(str(bin), env={**env, "FAKE_RESTIC_NEW": "3" * 64}, cache=cache)
+        assert b"".join(restic.dump(files[2])) == b"new"
+
+
+def test_restic_dump_known_missing():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        bin = fake_restic(dir)
+        log = dir.joinpath("log")
+        data = dir.joinpath("data")
+        data.mkdir()
+        data.joinpath("a").write_text("a")
+        env = {
+            "FAKE_RESTIC_LOG": str(log),
+            "FAKE_RESTIC_ROOT": str(data),
+            "DOTUTIL_CZ_RESTIC_META_DIR": str(dir.joinpath("meta")),
+        }
+        cache = DumpCache(dir.joinpath("cache"), XorCipher())
+        restic = Restic(str(bin), env=env, cache=cache)
+        # 没有缓存文件列表时仍然dump
+        with pytest.raises(SetupException):
+            b"".join(restic.dump(data.joinpath("missing")))
+        assert log.read_text().split() == ["cat", "snapshots", "dump"]
+
+        assert restic.exists(data.joinpath("a"))
+        # 文件列表中不存在的文件不会dump
+        with pytest.raises(SetupException, match="missing"):
+            b"".join(restic.dump(data.joinpath("missing")))
+        dumped = {}
+        with pytest.raises(SetupException, match="missing"):
+            for p, chunks in restic.dump_many(
+                [data.joinpath("a"), data.joinpath("missing")]
+            ):
+                dumped[p] = b"".join(chunks)
+        assert dumped == {data.joinpath("a"): b"a"}
+        assert log.read_text().split() == ["cat", "snapshots", "dump", "ls", "dump"]
+
+        # 其它进程中从本地缓存读取文件列表
+        _restic_resolved.clear()
+        with pytest.raises(SetupException, match="missing"):
+            b"".join(restic.dump(data.joinpath("missing"), "2" * 64))
+        assert log.read_text().split()[5:] == []
+
+
+def test_restic_metadata():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        bin = fake_restic(dir)
+        log = dir.joinpath("log")
+        data = dir.joinpath("data")
+        data.joinpath("sub").mkdir(parents=True)
+        data.joinpath("sub", "a").write_text("abc")
+        env = {
+            "FAKE_RESTIC_LOG": str(log),
+            "FAKE_RESTIC_ROOT": str(data),
+            "DOTUTIL_CZ_RESTIC_META_DIR": str(dir.joinpath("meta")),
+        }
+
+        restic = Restic(str(bin), env=env, cache=False)
+        assert restic.resolve_snapshot() == "2" * 64
+        assert restic.resolve_snapshot("1") == "1" * 64
+        assert restic.resolve_snapshot(host="a") == "1" * 64
+        assert restic.stat(data.joinpath("sub", "a"))["size"] == 3
+        assert restic.stat(data.joinpath("sub"))["type"] == "dir"
+        assert not restic.exists(data.joinpath("missing"))
+        assert restic.latest_snapshot_with(data.joinpath("sub", "a")) == "2" * 64
+        assert restic.latest_snapshot_with(data.joinpath("missing")) is None
+        assert log.read_text().split() == ["cat", "snapshots", "ls"]
+
+        # 其它进程中短id与文件列表从本地缓存读取，latest重新查询snapshots
+        _restic_resolved.clear()
+        assert restic.resolve_snapshot("1") == "1" * 64
+        assert log.read_text().split() == ["cat", "snapshots", "ls"]
+        assert restic.exists(data.joinpath("sub", "a"))
+        assert log.read_text().split() == ["cat", "snapshots", "ls", "snapshots"]
+
+        # 新的备份后latest不会解析为缓存中旧的snapshot
+        _restic_resolved.clear()
+        restic = Restic(str(bin), env={**env, "FAKE_RESTIC_NEW": "3" * 64}, cache=False)
+        assert restic.resolve_snapshot() == "3" * 64
+        assert restic.latest_snapshot_with(data.joinpath("sub", "a")) == "3" * 64
+        assert log.read_text().split()[4:] == ["snapshots", "ls"]
+
+        # 缓存中没有的短id重新查询
+        _restic_resolved.clear()
+        restic = Restic(str(bin), env={**env, "FAKE_RESTIC_NEW": "4" * 64}, cache=False)
+        assert restic.resolve_snapshot("4") == "4" * 64
+        assert log.read_text().split()[6:] == ["snapshots"]
+
+        # snapshots过期后重新查询，文件列表仍然有效
+        _restic_resolved.clear()
+        restic = Restic(
+            str(bin), env={**env, "DOTUTIL_CZ_RESTIC_SNAPSHOTS_TTL": "0"}, cache=False
+        )
+        assert restic.resolve_snapshot("1") == "1" * 64
+        assert restic.exists(data.joinpath("sub", "a"), "1")
+        assert log.read_text().split()[7:] == ["snapshots", "ls"]
+
+
+@pytest.mark.skipif(not shutil.which("restic"), reason="restic is not installed")
+def test_restic_dump_cache_repo():
+    pytest.importorskip("cryptography")
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        env = {
+            "RESTIC_REPOSITORY": str(dir.joinpath("repo")),
+            "RESTIC_PASSWORD": "test",
+            "DOTUTIL_CZ_RESTIC_CACHE_DIR": str(dir.joinpath("cache")),
+            "DOTUTIL_CZ_RESTIC_META_DIR": str(dir.joinpath("meta")),
+        }
+        data = dir.joinpath("data")
+        data.mkdir()
+        data.joinpath("a").write_bytes(b"secret")
+        full_env = {**os.environ, **env}
+        sp.run(["restic", "init"], env=full_env, check=True, capture_output=True)
+        sp.run(
+            ["restic", "backup", str(data)],
+            env=full_env,
+            check=True,
+            capture_output=True,
+        )
+
+        restic = Restic(shutil.which("restic"), env=env)
+        assert b"".join(restic.dump(data.joinpath("a"))) == b"secret"
+        cache = restic.dump_cache()
+        assert cache is not None
+        snapshot_id = restic.resolve_snapshot()
+        assert cache.get(snapshot_id, str(data.joinpath("a"))) == b"secret"
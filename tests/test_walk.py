@@ -0,0 +1,100 @@
+import os
+import tempfile
+from pathlib import Path
+
+from dotutil_cz.walk import (
+    WalkCounters,
+    collapse_subtrees,
+    merge_sorted,
+    walk,
+    walk_subtrees,
+)
+
+
+def test_walk():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        dir.joinpath("a", "x").mkdir(parents=True)
+        dir.joinpath("a", "x", "f").touch()
+        dir.joinpath("a.txt").touch()
+        dir.joinpath("b").touch()
+        os.symlink(dir.joinpath("a"), dir.joinpath("l"))
+
+        counters = WalkCounters()
+        entries = list(walk(dir, counters=counters))
+        rels = [e.rel for e in entries]
+        assert set(rels) == {str(p.relative_to(dir)) for p in dir.rglob("*")}
+        # sorted by path parts
+        assert rels == sorted(rels, key=lambda s: Path(s).parts)
+        assert counters.scandir == 3
+        assert counters.stat == 0
+
+        files = [e.rel for e in entries if e.is_file()]
+        assert files == [os.path.join("a", "x", "f"), "a.txt", "b"]
+        link = entries[-1]
+        assert link.is_symlink() and not link.is_dir() and not link.is_file()
+        assert counters.stat == 2
+
+        rels = [e.rel for e in walk(dir, prune=lambda e: e.name == "x")]
+        assert os.path.join("a", "x", "f") not in rels
+        rels = [e.rel for e in walk(dir.joinpath("a"), root=dir.parent)]
+        assert rels[0] == os.path.join(dir.name, "a", "x")
+
+
+def test_collapse_subtrees():
+    root = Path("/home/u/.root")
+    assert collapse_subtrees(root, [Path("/home/u/.config")]) == []
+    assert collapse_subtrees(root, [Path("/home/u"), root.joinpath("etc")]) == [root]
+    assert collapse_subtrees(
+        root,
+        [
+            root.joinpath("etc", "ssh", "sshd_config"),
+            root.joinpath("usr"),
+            root.joinpath("etc", "ssh"),
+            root.joinpath("etc", "ssh"),
+            root.joinpath("etc", "hosts"),
+        ],
+    ) == [
+        root.joinpath("etc", "hosts"),
+        root.joinpath("etc", "ssh"),
+        root.joinpath("usr"),
+    ]
+
+
+def test_walk_subtrees():
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        dir.joinpath("etc", "ssh").mkdir(parents=True)
+        dir.joinpath("etc", "ssh", "sshd_config").touch()
+        dir.joinpath("etc", "hosts").touch()
+        dir.joinpath("usr").mkdir()
+
+        subtrees = collapse_subtrees(
+            dir,
+            [
+                dir.joinpath("etc", "ssh"),
+                dir.joinpath("etc", "hosts"),
+                dir.joinpath("x"),
+            ],
+        )
+        rels = [e.rel for e in walk_subtrees(dir, subtrees)]
+        assert rels == [
+            os.path.join("etc", "hosts"),
+            os.path.join("etc", "ssh"),
+            os.path.join("etc", "ssh", "sshd_config"),
+        ]
+        assert [e.rel for e in walk_subtrees(dir, [dir])] == [e.rel for e in walk(dir)]
+
+
+def test_merge_sorted():
+    sep = os.sep
+    old = [("a", 1), (f"a{sep}b", 2), ("a.b", 3), ("c", 4)]
+    new = [("a", 5), (f"a{sep}c", 6), ("a.b", 7), ("d", 8)]
+    assert list(merge_sorted(old, new)) == [
+        ("a", 1, 5),
+        (f"a{sep}b", 2, None),
+        (f"a{sep}c", None, 6),
+        ("a.b", 3, 7),
+        ("c", 4, None),
+        ("d", None, 8),
+    ]